@@ -0,0 +1,196 @@
+# +
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from scipy import optimize
+
+from qPCR_analysis import Data_processing
+
+def curves_from_frame(df):
+    '''
+    Convert raw fluorescence to a dense (wells x cycles) array.
+
+    Accepts either a wide frame with a Cycle column and one column per well, or
+    a long frame with Well, Cycle and Fluorescence columns.
+    Returns (wells, cycles, fluorescence).
+    '''
+    if 'Well' in df.columns:
+        df = df.pivot_table(index='Cycle', columns='Well', values='Fluorescence', aggfunc='mean', sort=False)
+    else:
+        df = df.set_index('Cycle')
+    df = df.sort_index()
+    return np.asarray(df.columns), df.index.to_numpy(dtype=float), df.to_numpy(dtype=float).T.copy()
+
+def import_amplification_curves(file_path):
+    '''
+    Import a raw amplification export (see curves_from_frame for the layouts)
+    '''
+    return curves_from_frame(pd.read_csv(file_path))
+
+def subtract_baseline(fluorescence, start=3, end=15):
+    '''
+    Subtract a per-well linear baseline fitted to cycles start..end (1-based,
+    inclusive) from every well at once
+    '''
+    cycles = np.arange(fluorescence.shape[1], dtype=float)
+    window = slice(start - 1, end)
+    x = cycles[window]
+    y = fluorescence[:, window]
+    x_mean = x.mean()
+    y_mean = y.mean(axis=1)
+    slope = ((x - x_mean) * (y - y_mean[:, None])).sum(axis=1) / ((x - x_mean) ** 2).sum()
+    baseline = y_mean[:, None] + slope[:, None] * (cycles - x_mean)
+    return fluorescence - baseline
+
+def default_threshold(corrected, start=3, end=15, multiple=10, plateau_fraction=0.01):
+    '''
+    Plate-wide threshold: multiple x the median baseline noise (SD) of all wells,
+    raised to plateau_fraction of the median well maximum so it lies in the
+    log-linear phase rather than at the end of the baseline window
+    '''
+    noise = multiple * np.median(corrected[:, start - 1:end].std(axis=1, ddof=1))
+    return max(noise, plateau_fraction * np.median(np.nanmax(corrected, axis=1)))
+
+def threshold_ct(corrected, cycles, threshold, min_cycle=None):
+    '''
+    Cycle at which each baseline-corrected curve first crosses threshold,
+    linearly interpolated between the cycles either side. NaN for wells that
+    never cross.
+    '''
+    above = corrected >= threshold
+    if min_cycle is not None:
+        above &= cycles >= min_cycle
+    # A crossing must stay above threshold on the next cycle, which skips single-cycle noise spikes
+    sustained = above & np.concatenate([above[:, 1:], above[:, -1:]], axis=1)
+    crossed = sustained.any(axis=1)
+    first = np.argmax(sustained, axis=1)
+    rows = np.arange(len(corrected))
+    before = np.maximum(first - 1, 0)
+    f_low, f_high = corrected[rows, before], corrected[rows, first]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        fraction = np.where(first > 0, (threshold - f_low) / (f_high - f_low), 0)
+    ct = cycles[before] + fraction * (cycles[first] - cycles[before])
+    return np.where(crossed, ct, np.nan)
+
+def window_efficiency(corrected, lower, window=5, plateau_fraction=0.9):
+    '''
+    LinRegPCR-style per-well efficiency.
+
+    log10 fluorescence is fitted over every window of consecutive cycles between
+    lower (e.g. the Ct threshold) and plateau_fraction of the well's maximum,
+    using cumulative sums so all windows of all wells are fitted at once. The
+    steepest window defines the amplification factor 10**slope.
+
+    Returns (efficiency %, window start index) per well.
+    '''
+    n_wells, n_cycles = corrected.shape
+    with np.errstate(divide='ignore', invalid='ignore'):
+        log_f = np.log10(np.where(corrected > 0, corrected, np.nan))
+    usable = np.isfinite(log_f) & (corrected >= lower) \
+        & (corrected < plateau_fraction * np.nanmax(corrected, axis=1, keepdims=True))
+    log_f = np.where(usable, log_f, 0)
+
+    x = np.arange(n_cycles, dtype=float)
+    # Sliding window sums via cumulative sums along the cycle axis
+    def window_sum(a):
+        c = np.cumsum(np.pad(a, [(0, 0), (1, 0)]), axis=1)
+        return c[:, window:] - c[:, :-window]
+    n = window_sum(usable.astype(float))
+    sx = window_sum(np.broadcast_to(x, log_f.shape) * usable)
+    sxx = window_sum(np.broadcast_to(x ** 2, log_f.shape) * usable)
+    sy = window_sum(log_f)
+    sxy = window_sum(log_f * x)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        slope = (n * sxy - sx * sy) / (n * sxx - sx ** 2)
+    slope = np.where(n == window, slope, -np.inf)
+
+    best = np.argmax(slope, axis=1)
+    best_slope = slope[np.arange(n_wells), best]
+    efficiency = np.where(np.isfinite(best_slope) & (best_slope > 0), (10 ** best_slope - 1) * 100, np.nan)
+    return efficiency, best
+
+def _logistic(x, baseline, amplitude, midpoint, scale):
+    return baseline + amplitude / (1 + np.exp(-(x - midpoint) / scale))
+
+def _fit_logistic(cycles, curve):
+    '''
+    Fit a 4-parameter logistic to one curve, NaNs if the fit fails
+    '''
+    guess = [curve.min(), np.ptp(curve), cycles[np.argmax(np.diff(curve))], 1.5]
+    try:
+        with np.errstate(over='ignore'):
+            params, _ = optimize.curve_fit(_logistic, cycles, curve, p0=guess, maxfev=5000)
+    except (RuntimeError, ValueError, optimize.OptimizeWarning):
+        return np.full(4, np.nan)
+    return params
+
+def _fit_logistic_chunk(cycles, curves):
+    return np.array([_fit_logistic(cycles, curve) for curve in curves]).reshape(-1, 4)
+
+def sigmoid_fit(corrected, cycles, workers=1):
+    '''
+    Fit a 4-parameter logistic to every well, splitting wells across worker
+    processes when workers > 1.
+
+    Returns a dataframe with Baseline, Amplitude, Midpoint, Scale and the
+    second-derivative-maximum cycle (SDM Ct) for each well.
+    '''
+    if workers == 1 or len(corrected) < 2:
+        params = _fit_logistic_chunk(cycles, corrected)
+    else:
+        chunks = np.array_split(corrected, min(workers, len(corrected)))
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            params = np.vstack(list(pool.map(_fit_logistic_chunk, [cycles] * len(chunks), chunks)))
+    fits = pd.DataFrame(params, columns=['Baseline', 'Amplitude', 'Midpoint', 'Scale'])
+    # The second derivative of a logistic peaks at midpoint - scale * ln(2 + sqrt(3))
+    fits['SDM Ct'] = fits['Midpoint'] - fits['Scale'] * np.log(2 + np.sqrt(3))
+    return fits
+
+def call_wells(wells, cycles, fluorescence, threshold=None, baseline=(3, 15), window=5,
+               sigmoid=False, workers=1):
+    '''
+    Goal: call Ct and efficiency for every well of one or more plates
+
+    Input:
+    wells, cycles, fluorescence - from import_amplification_curves
+    threshold - fluorescence threshold, defaults to default_threshold
+    baseline - first and last cycle of the baseline window, which should end
+        before the earliest well starts to amplify
+    window - cycles per LinRegPCR efficiency window
+    sigmoid - also fit a logistic to each well (slower, uses workers processes)
+
+    Output: dataframe with Well, Ct and Efficiency (plus the logistic fit columns
+    when sigmoid is True)
+    '''
+    corrected = subtract_baseline(fluorescence, *baseline)
+    if threshold is None:
+        threshold = default_threshold(corrected, *baseline)
+    calls = pd.DataFrame({
+        'Well': wells,
+        'Ct': threshold_ct(corrected, cycles, threshold),
+        'Efficiency': window_efficiency(corrected, threshold, window)[0],
+    })
+    if sigmoid:
+        calls = pd.concat([calls, sigmoid_fit(corrected, cycles, workers)], axis=1)
+    return calls
+
+def calls_to_tidy(calls, layout):
+    '''
+    Goal: turn called wells into the tidy frame the rest of the package uses
+
+    Input:
+    calls - output of call_wells
+    layout - plate layout with a Well column and the sample columns of one of
+        Data_processing.EXPECTED_HEADERS (e.g. Gene, Condition, Replicate)
+
+    Output: dataframe with the sample columns, Ct_value, SEM, n_wells and the mean
+    well Efficiency, one row per sample
+    '''
+    wells = layout.merge(calls, on='Well', how='inner')
+    ids = [c for c in Data_processing.ID_COLUMNS if c in wells.columns]
+    wells['Technical_replicate'] = wells.groupby(ids, sort=False).cumcount() + 1
+    tidy = Data_processing.aggregate_technical_replicates(wells)
+    efficiency = wells.groupby(ids, sort=False, dropna=False)['Efficiency'].mean().to_numpy()
+    tidy['Efficiency'] = efficiency
+    return tidy
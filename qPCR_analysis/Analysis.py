@@ -0,0 +1,222 @@
+# +
+import numpy as np
+import pandas as pd
+from scipy import stats
+
+from qPCR_analysis import Data_processing
+
+class Analysis:
+    '''
+    Tidy plate data plus its derived results, kept up to date incrementally.
+
+    Wells are held one per row (Data_processing.to_long_format). Each sample
+    (gene/condition/dilution/fraction/replicate) keeps running sums of its
+    wells' Cts, and each gene keeps running regression sums over its sample
+    means. Excluding, re-including or re-calling a well therefore updates
+    only that sample's mean/SEM and its gene's efficiency sums in O(1). The
+    Pfaffl ratios of the affected genes are recomputed lazily on the next call
+    to pfaffl().
+
+    Parameters:
+        df (pandas.DataFrame): Wide frame from import_and_tidy_data or a long
+            frame from to_long_format.
+        efficiencies, reference_genes, control_condition: Passed to
+            Data_processing.pfaffl_batch by pfaffl(); efficiencies left
+            out are taken from the primer efficiency registry.
+    '''
+
+    def __init__(self, df, efficiencies=None, reference_genes=None, control_condition=None):
+        wells = df if 'Ct' in df.columns else Data_processing.to_long_format(df)
+        self._wells = wells.reset_index(drop=True).copy()
+        self._ids = [c for c in Data_processing.ID_COLUMNS if c in self._wells.columns]
+        self._ct = self._wells['Ct'].to_numpy(dtype=float).copy()
+        if 'Outlier' in self._wells.columns:
+            # Wells masked by Data_processing.flag_outliers start out excluded
+            self._excluded = self._wells['Outlier'].to_numpy(dtype=bool).copy()
+        else:
+            self._excluded = np.zeros(len(self._ct), dtype=bool)
+
+        codes, self._sample_keys = pd.MultiIndex.from_frame(self._wells[self._ids]).factorize()
+        self._sample_keys.names = self._ids
+        self._well_sample = codes
+        n_samples = len(self._sample_keys)
+        active = self._active()
+        self._n = np.bincount(codes, weights=active, minlength=n_samples)
+        self._sum = np.bincount(codes, weights=np.where(active, self._ct, 0), minlength=n_samples)
+        self._sumsq = np.bincount(codes, weights=np.where(active, self._ct, 0) ** 2, minlength=n_samples)
+
+        sample_genes = self._sample_keys.get_level_values('Gene')
+        self._sample_gene, self._genes = pd.factorize(sample_genes)
+        self._init_regression()
+
+        if isinstance(reference_genes, str):
+            reference_genes = [reference_genes]
+        self.efficiencies = efficiencies
+        self.reference_genes = list(reference_genes) if reference_genes is not None else None
+        self.control_condition = control_condition
+        self._pfaffl_cache = {}
+        self._dirty_genes = set(self._genes)
+        self.last_recomputed = []
+
+    def _active(self):
+        return ~self._excluded & ~np.isnan(self._ct)
+
+    def _sample_means(self, samples=slice(None)):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(self._n[samples] > 0, self._sum[samples] / self._n[samples], np.nan)
+
+    def _init_regression(self):
+        '''
+        Per-gene sums of log10(dilution) vs sample mean Ct, for dilution layouts
+        '''
+        self._has_dilution = 'Dilution' in self._ids
+        if not self._has_dilution:
+            return
+        self._x = np.log10(self._sample_keys.get_level_values('Dilution').to_numpy(dtype=float))
+        self._y = self._sample_means()
+        used = ~np.isnan(self._y)
+        x, y = np.where(used, self._x, 0), np.where(used, self._y, 0)
+        n_genes = len(self._genes)
+        self._reg = {name: np.bincount(self._sample_gene, weights=w, minlength=n_genes)
+                     for name, w in [('n', used.astype(float)), ('x', x), ('y', y),
+                                     ('xx', x * x), ('xy', x * y), ('yy', y * y)]}
+
+    def _update_regression(self, samples):
+        old_y, new_y = self._y[samples], self._sample_means(samples)
+        x, genes = self._x[samples], self._sample_gene[samples]
+        for y, sign in ((old_y, -1), (new_y, 1)):
+            used = ~np.isnan(y)
+            y0, x0 = np.where(used, y, 0), np.where(used, x, 0)
+            for name, w in [('n', used.astype(float)), ('x', x0), ('y', y0),
+                            ('xx', x0 * x0), ('xy', x0 * y0), ('yy', y0 * y0)]:
+                np.add.at(self._reg[name], genes, sign * w)
+        self._y[samples] = new_y
+
+    def _set_wells(self, wells, excluded=None, cts=None):
+        wells = np.atleast_1d(np.asarray(wells, dtype=np.intp))
+        if cts is not None:
+            cts = np.broadcast_to(cts, wells.shape)
+        # A well listed twice would be counted twice in np.add.at: keep its last entry
+        last = len(wells) - 1 - np.unique(wells[::-1], return_index=True)[1]
+        wells = wells[last]
+        if cts is not None:
+            cts = cts[last]
+        before = self._active()[wells]
+        old_ct = np.where(before, self._ct[wells], 0)
+        if excluded is not None:
+            self._excluded[wells] = excluded
+        if cts is not None:
+            self._ct[wells] = cts
+        after = self._active()[wells]
+        new_ct = np.where(after, self._ct[wells], 0)
+
+        # Swap each well's old contribution for its new one in its sample's sums
+        samples = self._well_sample[wells]
+        np.add.at(self._n, samples, after.astype(float) - before)
+        np.add.at(self._sum, samples, new_ct - old_ct)
+        np.add.at(self._sumsq, samples, new_ct ** 2 - old_ct ** 2)
+
+        changed = np.unique(samples)
+        if self._has_dilution:
+            self._update_regression(changed)
+        genes = set(self._genes[np.unique(self._sample_gene[changed])])
+        if self.reference_genes and genes & set(self.reference_genes):
+            # Every ratio is normalised to the reference genes
+            genes = set(self._genes)
+        self._dirty_genes |= genes
+        return self
+
+    def exclude(self, wells):
+        '''
+        Exclude wells (row positions in .wells) from every result
+        '''
+        return self._set_wells(wells, excluded=True)
+
+    def include(self, wells):
+        '''
+        Re-include previously excluded wells
+        '''
+        return self._set_wells(wells, excluded=False)
+
+    def update_ct(self, wells, cts):
+        '''
+        Replace the Ct of wells, e.g. after re-calling them (NaN for no Ct)
+        '''
+        return self._set_wells(wells, cts=np.asarray(cts, dtype=float))
+
+    @property
+    def wells(self):
+        '''
+        One row per well with its current Ct and an Excluded column
+        '''
+        wells = self._wells.copy()
+        wells['Ct'] = self._ct
+        wells['Excluded'] = self._excluded
+        return wells
+
+    def samples(self):
+        '''
+        Tidy frame with Ct_value, SEM and n_wells per sample, from the running sums
+        '''
+        n = self._n
+        mean = self._sample_means()
+        with np.errstate(divide='ignore', invalid='ignore'):
+            variance = (self._sumsq - n * mean ** 2) / (n - 1)
+            sem = np.sqrt(np.clip(variance, 0, None) / n)
+        tidy = self._sample_keys.to_frame(index=False)
+        tidy['Ct_value'] = mean
+        tidy['SEM'] = np.where(n > 1, sem, np.nan)
+        tidy['n_wells'] = n.astype(int)
+        return tidy
+
+    def efficiency(self):
+        '''
+        Primer efficiency per gene (dilution layouts), from the running regression sums
+        '''
+        if not self._has_dilution:
+            raise ValueError('Efficiency needs a Dilution column')
+        r = self._reg
+        n = r['n']
+        sxx = r['xx'] - r['x'] ** 2 / n
+        syy = r['yy'] - r['y'] ** 2 / n
+        sxy = r['xy'] - r['x'] * r['y'] / n
+        with np.errstate(divide='ignore', invalid='ignore'):
+            slope = sxy / sxx
+            r_value = np.clip(sxy / np.sqrt(sxx * syy), -1.0, 1.0)
+            dof = n - 2
+            t_stat = r_value * np.sqrt(dof / ((1.0 - r_value) * (1.0 + r_value)))
+            std_err = np.sqrt((1 - r_value ** 2) * syy / sxx / dof)
+            efficiency = np.round((10 ** (-1 / slope) - 1) * 100, 2)
+        return pd.DataFrame({
+            'Gene': np.asarray(self._genes),
+            'Slope': slope,
+            'Intercept': (r['y'] - slope * r['x']) / n,
+            'Error': std_err,
+            'R': r_value,
+            'p_value': 2 * stats.t.sf(np.abs(t_stat), dof),
+            'Primer Efficiency': efficiency,
+        })
+
+    def pfaffl(self):
+        '''
+        Long-form Pfaffl ratios as Data_processing.pfaffl_batch, recomputing
+        only genes whose samples (or reference genes) changed since the last call
+        '''
+        if self.reference_genes is None or self.control_condition is None:
+            raise ValueError('pfaffl needs reference_genes and control_condition')
+        dirty = [g for g in self._genes if g in self._dirty_genes and g not in self.reference_genes]
+        if dirty:
+            tidy = self.samples()
+            keep = np.isin(self._sample_gene, self._genes.get_indexer(dirty + self.reference_genes))
+            result = Data_processing.pfaffl_batch(tidy[keep], self.efficiencies, self.reference_genes,
+                                                  self.control_condition, genes=dirty)
+            for gene, frame in result.groupby('Gene', sort=False):
+                self._pfaffl_cache[gene] = frame
+            for gene in set(dirty) - set(result['Gene']):
+                self._pfaffl_cache.pop(gene, None)
+        self._dirty_genes.clear()
+        self.last_recomputed = dirty
+        frames = [self._pfaffl_cache[g] for g in self._genes if g in self._pfaffl_cache]
+        if not frames:
+            return pd.DataFrame(columns=['Gene', 'Condition', 'Replicate', 'DeltaCt', 'Gene Expression Ratio'])
+        return pd.concat(frames, ignore_index=True)
@@ -0,0 +1,316 @@
+# +
+import argparse
+import io
+import json
+import os
+import platform
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+from qPCR_analysis import Data_processing
+
+def _wells_per_gene(layout, conditions, replicates, technical, fractions, dilutions):
+    if layout == 'GER':
+        return conditions * replicates * technical
+    if layout == 'polysome':
+        return conditions * fractions * technical
+    return dilutions * technical
+
+def synthetic_plate(layout='GER', genes=10, conditions=2, replicates=3, technical=3,
+                    fractions=10, dilutions=5, reference_genes=1, seed=0):
+    '''
+    Goal: generate a plate of realistic Cts in one of the csv layouts
+
+    Input:
+    layout - 'GER', 'polysome' or 'dilution' (Data_processing.EXPECTED_HEADERS)
+    genes - genes on the plate, the first reference_genes are named Ref1, Ref2, ...
+        and are unchanged between conditions
+    conditions - conditions per gene, the first one is 'Untreated'
+    replicates - biological replicates (GER)
+    technical - Ct columns (Ct1, Ct2, ...)
+    fractions - polysome fractions, dilutions - ten-fold dilution steps
+    seed - seed of the random generator
+
+    Output: wide dataframe as it would be read from the csv, one row per sample
+    '''
+    rng = np.random.default_rng(seed)
+    names = [f'Ref{i + 1}' for i in range(min(reference_genes, genes))]
+    names += [f'Gene{i + 1:05d}' for i in range(genes - len(names))]
+    condition_names = ['Untreated'] + [f'Treated{i}' if conditions > 2 else 'Treated' for i in range(1, conditions)]
+    base = rng.uniform(18, 30, genes)
+
+    if layout == 'GER':
+        grid = pd.MultiIndex.from_product([range(genes), range(conditions), range(1, replicates + 1)],
+                                          names=['Gene', 'Condition', 'Replicate']).to_frame(index=False)
+        effect = rng.normal(0, 1, (genes, conditions))
+        effect[:, 0] = 0
+        effect[:reference_genes] = 0
+        sample_ct = base[grid['Gene']] + effect[grid['Gene'], grid['Condition']] + rng.normal(0, 0.2, len(grid))
+        frame = pd.DataFrame({'Gene': np.asarray(names)[grid['Gene']],
+                              'Condition': np.asarray(condition_names)[grid['Condition']],
+                              'Replicate': grid['Replicate']})
+    elif layout == 'polysome':
+        grid = pd.MultiIndex.from_product([range(genes), range(1, fractions + 1), range(conditions)],
+                                          names=['Gene', 'Fraction', 'Condition']).to_frame(index=False)
+        # Each gene peaks in one fraction, Ct rises away from the peak
+        peak = rng.integers(1, fractions + 1, genes)
+        sample_ct = base[grid['Gene']] + 0.8 * np.abs(grid['Fraction'] - peak[grid['Gene']]) \
+            + rng.normal(0, 0.2, len(grid))
+        frame = pd.DataFrame({'Gene': np.asarray(names)[grid['Gene']], 'Fraction': grid['Fraction'],
+                              'Condition': np.asarray(condition_names)[grid['Condition']]})
+    elif layout == 'dilution':
+        grid = pd.MultiIndex.from_product([range(genes), range(dilutions)],
+                                          names=['Gene', 'Step']).to_frame(index=False)
+        # Undiluted samples start earlier so five ten-fold steps stay below 40 cycles
+        slope = rng.uniform(-3.6, -3.2, genes)
+        sample_ct = base[grid['Gene']] - 5 - slope[grid['Gene']] * grid['Step']
+        frame = pd.DataFrame({'Gene': np.asarray(names)[grid['Gene']], 'Dilution': 10.0 ** -grid['Step']})
+    else:
+        raise ValueError(f"Unknown layout {layout!r}: {list(Data_processing.EXPECTED_HEADERS)}")
+
+    cts = np.asarray(sample_ct)[:, None] + rng.normal(0, 0.1, (len(frame), technical))
+    for i in range(technical):
+        frame[f'Ct{i + 1}'] = np.round(cts[:, i], 3)
+    return frame
+
+def synthetic_run(folder, plates=4, layouts=('GER', 'dilution', 'polysome'), seed=0, **sizes):
+    '''
+    Write plates csv files to folder, cycling through layouts, each with its own
+    seed. sizes are passed to synthetic_plate. Returns the written paths.
+    '''
+    os.makedirs(folder, exist_ok=True)
+    paths = []
+    for i, child in enumerate(np.random.SeedSequence(seed).spawn(plates)):
+        layout = layouts[i % len(layouts)]
+        path = os.path.join(folder, f'plate_{i:04d}_{layout}.csv')
+        synthetic_plate(layout, seed=child, **sizes).to_csv(path, index=False)
+        paths.append(path)
+    return paths
+
+def genes_for_wells(wells, layout='GER', conditions=2, replicates=3, technical=3, fractions=10, dilutions=5):
+    '''
+    Number of genes that brings a plate of the given layout to about wells wells
+    '''
+    per_gene = _wells_per_gene(layout, conditions, replicates, technical, fractions, dilutions)
+    return max(int(np.ceil(wells / per_gene)), 2)
+
+def measure(function, repeats=3):
+    '''
+    Best wall time (seconds) of repeats calls and peak traced memory (bytes) of
+    one extra call. Memory is traced separately so tracing does not slow the
+    timed calls. NumPy and pandas buffers are included in the peak.
+    '''
+    seconds = np.inf
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function()
+        seconds = min(seconds, time.perf_counter() - start)
+    tracemalloc.start()
+    try:
+        function()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return seconds, peak
+
+def _render(fig):
+    import matplotlib.pyplot as plt
+    buffer = io.BytesIO()
+    fig.savefig(buffer, format='png', dpi=72)
+    plt.close(fig)
+    return buffer
+
+def _legacy_pfaffl(ctx):
+    tidy = ctx['tidy']['GER']
+    tidy = tidy[tidy['Condition'].isin(['Untreated', 'Treated']) & (tidy['Replicate'] <= 3)]
+    for gene in ctx['genes']['GER'][1:]:
+        pair = tidy[tidy['Gene'].isin([gene, 'Ref1'])].copy()
+        Data_processing.pfaffl(gene, 'Ref1', 'Treated', 'Untreated', 100, 100, pair)
+
+def _legacy_primer_efficiency(ctx):
+    tidy = ctx['tidy']['dilution']
+    for gene in ctx['genes']['dilution']:
+        Data_processing.primer_efficiency(tidy[tidy['Gene'] == gene].copy(), gene)
+
+def _legacy_polysome(ctx):
+    raw = ctx['raw']['polysome']
+    index = Data_processing.group_index(raw, ('Gene', 'Condition'))
+    for gene in ctx['genes']['polysome']:
+        for condition in raw['Condition'].unique():
+            Data_processing.polysome_profiling_analysis(raw, gene, condition, index=index)
+
+def _plot_ratio(ctx):
+    from qPCR_analysis import Plotting
+    gene = ctx['genes']['GER'][1]
+    _render(Plotting.plot_gene_expression_ratio(Plotting.ger_table(ctx['pfaffl'], gene), gene))
+
+def _plot_expression_grid(ctx):
+    from qPCR_analysis import Plotting
+    _render(Plotting.plot_expression_grid(ctx['pfaffl'], ctx['genes']['GER'][1:17]))
+
+def _plot_fraction_grid(ctx):
+    from qPCR_analysis import Plotting
+    _render(Plotting.plot_fraction_grid(ctx['polysome'], ctx['genes']['polysome'][:16]))
+
+def _pipeline(ctx):
+    from qPCR_analysis import Pipeline
+    Pipeline.run_pipeline(ctx['folder'], efficiencies=ctx['efficiencies'], reference_genes=['Ref1'],
+                          control_condition='Untreated', workers=ctx['workers'])
+
+# Benchmarked stages: name -> (layout whose size is reported, function of the prepared context).
+# Legacy per-gene functions loop over at most max_genes genes, reported in the Genes column.
+STAGES = {
+    'import_and_tidy_data': ('GER', lambda ctx: Data_processing.import_and_tidy_data(ctx['path']['GER'])),
+    'import_and_tidy_data_chunked': ('GER', lambda ctx: Data_processing.import_and_tidy_data_chunked(ctx['path']['GER'])),
+    'flag_outliers': ('GER', lambda ctx: Data_processing.flag_outliers(ctx['raw']['GER'])),
+    'primer_efficiency': ('dilution', _legacy_primer_efficiency),
+    'primer_efficiency_batch': ('dilution', lambda ctx: Data_processing.primer_efficiency_batch(ctx['tidy']['dilution'])),
+    'pfaffl': ('GER', _legacy_pfaffl),
+    'pfaffl_batch': ('GER', lambda ctx: Data_processing.pfaffl_batch(ctx['tidy']['GER'], ctx['efficiencies'], ['Ref1'], 'Untreated')),
+    'polysome_profiling_analysis': ('polysome', _legacy_polysome),
+    'polysome_profiling_batch': ('polysome', lambda ctx: Data_processing.polysome_profiling_batch(ctx['raw']['polysome'])),
+    'plot_gene_expression_ratio': ('GER', _plot_ratio),
+    'plot_expression_grid': ('GER', _plot_expression_grid),
+    'plot_fraction_grid': ('polysome', _plot_fraction_grid),
+    'run_pipeline': ('GER', _pipeline),
+}
+
+LEGACY_STAGES = {'primer_efficiency', 'pfaffl', 'polysome_profiling_analysis'}
+
+def _prepare(folder, wells, plates, max_genes, workers, seed, sizes):
+    '''
+    Generate every layout at the requested size plus the derived frames the stages use
+    '''
+    ctx = {'raw': {}, 'tidy': {}, 'path': {}, 'genes': {}, 'wells': {}, 'workers': workers}
+    for layout in Data_processing.EXPECTED_HEADERS:
+        raw = synthetic_plate(layout, genes=genes_for_wells(wells, layout, **sizes), seed=seed, **sizes)
+        path = os.path.join(folder, f'{layout}.csv')
+        raw.to_csv(path, index=False)
+        ctx['raw'][layout] = raw
+        ctx['path'][layout] = path
+        ctx['tidy'][layout] = Data_processing._tidy_chunk(raw.copy(), Data_processing.ct_columns(raw.columns))
+        ctx['genes'][layout] = list(raw['Gene'].unique()[:max_genes])
+        ctx['wells'][layout] = len(raw) * len(Data_processing.ct_columns(raw.columns))
+    # Run plates are smaller, so their genes are a subset of the GER plate's
+    ctx['efficiencies'] = dict.fromkeys(ctx['raw']['GER']['Gene'].unique(), 100.0)
+    ctx['pfaffl'] = Data_processing.pfaffl_batch(ctx['tidy']['GER'], ctx['efficiencies'], ['Ref1'], 'Untreated')
+    ctx['polysome'] = Data_processing.polysome_profiling_batch(ctx['raw']['polysome'])
+    ctx['folder'] = os.path.join(folder, 'run')
+    synthetic_run(ctx['folder'], plates, seed=seed,
+                  genes=genes_for_wells(wells / plates, **sizes), **sizes)
+    return ctx
+
+def run_benchmarks(wells=(10_000,), stages=None, repeats=3, plates=4, max_genes=20, workers=1, seed=0, **sizes):
+    '''
+    Goal: time the analysis and plotting hot paths on synthetic plates
+
+    Input:
+    wells - target well counts, one benchmark round per value
+    stages - names from STAGES (default: all)
+    repeats - timed calls per stage, the best is reported
+    plates - plates in the folder given to run_pipeline, which share the wells
+    max_genes - genes looped over by the legacy per-gene stages
+    workers - worker processes for run_pipeline
+    sizes - conditions, replicates, technical, fractions, dilutions (see synthetic_plate)
+
+    Output: dataframe with Stage, Wells, Genes, Seconds and Peak MB per stage and size
+    '''
+    stages = list(stages or STAGES)
+    unknown = set(stages) - set(STAGES)
+    if unknown:
+        raise ValueError(f'Unknown stages {sorted(unknown)}, choose from {list(STAGES)}')
+    rows = []
+    for target in wells:
+        with tempfile.TemporaryDirectory() as folder:
+            ctx = _prepare(folder, target, plates, max_genes, workers, seed, sizes)
+            for stage in stages:
+                layout, function = STAGES[stage]
+                seconds, peak = measure(lambda: function(ctx), repeats)
+                genes = len(ctx['genes'][layout]) if stage in LEGACY_STAGES else ctx['raw'][layout]['Gene'].nunique()
+                rows.append({'Stage': stage, 'Wells': ctx['wells'][layout], 'Genes': genes,
+                             'Seconds': seconds, 'Peak MB': peak / 2 ** 20})
+    return pd.DataFrame(rows)
+
+def save_baseline(results, file_path):
+    '''
+    Write benchmark results and the library versions they were measured with to json
+    '''
+    payload = {
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'pandas': pd.__version__,
+        'machine': platform.machine(),
+        'results': results.to_dict(orient='records'),
+    }
+    with open(file_path, 'w') as handle:
+        json.dump(payload, handle, indent=1)
+
+def load_baseline(file_path):
+    '''
+    Results saved by save_baseline, as a dataframe
+    '''
+    with open(file_path) as handle:
+        return pd.DataFrame(json.load(handle)['results'])
+
+def compare(results, baseline, tolerance=1.2):
+    '''
+    Goal: judge new benchmark results against a saved baseline
+
+    Input:
+    results - output of run_benchmarks
+    baseline - earlier results (load_baseline)
+    tolerance - slowdown (or memory growth) factor counted as a regression
+
+    Output: results with Baseline seconds, Baseline MB, Time ratio, Memory ratio
+    and Regression columns for the stages and sizes present in both
+    '''
+    merged = results.merge(baseline[['Stage', 'Wells', 'Seconds', 'Peak MB']],
+                           on=['Stage', 'Wells'], suffixes=('', ' baseline'))
+    merged = merged.rename(columns={'Seconds baseline': 'Baseline seconds', 'Peak MB baseline': 'Baseline MB'})
+    merged['Time ratio'] = merged['Seconds'] / merged['Baseline seconds']
+    merged['Memory ratio'] = merged['Peak MB'] / merged['Baseline MB']
+    merged['Regression'] = (merged['Time ratio'] > tolerance) | (merged['Memory ratio'] > tolerance)
+    return merged
+
+def build_parser(parser=None):
+    '''
+    Argument parser for the benchmark command line
+    '''
+    parser = parser or argparse.ArgumentParser(description='Benchmark qPCR_analysis on synthetic plates')
+    parser.add_argument('-n', '--wells', type=int, nargs='+', default=[10_000], help='target wells per round')
+    parser.add_argument('-s', '--stage', action='append', dest='stages', choices=list(STAGES),
+                        help='stage to run, repeat for several (default: all)')
+    parser.add_argument('--repeats', type=int, default=3, help='timed calls per stage')
+    parser.add_argument('--plates', type=int, default=4, help='plates in the run_pipeline folder')
+    parser.add_argument('--max-genes', type=int, default=20, help='genes looped over by legacy stages')
+    parser.add_argument('-w', '--workers', type=int, default=1, help='worker processes for run_pipeline')
+    parser.add_argument('--save', metavar='JSON', help='write the results as a baseline')
+    parser.add_argument('--compare', metavar='JSON', help='baseline to compare against')
+    parser.add_argument('--tolerance', type=float, default=1.2, help='slowdown factor counted as a regression')
+    return parser
+
+def run_from_args(args):
+    '''
+    Run the benchmarks for parsed arguments, print them and save or compare baselines
+    '''
+    results = run_benchmarks(args.wells, args.stages, repeats=args.repeats, plates=args.plates,
+                             max_genes=args.max_genes, workers=args.workers)
+    status = 0
+    if args.compare:
+        results = compare(results, load_baseline(args.compare), args.tolerance)
+        status = int(results['Regression'].any())
+    with pd.option_context('display.width', 200, 'display.max_columns', None):
+        print(results.to_string(index=False, float_format=lambda x: f'{x:.4g}'))
+    if args.save:
+        save_baseline(results[['Stage', 'Wells', 'Genes', 'Seconds', 'Peak MB']], args.save)
+    return status
+
+def main(argv=None):
+    return run_from_args(build_parser().parse_args(argv))
+
+if __name__ == '__main__':
+    raise SystemExit(main())
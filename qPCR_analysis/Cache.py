@@ -0,0 +1,154 @@
+# +
+import hashlib
+import os
+import time
+
+# Bump when the tidied output of the importers changes so stale cache files are ignored
+CACHE_VERSION = '1'
+
+# Default eviction limits cached() enforces after every write: total size of
+# the cache files and seconds since last use (None for no limit)
+MAX_CACHE_BYTES = 2 << 30
+MAX_CACHE_AGE = 30 * 24 * 3600
+
+# Seconds after which a write_frame temporary file is taken for a dead writer's
+TMP_MAX_AGE = 3600
+
+def default_cache_dir():
+    '''
+    Cache directory used when none is given: $QPCR_CACHE_DIR or ~/.cache/qPCR_analysis
+    '''
+    return os.environ.get('QPCR_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'qPCR_analysis'))
+
+def _require_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.ipc
+    except ImportError as err:
+        raise ImportError("The tidy-data cache needs pyarrow: pip install 'qPCR_analysis[cache]'") from err
+    return pyarrow
+
+def file_hash(file_path, block_size=1 << 20):
+    '''
+    SHA-256 of a file's contents, read in blocks so large exports are not loaded at once
+    '''
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as handle:
+        for block in iter(lambda: handle.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def cache_key(file_path, tag=''):
+    '''
+    Cache key built from the source file hash, CACHE_VERSION and an importer tag
+    '''
+    key = hashlib.sha256(f'{file_hash(file_path)}:{CACHE_VERSION}:{tag}'.encode()).hexdigest()
+    return key[:32]
+
+def write_frame(df, path):
+    '''
+    Write a dataframe to an uncompressed Arrow IPC file so it can be memory-mapped back
+    '''
+    pa = _require_pyarrow()
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with pa.OSFile(tmp_path, 'wb') as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+    os.replace(tmp_path, path)
+
+def read_frame(path):
+    '''
+    Memory-map an Arrow IPC file written by write_frame back into a dataframe.
+    Numeric columns without missing values are zero-copy, read-only views of
+    the mapped file; the other columns (strings, categories, columns with
+    NaNs) are converted into memory.
+    '''
+    pa = _require_pyarrow()
+    with pa.memory_map(str(path), 'r') as source:
+        table = pa.ipc.open_file(source).read_all()
+    # split_blocks keeps one block per column instead of copying them into 2D blocks
+    return table.to_pandas(split_blocks=True)
+
+def _remove(path):
+    '''
+    Remove a file another process may already have removed; True if this call removed it
+    '''
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        return False
+    return True
+
+def evict(cache_dir=None, max_bytes=None, max_age=None):
+    '''
+    Remove cache files older than max_age seconds, then the least recently used
+    files until the cache is no larger than max_bytes. Temporary files left by
+    writers that died are removed once older than TMP_MAX_AGE. Several
+    processes may evict the same directory at once. Returns the removed paths.
+    '''
+    cache_dir = cache_dir or default_cache_dir()
+    if not os.path.isdir(cache_dir):
+        return []
+    now = time.time()
+    entries = []
+    removed = []
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name)
+        try:
+            info = os.stat(path)
+        except FileNotFoundError:
+            continue
+        if name.endswith('.arrow'):
+            entries.append((info.st_mtime, info.st_size, path))
+        elif name.endswith('.tmp') and now - info.st_mtime > TMP_MAX_AGE and _remove(path):
+            removed.append(path)
+
+    if max_age is not None:
+        for entry in [e for e in entries if now - e[0] > max_age]:
+            if _remove(entry[2]):
+                removed.append(entry[2])
+            entries.remove(entry)
+    if max_bytes is not None:
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        while entries and total > max_bytes:
+            _, size, path = entries.pop(0)
+            if _remove(path):
+                removed.append(path)
+            total -= size
+    return removed
+
+def cached(file_path, builder, cache_dir=None, tag='', max_bytes=None, max_age=None):
+    '''
+    Goal: return builder(file_path), reusing a columnar copy of a previous result
+
+    Input:
+    file_path - source csv, its content hash keys the cache entry
+    builder - function turning file_path into a dataframe (e.g. import_and_tidy_data)
+    cache_dir - where cache files live, defaults to default_cache_dir()
+    tag - distinguishes different builders or options for the same file
+    max_bytes, max_age - eviction limits applied after a new entry is written,
+        MAX_CACHE_BYTES and MAX_CACHE_AGE when None
+
+    Output: the dataframe as read_frame returns it, on a hit and on a miss
+    alike: its numeric columns are read-only (copy the frame to edit it)
+    '''
+    cache_dir = cache_dir or default_cache_dir()
+    path = os.path.join(cache_dir, f'{cache_key(file_path, tag)}.arrow')
+    try:
+        # Refresh the timestamp so eviction is least-recently-used
+        os.utime(path)
+        return read_frame(path)
+    except FileNotFoundError:
+        # Not cached yet, or evicted by another process since
+        pass
+
+    df = builder(file_path)
+    os.makedirs(cache_dir, exist_ok=True)
+    write_frame(df, path)
+    # Mapped before evicting, which may remove the new entry itself
+    df = read_frame(path)
+    evict(cache_dir, max_bytes=MAX_CACHE_BYTES if max_bytes is None else max_bytes,
+          max_age=MAX_CACHE_AGE if max_age is None else max_age)
+    return df
@@ -0,0 +1,207 @@
+# +
+import argparse
+import os
+import sys
+
+# Only argparse is imported up front: pandas, scipy and matplotlib are imported
+# by the subcommand that needs them, so `qpcr --help` or `qpcr pfaffl` never
+# load matplotlib and only efficiency fits load scipy.
+
+def _write(table, output):
+    '''
+    Write a result table as csv to output, or to stdout when output is None or '-'
+    '''
+    if output in (None, '-'):
+        table.to_csv(sys.stdout, index=False)
+    else:
+        table.to_csv(output, index=False)
+
+def _load(args, tidy=True):
+    '''
+    Tidied frame of args.file. With tidy=False instrument exports stay one row
+    per well (the polysome analysis needs each well's Ct).
+    '''
+    from qPCR_analysis import Data_processing, Instruments
+    if Instruments.is_export(args.file):
+        return Instruments.read_export(args.file, layout=args.layout, tidy=tidy, qc=args.qc)
+    if args.chunksize:
+        return Data_processing.import_and_tidy_data_chunked(args.file, args.chunksize, cache_dir=args.cache_dir,
+                                                            qc=args.qc)
+    return Data_processing.import_and_tidy_data(args.file, cache_dir=args.cache_dir, qc=args.qc)
+
+def _efficiencies(args):
+    '''
+    Efficiency table from --efficiency-table csvs (qpcr efficiency output) and
+    GENE=PERCENT values, later ones overriding earlier ones
+    '''
+    import pandas as pd
+    from qPCR_analysis import Data_processing
+    from qPCR_analysis.Pipeline import _parse_efficiencies
+    tables = [Data_processing._efficiency_lookup(pd.read_csv(path)) for path in args.efficiency_table or []]
+    tables.append(Data_processing._efficiency_lookup(_parse_efficiencies(args.efficiency)))
+    merged = pd.concat(tables)
+    return merged[~merged.index.duplicated(keep='last')].to_dict()
+
+def _pfaffl(args, df):
+    from qPCR_analysis import Data_processing
+    return Data_processing.pfaffl_batch(df, _efficiencies(args), args.reference_genes, args.control_condition,
+                                        lot=args.lot)
+
+def run_import(args):
+    _write(_load(args), args.output)
+    return 0
+
+def run_efficiency(args):
+    from qPCR_analysis import Data_processing, Efficiencies
+    df = _load(args)
+    if args.register:
+        table = Efficiencies.fit(df, lot=args.lot, registry_dir=args.registry_dir)
+    else:
+        table = Data_processing.primer_efficiency_batch(df)
+    _write(table, args.output)
+    return 0
+
+def run_pfaffl(args):
+    from qPCR_analysis import Data_processing
+    result = _pfaffl(args, _load(args))
+    _write(Data_processing.summarize_pfaffl(result) if args.summary else result, args.output)
+    return 0
+
+def run_polysome(args):
+    from qPCR_analysis import Data_processing
+    result = Data_processing.polysome_profiling_batch(_load(args, tidy=False), args.baseline_fraction)
+    _write(Data_processing.summarize_polysome(result) if args.summary else result, args.output)
+    return 0
+
+def run_plot(args):
+    from qPCR_analysis import Data_processing, Plotting
+    df = _load(args, tidy=False)
+    layout = Data_processing.frame_layout(df.columns)
+    if layout != 'polysome' and 'Ct' in df.columns:
+        df = Data_processing.aggregate_technical_replicates(df)
+    if layout == 'dilution':
+        data = {'dilution_df': df, 'efficiency_df': Data_processing.primer_efficiency_batch(df)}
+    elif layout == 'polysome':
+        data = {'polysome_df': Data_processing.polysome_profiling_batch(df, args.baseline_fraction)}
+    else:
+        if args.reference_genes is None or args.control_condition is None:
+            raise SystemExit('qpcr plot: GER plates need --reference and --control')
+        data = {'pfaffl_df': _pfaffl(args, df)}
+    written = Plotting.export_figures(args.output_dir, formats=args.formats or ['png'], workers=args.workers,
+                                      dpi=args.dpi, **data)
+    print(f'{len(written)} files written to {args.output_dir}')
+    return 0
+
+def run_watch(args):
+    from qPCR_analysis import Watch
+    formats = [] if args.no_figures else args.formats or ['png']
+    watcher = Watch.watch(args.folder, args.output_dir, max_plates=args.max_plates, timeout=args.timeout,
+                          workers=args.workers, poll_interval=args.poll, settle=args.settle,
+                          recursive=args.recursive, existing=not args.skip_existing,
+                          efficiencies=_efficiencies(args), reference_genes=args.reference_genes,
+                          control_condition=args.control_condition, qc=args.qc, lot=args.lot,
+                          register=args.register, formats=formats, dpi=args.dpi)
+    for name, value in watcher.summary().items():
+        print(f'{name}: {value:.3g}' if isinstance(value, float) else f'{name}: {value}')
+    return 0
+
+def _add_pfaffl_options(parser, required):
+    parser.add_argument('-r', '--reference', action='append', dest='reference_genes', required=required,
+                        help='reference gene, repeat for several')
+    parser.add_argument('-c', '--control', dest='control_condition', required=required,
+                        help='calibrator condition')
+    parser.add_argument('-e', '--efficiency', action='append', metavar='GENE=PERCENT',
+                        help='primer efficiency for a gene, repeat for several')
+    parser.add_argument('--efficiency-table', action='append', metavar='CSV',
+                        help='csv with Gene and Primer Efficiency columns (qpcr efficiency output)')
+    parser.add_argument('--lot', help='primer lot of the registered efficiencies used for genes not given '
+                                      'with -e or --efficiency-table (default: latest fit of any lot)')
+
+def build_parser():
+    '''
+    Argument parser for the qpcr command and its subcommands
+    '''
+    parser = argparse.ArgumentParser(prog='qpcr', description='Analyze RT-qPCR Ct exports')
+    commands = parser.add_subparsers(dest='command', required=True, metavar='command')
+
+    # Options shared by every subcommand that reads a Ct csv
+    source = argparse.ArgumentParser(add_help=False)
+    source.add_argument('file', help='csv with Gene, ... and Ct1, Ct2, ... columns, or an RDML, '
+                                     'QuantStudio or CFX export (.rdml, .txt, .xlsx, .csv)')
+    source.add_argument('--layout', help='plate layout csv for instrument exports, keyed by Sample or Well')
+    source.add_argument('--qc', choices=['median', 'spread', 'grubbs'],
+                        help='mask outlier technical replicates with this rule')
+    source.add_argument('--chunksize', type=int, help='stream the csv in chunks of this many rows')
+    source.add_argument('--cache-dir', help='cache the tidied import here')
+    output = argparse.ArgumentParser(add_help=False)
+    output.add_argument('-o', '--output', help='output csv (default: stdout)')
+
+    command = commands.add_parser('import', parents=[source, output],
+                                  help='average technical replicates into a tidy csv')
+    command.set_defaults(run=run_import)
+
+    command = commands.add_parser('efficiency', parents=[source, output],
+                                  help='primer efficiency of every gene of a dilution plate')
+    command.add_argument('--register', action='store_true',
+                         help='store the fit in the primer efficiency registry, reusing it if the data is unchanged')
+    command.add_argument('--lot', help='primer lot the dilution series was run with')
+    command.add_argument('--registry-dir', help='registry directory (default: $QPCR_EFFICIENCY_DIR or the cache dir)')
+    command.set_defaults(run=run_efficiency)
+
+    command = commands.add_parser('pfaffl', parents=[source, output],
+                                  help='Pfaffl gene expression ratios of a GER plate')
+    _add_pfaffl_options(command, required=True)
+    command.add_argument('--summary', action='store_true', help='mean and SEM per gene and condition')
+    command.set_defaults(run=run_pfaffl)
+
+    command = commands.add_parser('polysome', parents=[source, output],
+                                  help='percent of mRNA per polysome fraction')
+    command.add_argument('--baseline-fraction', type=int, default=1, help='delta Ct reference fraction')
+    command.add_argument('--summary', action='store_true', help='mean and SEM per gene, condition and fraction')
+    command.set_defaults(run=run_polysome)
+
+    command = commands.add_parser('plot', parents=[source], help='export the per-gene figures of a plate')
+    command.add_argument('-o', '--output-dir', default='.', help='where figures are written')
+    command.add_argument('-f', '--format', action='append', dest='formats', metavar='EXT',
+                         help='file format, repeat for several (default: png)')
+    command.add_argument('--dpi', type=int, default=100, help='resolution of raster formats')
+    command.add_argument('-w', '--workers', type=int, default=None, help='worker processes (default: one per core)')
+    command.add_argument('--baseline-fraction', type=int, default=1, help='delta Ct reference fraction (polysome)')
+    _add_pfaffl_options(command, required=False)
+    command.set_defaults(run=run_plot)
+
+    command = commands.add_parser('watch', help='analyze plates as they are written to a folder')
+    command.add_argument('folder', help='folder the instrument exports to')
+    command.add_argument('-o', '--output-dir', required=True, help='where results, figures and watch_report.csv go')
+    command.add_argument('-w', '--workers', type=int, default=None,
+                         help='worker processes (default: one per core, 1 runs in-process)')
+    command.add_argument('--poll', type=float, default=1.0, help='seconds between folder scans')
+    command.add_argument('--settle', type=float, default=2.0,
+                         help='seconds a file must stay unchanged before it is analyzed')
+    command.add_argument('--recursive', action='store_true', help='also watch subfolders')
+    command.add_argument('--skip-existing', action='store_true', help='ignore files already in the folder')
+    command.add_argument('--qc', choices=['median', 'spread', 'grubbs'],
+                         help='mask outlier technical replicates with this rule')
+    command.add_argument('--register', action='store_true',
+                         help='store dilution plate fits in the primer efficiency registry')
+    command.add_argument('-f', '--format', action='append', dest='formats', metavar='EXT',
+                         help='figure format, repeat for several (default: png)')
+    command.add_argument('--no-figures', action='store_true', help='only write result tables')
+    command.add_argument('--dpi', type=int, default=100, help='resolution of raster formats')
+    command.add_argument('--max-plates', type=int, help='stop after this many plates')
+    command.add_argument('--timeout', type=float, help='stop after this many seconds')
+    _add_pfaffl_options(command, required=False)
+    command.set_defaults(run=run_watch)
+    return parser
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    try:
+        return args.run(args)
+    except BrokenPipeError:
+        # Output piped into e.g. head, which stopped reading
+        sys.stdout = open(os.devnull, 'w')
+        return 0
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -1,9 +1,23 @@
 # +
+import warnings
+
 import numpy as np
 import pandas as pd 
-from scipy import stats
 
-def import_and_tidy_data(file_path):
+# scipy.stats is imported inside the few functions that use it: it takes longer
+# to import than pandas and most commands never need it
+
+# Identifier columns for each supported csv layout, followed by Ct1, Ct2, ... columns
+EXPECTED_HEADERS = {
+    'GER': ['Gene', 'Condition', 'Replicate'],      #for GER tests
+    'polysome': ['Gene', 'Fraction', 'Condition'],  #for polysome profiling qPCR
+    'dilution': ['Gene', 'Dilution'],               #for dilution series, Replicate is optional
+}
+
+# Strings instruments write in place of a Ct when no amplification was detected
+NA_CT_VALUES = ['Undetermined', 'undetermined', 'No Ct', 'N/A']
+
+def import_and_tidy_data(file_path, cache_dir=None, qc=None):
     '''
     Import csv file with the following headings:
     Gene
@@ -11,20 +25,320 @@ def import_and_tidy_data(file_path):
     Replicate
     Ct1
     Ct2
-    Ct3
+    ...
 
     This will import the csv file and average technical Ct replicates 
+    (any number of Ct columns, 'Undetermined' or empty wells are skipped)
+
+    If cache_dir is given the tidied frame is stored there as an Arrow file
+    keyed by the csv's content hash and returned memory-mapped from it, on
+    this and later calls (its numeric columns are read-only, see Cache.cached)
+
+    qc names an outlier rule ('grubbs', 'median' or 'spread', see
+    flag_outliers); outlier wells are then left out of Ct_value and SEM and
+    recorded in an Outlier mask column
+
+    Raises ValueError when the header matches no layout (see detect_layout)
     '''
-    df = pd.read_csv(file_path)
-    expected_headers1 = ['Gene', 'Condition', 'Replicate', 'Ct1', 'Ct2', 'Ct3'] #for GER tests
-    expected_headers2 = ['Gene', 'Dilution', 'Replicate', 'Ct1', 'Ct2', 'Ct3']  #for dilution series and    
-    expected_headers3 = ['Gene', 'Fraction', 'Condition', 'Ct1', 'Ct2', 'Ct3'] #for polysome profiling qPCR
+    if cache_dir is not None:
+        from qPCR_analysis import Cache
+        return Cache.cached(file_path, lambda path: import_and_tidy_data(path, qc=qc), cache_dir,
+                            tag=f'import_and_tidy_data:{qc}')
+    df = pd.read_csv(file_path, na_values=NA_CT_VALUES)
+    detect_layout(df.columns)
+    reps = ct_columns(df.columns)
+    df[reps] = df[reps].apply(pd.to_numeric, errors='coerce')
 
-    df['Ct_value'] = df[['Ct1', 'Ct2', 'Ct3']].mean(axis=1)    
-    df['SEM'] = df[['Ct1', 'Ct2', 'Ct3']].sem(axis=1)
+    return _tidy_chunk(df, reps, qc)
 
+
+def ct_columns(columns):
+    '''
+    Return the technical replicate columns (Ct1, Ct2, ...) of a header in replicate order
+    '''
+    reps = [c for c in columns if isinstance(c, str) and c[:2] == 'Ct' and c[2:].isdigit()]
+    return sorted(reps, key=lambda c: int(c[2:]))
+
+def detect_layout(columns):
+    '''
+    Match a csv header against EXPECTED_HEADERS and return the layout name
+    ('GER', 'polysome' or 'dilution'). Raises ValueError for an unknown header.
+    '''
+    columns = [c.strip() if isinstance(c, str) else c for c in columns]
+    if not ct_columns(columns):
+        raise ValueError(f"No Ct replicate columns (Ct1, Ct2, ...) found in header {columns}")
+    return _match_layout(columns)
+
+def frame_layout(columns):
+    '''
+    Layout of any frame the importers return: a wide Ct csv (see
+    detect_layout), a long per-well frame with a Ct column (to_long_format,
+    Instruments.read_export) or a tidied one with Ct_value
+    (aggregate_technical_replicates). Raises ValueError for an unknown header.
+    '''
+    if ct_columns(columns):
+        return detect_layout(columns)
+    if 'Ct' not in columns and 'Ct_value' not in columns:
+        raise ValueError(f"No Ct, Ct_value or Ct replicate columns found in {list(columns)}")
+    return _match_layout(list(columns))
+
+def _match_layout(columns):
+    for layout in ('polysome', 'dilution', 'GER'):
+        if all(c in columns for c in EXPECTED_HEADERS[layout]):
+            return layout
+    raise ValueError(f"Header {columns} does not match any known layout: {EXPECTED_HEADERS}")
+
+def _compact_dtypes(layout, columns):
+    '''
+    Column dtypes used by the chunked importer: categorical labels and float32 Cts
+    '''
+    dtypes = {c: 'float32' for c in ct_columns(columns)}
+    dtypes['Gene'] = 'category'
+    if 'Condition' in columns:
+        dtypes['Condition'] = 'category'
+    if layout == 'dilution':
+        dtypes['Dilution'] = 'float64'
+    return dtypes
+
+def _tidy_chunk(df, reps, qc=None):
+    '''
+    Average the technical replicates of one chunk and record their SEM
+    '''
+    if qc is not None:
+        return flag_outliers(df, method=qc)
+    df['Ct_value'] = df[reps].mean(axis=1)
+    df['SEM'] = df[reps].sem(axis=1)
     return df
+
+# Default outlier cut-offs in cycles: distance from the sample median, or spread of its wells
+OUTLIER_THRESHOLDS = {'median': 1.0, 'spread': 0.5}
+
+def _grubbs_critical(n, alpha):
+    '''
+    Two-sided Grubbs critical value for samples of size n (NaN where n < 3)
+    '''
+    from scipy import stats
+    n = np.asarray(n, dtype=float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = stats.t.ppf(1 - alpha / (2 * n), n - 2)
+        return (n - 1) / np.sqrt(n) * np.sqrt(t ** 2 / (n - 2 + t ** 2))
+
+def outlier_mask(cts, method='median', threshold=None, alpha=0.05):
+    '''
+    Flag outlier technical replicates in a (samples x replicates) Ct matrix.
+
+    NaN wells (no amplification) are ignored and never flagged. Samples with
+    fewer than 3 wells are left alone, as a pair cannot say which well is off.
+
+    method:
+    'median' - every well more than threshold cycles from the sample median
+    'grubbs' - the well furthest from the mean if its Grubbs statistic exceeds
+        the critical value at alpha (one test per sample). With triplicates
+        the statistic can barely reach the critical value, so this rule is
+        mainly useful for 4 or more wells per sample
+    'spread' - the well furthest from the median if max - min exceeds threshold
+
+    Returns a boolean matrix of the same shape, True for outlier wells.
+    '''
+    cts = np.asarray(cts, dtype=float)
+    valid = ~np.isnan(cts)
+    n = valid.sum(axis=1)
+    testable = (n >= 3)[:, None]
+    if method != 'grubbs' and threshold is None:
+        threshold = OUTLIER_THRESHOLDS[method]
+
+    with np.errstate(invalid='ignore'), warnings.catch_warnings():
+        # All-NaN rows are expected (e.g. no-template controls)
+        warnings.simplefilter('ignore', RuntimeWarning)
+        if method == 'median':
+            mask = np.abs(cts - np.nanmedian(cts, axis=1, keepdims=True)) > threshold
+        elif method in ('grubbs', 'spread'):
+            centre = np.nanmean(cts, axis=1, keepdims=True) if method == 'grubbs' \
+                else np.nanmedian(cts, axis=1, keepdims=True)
+            distance = np.where(valid, np.abs(cts - centre), -np.inf)
+            furthest = np.argmax(distance, axis=1)
+            if method == 'grubbs':
+                flagged = distance.max(axis=1) / np.nanstd(cts, axis=1, ddof=1) > _grubbs_critical(n, alpha)
+            else:
+                flagged = np.nanmax(cts, axis=1) - np.nanmin(cts, axis=1) > threshold
+            mask = np.zeros(cts.shape, dtype=bool)
+            mask[np.arange(len(cts)), furthest] = flagged
+        else:
+            raise ValueError(f"Unknown outlier method {method!r}, use 'grubbs', 'median' or 'spread'")
+    return mask & valid & testable
+
+def flag_outliers(df, method='median', threshold=None, alpha=0.05):
+    '''
+    Goal: mask outlier technical replicates of a wide Ct frame
+
+    Input:
+    df - dataframe with Ct1, Ct2, ... columns (e.g. from import_and_tidy_data)
+    method, threshold, alpha - outlier rule, see outlier_mask
+
+    Output: copy of df with Ct_value and SEM recomputed without the outlier
+    wells, and an Outlier mask column (bit i set when Ct{i+1} was masked).
+    The raw Ct columns are kept so the mask can be reviewed or undone.
+    '''
+    reps = ct_columns(df.columns)
+    cts = df[reps].apply(pd.to_numeric, errors='coerce').to_numpy(dtype=float)
+    mask = outlier_mask(cts, method, threshold, alpha)
+    kept = np.where(mask, np.nan, cts)
+
+    flagged = df.copy()
+    n = (~np.isnan(kept)).sum(axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'), warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        flagged['Ct_value'] = np.nanmean(kept, axis=1)
+        flagged['SEM'] = np.where(n > 1, np.nanstd(kept, axis=1, ddof=1) / np.sqrt(n), np.nan)
+    flagged['Outlier mask'] = (mask * (1 << np.arange(len(reps)))).sum(axis=1)
+    return flagged
+
+def flag_long_outliers(long_df, method='median', threshold=None, alpha=0.05):
+    '''
+    Goal: mask outlier technical replicates of a long frame (one row per well,
+    as to_long_format or the Instruments readers)
+
+    Output: copy of long_df whose Outlier column also marks the wells
+    outlier_mask flags within each sample. Wells already marked Outlier (e.g.
+    omitted on the instrument) are left out of the test and stay marked.
+    '''
+    ids = [c for c in ID_COLUMNS if c in long_df.columns]
+    excluded = long_df['Outlier'].to_numpy(dtype=bool) if 'Outlier' in long_df.columns \
+        else np.zeros(len(long_df), dtype=bool)
+    sample = long_df.groupby(ids, sort=False, dropna=False).ngroup().to_numpy()
+    well = long_df.groupby(ids, sort=False, dropna=False).cumcount().to_numpy()
+    cts = np.full((sample.max() + 1 if len(sample) else 0, well.max() + 1 if len(well) else 0), np.nan)
+    cts[sample, well] = np.where(excluded, np.nan, pd.to_numeric(long_df['Ct'], errors='coerce'))
+    mask = outlier_mask(cts, method, threshold, alpha)
+    return long_df.assign(Outlier=excluded | mask[sample, well])
+
+def iter_tidy_chunks(file_path, chunksize=100_000, qc=None):
+    '''
+    Stream a large Ct export in chunks of chunksize rows.
+
+    The header is validated once against the known layouts, Gene/Condition are
+    read as categoricals and Cts as float32 (with 'Undetermined' read as NaN).
+    Each yielded chunk is tidied like import_and_tidy_data (including the
+    optional qc outlier rule), so the raw file is never held in memory at once.
+    '''
+    header = pd.read_csv(file_path, nrows=0).columns.str.strip()
+    layout = detect_layout(header)
+    reps = ct_columns(header)
+    reader = pd.read_csv(file_path, chunksize=chunksize, header=0, names=list(header),
+                         dtype=_compact_dtypes(layout, list(header)), na_values=NA_CT_VALUES)
+    with reader:
+        for chunk in reader:
+            yield _tidy_chunk(chunk, reps, qc)
+
+def import_and_tidy_data_chunked(file_path, chunksize=100_000, cache_dir=None, qc=None):
+    '''
+    Import a large csv through iter_tidy_chunks and concatenate the tidied chunks
+    into one compact dataframe, merging the per-chunk categories. cache_dir and
+    qc work as in import_and_tidy_data.
+    '''
+    if cache_dir is not None:
+        from qPCR_analysis import Cache
+        return Cache.cached(file_path, lambda path: import_and_tidy_data_chunked(path, chunksize, qc=qc),
+                            cache_dir, tag=f'import_and_tidy_data_chunked:{qc}')
+    chunks = list(iter_tidy_chunks(file_path, chunksize, qc))
+    if not chunks:
+        return pd.DataFrame()
+    categorical = [c for c in chunks[0].columns if isinstance(chunks[0][c].dtype, pd.CategoricalDtype)]
+    merged = {c: pd.api.types.union_categoricals([chunk[c] for chunk in chunks]) for c in categorical}
+    df = pd.concat([chunk.drop(columns=categorical) for chunk in chunks], ignore_index=True)
+    for c in categorical:
+        df[c] = merged[c]
+    return df[chunks[0].columns]
     
+# Columns identifying a biological sample, in the order they are grouped on
+ID_COLUMNS = ['Gene', 'Condition', 'Dilution', 'Fraction', 'Replicate']
+
+def group_index(df, columns=('Gene', 'Condition')):
+    '''
+    Goal: row positions of every group of df on columns, for many lookups
+
+    Input:
+    df - dataframe, e.g. from import_and_tidy_data
+    columns - grouping columns, any subset of ID_COLUMNS
+
+    Output: dict with the grouping 'columns' and 'groups', label tuple (in the
+    order of columns) -> ascending row positions. Rows are stably sorted by
+    their group codes once and each group is a slice of that order (an offset
+    table), so looking up a group with select_rows costs a dict lookup instead
+    of an O(rows) comparison of every label.
+
+    The index describes df as it is now: build it where the lookups happen and
+    build a new one after df is sorted or relabelled in place.
+    '''
+    columns = tuple(columns)
+    # Combine the columns' codes one at a time, renumbering so codes stay below len(df)
+    group = np.zeros(len(df), dtype=np.int64)
+    for column in columns:
+        column_codes, uniques = pd.factorize(df[column], use_na_sentinel=False)
+        group = np.unique(group * len(uniques) + column_codes, return_inverse=True)[1].ravel()
+    order = np.argsort(group, kind='stable')
+    bounds = np.concatenate([[0], np.cumsum(np.bincount(group))])
+    first = order[bounds[:-1]]
+    labels = zip(*(df[column].to_numpy()[first] for column in columns))
+    groups = {label: order[start:end] for label, start, end in zip(labels, bounds[:-1], bounds[1:])}
+    return {'columns': columns, 'groups': groups}
+
+def select_rows(df, index=None, **labels):
+    '''
+    Rows of df whose columns equal the given labels, e.g.
+    select_rows(df, Gene='GAPDH', Condition='Treated'). With index, a
+    group_index of df on exactly those columns, the rows are looked up in it
+    instead of filtered with boolean masks.
+    '''
+    if index is None:
+        mask = np.ones(len(df), dtype=bool)
+        for column, label in labels.items():
+            mask &= (df[column].isna() if pd.isna(label) else df[column] == label).to_numpy(dtype=bool)
+        return df[mask]
+    if set(index['columns']) != set(labels):
+        raise ValueError(f"Index on {index['columns']} cannot select by {sorted(labels)}")
+    positions = index['groups'].get(tuple(labels[c] for c in index['columns']))
+    if positions is None:
+        return df.iloc[:0]
+    return df.iloc[positions]
+
+def to_long_format(df):
+    '''
+    Reshape a wide frame with one column per technical replicate (Ct1, Ct2, ...)
+    into one row per well with Technical_replicate and Ct columns.
+    Non-numeric Cts such as 'Undetermined' become NaN. If df has an Outlier
+    mask column (flag_outliers) each well also gets a boolean Outlier column.
+    '''
+    reps = ct_columns(df.columns)
+    ids = [c for c in ID_COLUMNS if c in df.columns]
+    cts = df[reps].apply(pd.to_numeric, errors='coerce').to_numpy(dtype=float)
+
+    long_df = df[ids].iloc[np.repeat(np.arange(len(df)), len(reps))].reset_index(drop=True)
+    long_df['Technical_replicate'] = np.tile(np.arange(1, len(reps) + 1), len(df))
+    long_df['Ct'] = cts.ravel()
+    if 'Outlier mask' in df.columns:
+        bits = df['Outlier mask'].to_numpy(dtype=np.int64)[:, None] >> np.arange(len(reps))
+        long_df['Outlier'] = (bits & 1).astype(bool).ravel()
+    return long_df
+
+def aggregate_technical_replicates(long_df):
+    '''
+    Collapse a long frame from to_long_format to one row per sample with the
+    mean Ct (Ct_value), its SEM and the number of wells with a Ct (n_wells).
+    Wells marked in an Outlier column are left out.
+    '''
+    ids = [c for c in ID_COLUMNS if c in long_df.columns]
+    if 'Outlier' in long_df.columns:
+        long_df = long_df.assign(Ct=long_df['Ct'].mask(long_df['Outlier']))
+    grouped = long_df.groupby(ids, sort=False, observed=True, dropna=False)['Ct']
+    return grouped.agg(Ct_value='mean', SEM='sem', n_wells='count').reset_index()
+
+def import_long_data(file_path):
+    '''
+    Import a wide csv (same headings as import_and_tidy_data) as one row per well
+    '''
+    return to_long_format(pd.read_csv(file_path, na_values=NA_CT_VALUES))
+
 def primer_effiency_calc(slope):
     '''
     Equation for primer effieciency 
@@ -44,11 +358,12 @@ def primer_efficiency(df, gene):
     linear regression to calculate the slope, and doing the primer effeciency 
     calculation on the data
     """
-    #Convert dilution series to log10
-    df['log_dilution'] = np.log10(df['Dilution'])
+    from scipy import stats
+    #Convert dilution series to log10 (kept local, the input dataframe is not modified)
+    log_dilution = np.log10(df['Dilution'])
     
     #Use Scipy to calculate linear regression of dilution series
-    slope, intercept, r_value, p_value, std_err = stats.linregress(df['log_dilution'], df['Ct_value'])
+    slope, intercept, r_value, p_value, std_err = stats.linregress(log_dilution, df['Ct_value'])
 
     #Convert data to a pandas dataframe
     primer_efficiency_df = pd.DataFrame({
@@ -63,6 +378,111 @@ def primer_efficiency(df, gene):
     
     return primer_efficiency_df
 
+def _standard_curves(df, value_column='Ct_value', quantity_column='Dilution'):
+    '''
+    Per-gene log10(quantity) vs Ct least-squares fits from grouped centred sums.
+    Besides the regression outputs it keeps n, the x/y means, Sxx and the
+    residual standard deviation needed to invert the curves with intervals.
+    '''
+    # scipy.special loads much faster than scipy.stats and has the t distribution
+    from scipy import special
+    data = pd.DataFrame({
+        'Gene': df['Gene'].to_numpy(),
+        'x': np.log10(df[quantity_column].to_numpy(dtype=float)),
+        'y': df[value_column].to_numpy(dtype=float),
+    }).dropna()
+    grouped = data.groupby('Gene', sort=False, observed=True)
+
+    # Centre on the per-gene means so the sums of squares stay well conditioned
+    n = grouped['x'].count()
+    x_mean = grouped['x'].mean()
+    y_mean = grouped['y'].mean()
+    data['dx'] = data['x'] - data['Gene'].map(x_mean).astype(float)
+    data['dy'] = data['y'] - data['Gene'].map(y_mean).astype(float)
+    data['dxdx'] = data['dx'] ** 2
+    data['dydy'] = data['dy'] ** 2
+    data['dxdy'] = data['dx'] * data['dy']
+    sums = data.groupby('Gene', sort=False, observed=True)[['dxdx', 'dydy', 'dxdy']].sum()
+    ssxm, ssym, ssxym = (sums[c].to_numpy() for c in ('dxdx', 'dydy', 'dxdy'))
+    n = n.to_numpy()
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        slope = ssxym / ssxm
+        intercept = y_mean.to_numpy() - slope * x_mean.to_numpy()
+        r_value = np.clip(ssxym / np.sqrt(ssxm * ssym), -1.0, 1.0)
+        dof = n - 2
+        t_stat = r_value * np.sqrt(dof / ((1.0 - r_value) * (1.0 + r_value)))
+        p_value = 2 * special.stdtr(dof, -np.abs(t_stat))
+        std_err = np.sqrt((1 - r_value**2) * ssym / ssxm / dof)
+        residual_sd = np.sqrt((ssym - slope * ssxym) / dof)
+
+    return pd.DataFrame({
+        'Gene': sums.index.to_numpy(),
+        'Slope': slope,
+        'Intercept': intercept,
+        'Error': std_err,
+        'R': r_value,
+        'p_value': p_value,
+        'Primer Efficiency': np.round((10**(-1/slope) - 1) * 100, 2),
+        'n': n,
+        'x_mean': x_mean.to_numpy(),
+        'y_mean': y_mean.to_numpy(),
+        'Sxx': ssxm,
+        'Residual SD': residual_sd,
+    })
+
+def primer_efficiency_batch(df, value_column='Ct_value'):
+    """
+    Input dataframe from import and tidy data holding dilution series for any
+    number of genes
+
+    Fits the log10(dilution) vs Ct regression for every gene at once from
+    grouped sums rather than one linregress call per gene, and returns the
+    same columns as primer_efficiency with one row per gene. The input
+    dataframe is not modified.
+    """
+    curves = _standard_curves(df, value_column)
+    return curves[['Gene', 'Slope', 'Intercept', 'Error', 'R', 'p_value', 'Primer Efficiency']]
+
+def absolute_quantification(standards, unknowns, quantity_column='Dilution', confidence=0.95, replicates=None):
+    """
+    Input standards (tidy frame with Gene, a known quantity column and Ct_value)
+    and unknowns (tidy frame with Gene and Ct_value)
+
+    Fits a standard curve per gene and inverts it for every unknown row at once,
+    returning the unknowns with log10 Quantity, Quantity and the prediction
+    interval (PI low, PI high) at the given confidence. Quantities are in the
+    units of the standards' quantity_column (e.g. copies). replicates is the
+    number of wells averaged into each unknown Ct (defaults to the unknowns'
+    n_wells column, or 1).
+    """
+    from scipy import stats
+    curves = _standard_curves(standards, quantity_column=quantity_column).set_index('Gene')
+    missing = sorted(set(pd.unique(unknowns['Gene'])) - set(curves.index))
+    if missing:
+        raise ValueError(f"No standard curve for: {', '.join(map(str, missing))}")
+
+    # Line every unknown up with its gene's curve
+    curve = curves.reindex(unknowns['Gene'].to_numpy())
+    ct = unknowns['Ct_value'].to_numpy(dtype=float)
+    slope = curve['Slope'].to_numpy()
+    if replicates is None:
+        replicates = unknowns['n_wells'].to_numpy(dtype=float) if 'n_wells' in unknowns.columns else 1
+
+    log_quantity = (ct - curve['Intercept'].to_numpy()) / slope
+    # Standard error of an x value predicted from a measured y (inverse regression)
+    se = curve['Residual SD'].to_numpy() / np.abs(slope) * np.sqrt(
+        1 / replicates + 1 / curve['n'].to_numpy()
+        + (ct - curve['y_mean'].to_numpy()) ** 2 / (slope ** 2 * curve['Sxx'].to_numpy()))
+    half_width = stats.t.ppf(0.5 + confidence / 2, curve['n'].to_numpy() - 2) * se
+
+    quantified = unknowns.copy()
+    quantified['log10 Quantity'] = log_quantity
+    quantified['Quantity'] = 10 ** log_quantity
+    quantified['PI low'] = 10 ** (log_quantity - half_width)
+    quantified['PI high'] = 10 ** (log_quantity + half_width)
+    return quantified
+
 def delta_Ct(GOI, control_gene):
     '''
     Goal: 
@@ -111,20 +531,27 @@ def pfaffl(GOI, control_gene, experimental_condition, control_condition, E_GOI,
 
     
     '''
-    #Get control averages 
-    average_GOI = df[(df['Condition'] == control_condition) & (df['Gene'] == control_gene)]['Ct_value'].mean()
-    average_control = df[(df['Condition'] == control_condition) & (df['Gene'] == GOI)]['Ct_value'].mean()
+    from scipy import stats
+    # Efficiencies passed as None come from the primer efficiency registry
+    if E_GOI is None or E_control is None:
+        registered = _efficiency_lookup({}, [GOI, control_gene])
+        missing = [g for g, e in ((GOI, E_GOI), (control_gene, E_control)) if e is None and g not in registered.index]
+        if missing:
+            raise ValueError(f"No primer efficiency given or registered for: {', '.join(map(str, missing))}")
+        E_GOI = registered[GOI] if E_GOI is None else E_GOI
+        E_control = registered[control_gene] if E_control is None else E_control
 
-    # Create a new columns 
-    df['DeltaCt'] = None  # Initialize DeltaCt column with None values
+    #Get control averages 
+    average_GOI = select_rows(df, Gene=control_gene, Condition=control_condition)['Ct_value'].mean()
+    average_control = select_rows(df, Gene=GOI, Condition=control_condition)['Ct_value'].mean()
 
-    df.loc[df['Gene'] == control_gene, 'DeltaCt'] = df['Ct_value'] - average_control
-    df.loc[df['Gene'] == GOI, 'DeltaCt'] = df['Ct_value'] - average_GOI
-    df = df[['Gene', 'Condition', 'DeltaCt','Replicate']]
-    df_goi = df[df['Gene'] == GOI]  # DataFrame containing rows where 'Gene' is 'GOI'
-    df_control = df[df['Gene'] == control_gene]  # DataFrame containing rows where 'Gene' is 'Control'
-    df_goi.reset_index(drop=True, inplace=True)
-    df_control.reset_index(drop=True, inplace=True)
+    # DeltaCt of each gene's rows (the input dataframe is not modified)
+    df_goi = select_rows(df, Gene=GOI)  # DataFrame containing rows where 'Gene' is 'GOI'
+    df_control = select_rows(df, Gene=control_gene)  # DataFrame containing rows where 'Gene' is 'Control'
+    df_goi = df_goi[['Gene', 'Condition', 'Replicate']].assign(DeltaCt=df_goi['Ct_value'] - average_GOI)
+    df_control = df_control[['Gene', 'Condition', 'Replicate']].assign(DeltaCt=df_control['Ct_value'] - average_control)
+    df_goi = df_goi.reset_index(drop=True)
+    df_control = df_control.reset_index(drop=True)
 
     GER1 = []
     GER2 = []
@@ -158,6 +585,134 @@ def pfaffl(GOI, control_gene, experimental_condition, control_condition, E_GOI,
     return pfaffl_df
 
 
+def _efficiency_lookup(efficiencies, genes=None, lot=None):
+    '''
+    Normalise a gene -> primer efficiency table into a pandas Series indexed by gene.
+
+    Accepts a dict, a Series indexed by gene or a dataframe with 'Gene' and
+    'Primer Efficiency' columns (the output of primer_efficiency), or None.
+    Efficiencies are percentages, as returned by primer_effiency_calc.
+
+    Genes listed in genes but missing from efficiencies are resolved from the
+    primer efficiency registry (Efficiencies.lookup, fits of primer lot lot)
+    when it has them.
+    '''
+    if efficiencies is None:
+        efficiencies = {}
+    if isinstance(efficiencies, pd.DataFrame):
+        efficiencies = efficiencies.set_index('Gene')['Primer Efficiency']
+    efficiency = pd.Series(efficiencies, dtype=float)
+    missing = [g for g in genes or [] if g not in efficiency.index]
+    if missing:
+        from qPCR_analysis import Efficiencies
+        registered = Efficiencies.lookup(missing, lot=lot)
+        if registered:
+            efficiency = pd.concat([efficiency, pd.Series(registered, dtype=float)])
+    return efficiency
+
+def _log_relative_expression(df, efficiencies, genes, control_condition, lot=None):
+    '''
+    Pivot Ct_value to one sample (Condition, Replicate) per row and one gene per
+    column, and return it with DeltaCt (calibrator mean - sample) and the natural
+    log of the efficiency-weighted relative expression E**DeltaCt
+    '''
+    efficiency = _efficiency_lookup(efficiencies, genes, lot)
+    missing = [g for g in genes if g not in efficiency.index]
+    if missing:
+        raise ValueError(f"No primer efficiency given for: {', '.join(map(str, missing))}")
+
+    ct = df.pivot_table(index=['Condition', 'Replicate'], columns='Gene',
+                        values='Ct_value', aggfunc='mean', observed=True)
+    absent = [g for g in genes if g not in ct.columns]
+    if absent:
+        raise ValueError(f"Genes not found in data: {', '.join(map(str, absent))}")
+    if control_condition not in ct.index.get_level_values('Condition'):
+        raise ValueError(f"Control condition {control_condition!r} not found in data")
+
+    # Delta Ct against each gene's calibrator mean, then E**DeltaCt for every cell
+    calibrator = ct.xs(control_condition, level='Condition').mean()
+    delta = delta_Ct(calibrator, ct)
+    amplification = (efficiency.reindex(ct.columns) / 100 + 1).to_numpy()
+    return ct, delta, delta.to_numpy() * np.log(amplification)
+
+def normalization_factors(df, efficiencies, reference_genes, control_condition, lot=None):
+    '''
+    Goal: per-sample normalisation factor from one or more reference genes
+
+    Input: as pfaffl_batch
+
+    Output: dataframe with Condition, Replicate and Normalization Factor, the
+    geometric mean of the reference genes' efficiency-weighted relative expression
+    '''
+    if isinstance(reference_genes, str):
+        reference_genes = [reference_genes]
+    reference_genes = list(reference_genes)
+    ct, _, log_expression = _log_relative_expression(df, efficiencies, reference_genes, control_condition, lot)
+    log_reference = log_expression[:, ct.columns.get_indexer(reference_genes)].mean(axis=1)
+    factors = ct.index.to_frame(index=False)
+    factors['Normalization Factor'] = np.exp(log_reference)
+    return factors
+
+def pfaffl_batch(df, efficiencies, reference_genes, control_condition, genes=None, lot=None):
+    '''
+    Goal: compute Pfaffl gene expression ratios for every gene, condition and
+    biological replicate in a single pass
+
+    Input:
+    df - dataframe from import_and_tidy_data with Gene, Condition, Replicate and Ct_value
+    efficiencies - gene -> primer efficiency (%) as a dict, Series or primer_efficiency
+        dataframe. Genes left out (or all of them, with None) are taken from
+        the primer efficiency registry, see Efficiencies.fit
+    reference_genes - a reference gene name or a list of them. With several
+        reference genes the sample is normalised to the geometric mean of their
+        efficiency-weighted expression
+    control_condition - condition whose mean Ct is the calibrator for each gene
+    genes - optional list of genes of interest, defaults to every non-reference gene
+    lot - primer lot of the registry fits to use, None for the latest fit of any lot
+
+    Output: long-form dataframe with one row per Gene, Condition and Replicate
+    holding DeltaCt (calibrator mean - sample Ct) and the Gene Expression Ratio
+    '''
+    if isinstance(reference_genes, str):
+        reference_genes = [reference_genes]
+    reference_genes = list(reference_genes)
+    if genes is None:
+        genes = [g for g in pd.unique(df['Gene']) if g not in reference_genes]
+    genes = list(genes)
+
+    ct, delta, log_expression = _log_relative_expression(df, efficiencies, genes + reference_genes,
+                                                         control_condition, lot)
+
+    # Geometric mean of the reference genes is the arithmetic mean of the logs
+    ref_idx = ct.columns.get_indexer(reference_genes)
+    goi_idx = ct.columns.get_indexer(genes)
+    log_reference = log_expression[:, ref_idx].mean(axis=1)
+    ratio = np.exp(log_expression[:, goi_idx] - log_reference[:, None])
+
+    n_samples, n_genes = ratio.shape
+    pfaffl_df = pd.DataFrame({
+        'Gene': np.tile(np.asarray(genes, dtype=object), n_samples),
+        'Condition': np.repeat(ct.index.get_level_values('Condition').to_numpy(), n_genes),
+        'Replicate': np.repeat(ct.index.get_level_values('Replicate').to_numpy(), n_genes),
+        'DeltaCt': delta.to_numpy()[:, goi_idx].ravel(),
+        'Gene Expression Ratio': ratio.ravel(),
+    })
+    pfaffl_df = pfaffl_df.dropna(subset=['Gene Expression Ratio'])
+    return pfaffl_df.sort_values(['Gene', 'Condition', 'Replicate'], kind='stable').reset_index(drop=True)
+
+def summarize_pfaffl(pfaffl_df):
+    '''
+    Goal: collapse pfaffl_batch output to one row per Gene and Condition
+
+    Input: long-form dataframe from pfaffl_batch
+
+    Output: dataframe with Gene, Condition, n, Average GER and SEM GER
+    '''
+    grouped = pfaffl_df.groupby(['Gene', 'Condition'], sort=False, observed=True)['Gene Expression Ratio']
+    summary = grouped.agg(['count', 'mean', 'sem']).reset_index()
+    return summary.rename(columns={'count': 'n', 'mean': 'Average GER', 'sem': 'SEM GER'})
+
+
 #polysome_test = import_and_tidy_data('data/polysome_profile_testdata.csv')
 #print(polysome_test)
 
@@ -170,43 +725,115 @@ def calculate_2_delta_ct_polysome(delta_ct):
 def calculate_percentages(total, column):
     return (column * 100) / total if total != 0 else 0
 
-def polysome_profiling_analysis(df, gene, condition, reps):
-    
-    subset_df = df[(df['Condition'] == condition) & (df['Gene'] == gene)].copy()
-
-    # Calculate the baseline CT values for Fraction 1 to be used as reference
-    baseline_cts = subset_df.loc[subset_df['Fraction'] == 1, ['Ct1', 'Ct2', 'Ct3']].mean()
-
-    # Calculate delta Ct, 2^-deltaCT, and percentages for each Ct replicate
-    for r in range(1, reps+1):
-        replicate = f'Ct{r}'
-        delta_ct_col = f'deltaCtR{r}'
-        two_delta_ct_col = f'2DeltaCtR{r}'
-        percent_col = f'Percent in fraction R{r}'
-        
-        # Calculate delta Ct
-        delta_ct = calculate_polysome_diff(baseline_cts[replicate], subset_df[replicate])
-        subset_df.loc[:, delta_ct_col] = delta_ct
-        
-        # Calculate 2^-deltaCT
-        subset_df.loc[:, two_delta_ct_col] = calculate_2_delta_ct_polysome(delta_ct)
-        
-        # Calculate the percentage for each replicate
-        sum_2_delta_ct = subset_df[two_delta_ct_col].sum()
-        subset_df.loc[:, percent_col] = calculate_percentages(sum_2_delta_ct, subset_df[two_delta_ct_col])
-        #print(subset_df[two_delta_ct_col])
-    
-    
-    
-    subset_df = subset_df[subset_df.columns[subset_df.columns.str.contains('percent', case=False) | (subset_df.columns == 'fraction')]]
-    row_averages = subset_df.mean(axis=1)
-    row_sem = subset_df.sem(axis=1)
-
-    subset_df['Average Percent in Fraction'] = row_averages
-    subset_df['SEM Percent in Fraction'] = row_sem
+def polysome_profiling_analysis(df, gene, condition, reps=None, index=None):
+    '''
+    Percent of a gene's mRNA in each polysome fraction for one condition.
+
+    reps is the number of replicate Ct columns to use (Ct1 ... Ct{reps}); by
+    default every Ct column in df is used. Missing Cts (NaN) are left out of
+    the fraction 1 baseline and of each replicate's total, and so are wells
+    masked in an Outlier mask column (flag_outliers); a replicate without a
+    fraction 1 Ct gets NaN percentages. index is an optional
+    group_index(df, ('Gene', 'Condition')) shared by calls for many genes.
+    '''
+    subset_df = select_rows(df, index, Gene=gene, Condition=condition)
+    replicates = ct_columns(subset_df.columns)
+    if reps is not None:
+        replicates = replicates[:reps]
+    cts = subset_df[replicates].to_numpy(dtype=float)
+    if 'Outlier mask' in subset_df.columns:
+        # Bit i of the mask is the i-th Ct column, as written by flag_outliers
+        bits = subset_df['Outlier mask'].to_numpy(dtype=np.int64)[:, None] >> np.arange(len(replicates))
+        cts = np.where(bits & 1, np.nan, cts)
+
+    with warnings.catch_warnings():
+        # Replicates without a fraction 1 Ct (missing or an outlier) get NaN percentages
+        warnings.simplefilter('ignore', RuntimeWarning)
+        # Calculate the baseline CT values for Fraction 1 to be used as reference
+        baseline_cts = np.nanmean(cts[subset_df['Fraction'].to_numpy() == 1], axis=0)
+
+        # Delta Ct, 2^deltaCT and percentages for every replicate column at once
+        two_delta_ct = calculate_2_delta_ct_polysome(calculate_polysome_diff(baseline_cts, cts))
+        total = np.nansum(two_delta_ct, axis=0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            percent = np.where(total > 0, two_delta_ct * 100 / total, np.nan)
+        average = np.nanmean(percent, axis=1)
+
+    percent_df = pd.DataFrame(percent, columns=[f'Percent in fraction R{c[2:]}' for c in replicates])
+    percent_df.insert(0, 'Fraction', subset_df['Fraction'].to_numpy())
+    percent_df['Average Percent in Fraction'] = average
+    percent_df['SEM Percent in Fraction'] = percent_df.iloc[:, 1:1 + len(replicates)].sem(axis=1)
+
+    return percent_df
+
+def polysome_profiling_batch(df, baseline_fraction=1):
+    '''
+    Goal: percent of mRNA in each polysome fraction for every gene, condition
+    and replicate at once
+
+    Input:
+    df - polysome dataframe (Gene, Fraction, Condition, Ct1, Ct2, ...) from
+        import_and_tidy_data, or a long frame from to_long_format
+    baseline_fraction - fraction whose Ct is the delta Ct reference
+
+    Output: tidy dataframe with one row per Gene, Condition, Replicate and
+    Fraction holding DeltaCt, 2DeltaCt and Percent in fraction. Replicate
+    is the Ct column number, as in polysome_profiling_analysis. Outlier
+    wells (flag_outliers) are left out like missing Cts. A replicate without
+    a baseline Ct gets NaN percentages, which summarize_polysome skips.
+    '''
+    long_df = df if 'Ct' in df.columns else to_long_format(df)
+    long_df = long_df.dropna(subset=['Ct'])
+    if 'Outlier' in long_df.columns:
+        long_df = long_df[~long_df['Outlier'].astype(bool)]
+
+    # Integer codes for the three axes of a (gene/condition, fraction, replicate) cube
+    sample_codes, samples = pd.MultiIndex.from_frame(long_df[['Gene', 'Condition']]).factorize(sort=True)
+    fraction_codes, fractions = pd.factorize(long_df['Fraction'], sort=True)
+    replicate_codes, replicates = pd.factorize(long_df['Technical_replicate'], sort=True)
+    shape = (len(samples), len(fractions), len(replicates))
+
+    # Mean Ct per cell, so repeated wells of a fraction are averaged
+    ct_sum = np.zeros(shape)
+    ct_count = np.zeros(shape)
+    np.add.at(ct_sum, (sample_codes, fraction_codes, replicate_codes), long_df['Ct'].to_numpy(dtype=float))
+    np.add.at(ct_count, (sample_codes, fraction_codes, replicate_codes), 1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cts = ct_sum / ct_count
+
+    baseline = np.full((shape[0], 1, shape[2]), np.nan)
+    if baseline_fraction in fractions:
+        baseline[:, 0, :] = cts[:, fractions.get_loc(baseline_fraction), :]
+    delta_ct = calculate_polysome_diff(baseline, cts)
+    two_delta_ct = calculate_2_delta_ct_polysome(delta_ct)
+    # No baseline Ct (missing or an outlier) leaves nothing to sum: NaN, not 0%
+    total = np.nansum(two_delta_ct, axis=1, keepdims=True)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        percent = np.where(total > 0, two_delta_ct * 100 / total, np.nan)
+
+    sample_idx, fraction_idx, replicate_idx = np.nonzero(ct_count)
+    polysome_df = pd.DataFrame({
+        'Gene': samples.get_level_values(0)[sample_idx],
+        'Condition': samples.get_level_values(1)[sample_idx],
+        'Replicate': replicates[replicate_idx],
+        'Fraction': fractions[fraction_idx],
+        'DeltaCt': delta_ct[sample_idx, fraction_idx, replicate_idx],
+        '2DeltaCt': two_delta_ct[sample_idx, fraction_idx, replicate_idx],
+        'Percent in fraction': percent[sample_idx, fraction_idx, replicate_idx],
+    })
+    return polysome_df.sort_values(['Gene', 'Condition', 'Replicate', 'Fraction'], kind='stable').reset_index(drop=True)
+
+def summarize_polysome(polysome_df):
+    '''
+    Goal: average polysome_profiling_batch output over replicates
 
-    # Return the modified dataframe
-    return subset_df.reset_index(drop=True)
+    Input: tidy dataframe from polysome_profiling_batch
 
+    Output: dataframe with Gene, Condition, Fraction, Average Percent in Fraction
+    and SEM Percent in Fraction
+    '''
+    grouped = polysome_df.groupby(['Gene', 'Condition', 'Fraction'], observed=True)['Percent in fraction']
+    summary = grouped.agg(['mean', 'sem']).reset_index()
+    return summary.rename(columns={'mean': 'Average Percent in Fraction', 'sem': 'SEM Percent in Fraction'})
 
 #polysome_profiling_analysis(polysome_test, 'GOI','Untreated', 3) 
@@ -0,0 +1,154 @@
+# +
+import hashlib
+import json
+import os
+import time
+from collections import OrderedDict
+
+import pandas as pd
+
+from qPCR_analysis import Cache, Data_processing
+
+# Bump when primer_efficiency_batch output changes so stored fits are refitted
+FIT_VERSION = '1'
+
+# Fits kept in memory per process, least recently used dropped first
+MAX_MEMORY_ENTRIES = 256
+
+_memory = OrderedDict()
+_entries = {}
+
+def default_registry_dir():
+    '''
+    Registry directory used when none is given: $QPCR_EFFICIENCY_DIR or an
+    efficiencies folder in the tidy-data cache directory
+    '''
+    return os.environ.get('QPCR_EFFICIENCY_DIR', os.path.join(Cache.default_cache_dir(), 'efficiencies'))
+
+def data_hash(source):
+    '''
+    SHA-256 of a dilution series: of the file's contents, or of the Gene,
+    Dilution and Ct columns of a dataframe
+    '''
+    if not isinstance(source, pd.DataFrame):
+        return Cache.file_hash(source)
+    columns = [c for c in ['Gene', 'Dilution', 'Ct_value'] + Data_processing.ct_columns(source.columns)
+               if c in source.columns]
+    digest = hashlib.sha256(','.join(columns).encode())
+    digest.update(pd.util.hash_pandas_object(source[columns].astype(object), index=False).to_numpy().tobytes())
+    return digest.hexdigest()
+
+def entry_key(dilution_hash, lot=None, qc=None):
+    '''
+    Registry key of one fit: dilution data hash, primer lot, outlier rule and FIT_VERSION
+    '''
+    return hashlib.sha256(f'{dilution_hash}:{lot}:{qc}:{FIT_VERSION}'.encode()).hexdigest()[:32]
+
+def _remember(key, entry):
+    _memory[key] = entry
+    _memory.move_to_end(key)
+    while len(_memory) > MAX_MEMORY_ENTRIES:
+        _memory.popitem(last=False)
+
+def _write_entry(entry, path):
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as handle:
+        json.dump(entry, handle)
+    os.replace(tmp_path, path)
+
+def fit(source, lot=None, qc=None, registry_dir=None):
+    '''
+    Goal: primer efficiencies of a dilution series, fitted at most once per
+    distinct dilution data, primer lot and outlier rule
+
+    Input:
+    source - dilution csv path or a tidy dilution dataframe
+    lot - primer lot the dilution series was run with, None if untracked
+    qc - outlier rule applied before fitting (see Data_processing.flag_outliers)
+    registry_dir - defaults to default_registry_dir()
+
+    Output: primer_efficiency_batch dataframe. It comes from the in-process
+    LRU, then from the registry directory, and only then from a new fit,
+    which is stored in both and is what lookup() returns for its genes.
+    '''
+    registry_dir = registry_dir or default_registry_dir()
+    dilution_hash = data_hash(source)
+    key = entry_key(dilution_hash, lot, qc)
+    path = os.path.join(registry_dir, f'{key}.json')
+    entry = _memory.get((registry_dir, key))
+    if entry is None and os.path.exists(path):
+        with open(path) as handle:
+            entry = json.load(handle)
+    if entry is None:
+        if isinstance(source, pd.DataFrame):
+            df = Data_processing.flag_outliers(source, method=qc) if qc is not None else source
+        else:
+            df = Data_processing.import_and_tidy_data(source, qc=qc)
+        table = Data_processing.primer_efficiency_batch(df)
+        entry = {'hash': dilution_hash, 'lot': lot, 'qc': qc, 'fitted': time.time(),
+                 'source': None if isinstance(source, pd.DataFrame) else os.path.abspath(source),
+                 'table': json.loads(table.to_json(orient='records'))}
+        os.makedirs(registry_dir, exist_ok=True)
+        _write_entry(entry, path)
+        _entries.pop(registry_dir, None)
+    _remember((registry_dir, key), entry)
+    return pd.DataFrame(entry['table'])
+
+def _load_entries(registry_dir):
+    '''
+    Every stored fit of a registry directory, re-read only when the directory changes
+    '''
+    try:
+        stamp = os.stat(registry_dir).st_mtime_ns
+    except FileNotFoundError:
+        return []
+    cached = _entries.get(registry_dir)
+    if cached is not None and cached[0] == stamp:
+        return cached[1]
+    entries = []
+    for name in os.listdir(registry_dir):
+        if name.endswith('.json'):
+            with open(os.path.join(registry_dir, name)) as handle:
+                entries.append(json.load(handle))
+    entries.sort(key=lambda entry: entry['fitted'])
+    _entries[registry_dir] = (stamp, entries)
+    return entries
+
+def registered(registry_dir=None):
+    '''
+    One row per gene and stored fit: Gene, Lot, QC, Hash, Source, Fitted and
+    the primer_efficiency_batch columns, oldest fit first
+    '''
+    rows = [dict(row, Lot=entry['lot'], QC=entry['qc'], Hash=entry['hash'], Source=entry['source'],
+                 Fitted=entry['fitted'])
+            for entry in _load_entries(registry_dir or default_registry_dir()) for row in entry['table']]
+    return pd.DataFrame(rows)
+
+def lookup(genes=None, lot=None, registry_dir=None):
+    '''
+    Goal: gene -> primer efficiency (%) from the registry
+
+    Input:
+    genes - genes to resolve, None for every registered gene
+    lot - only use fits of this primer lot, None for any lot
+    registry_dir - defaults to default_registry_dir()
+
+    Output: dict holding the most recently fitted efficiency of each gene
+    found; genes without a fit are left out
+    '''
+    wanted = None if genes is None else set(genes)
+    efficiencies = {}
+    for entry in _load_entries(registry_dir or default_registry_dir()):
+        if lot is not None and entry['lot'] != lot:
+            continue
+        for row in entry['table']:
+            if wanted is None or row['Gene'] in wanted:
+                efficiencies[row['Gene']] = row['Primer Efficiency']
+    return efficiencies
+
+def clear_memory():
+    '''
+    Forget the in-process fits and directory listings (the stored fits are kept)
+    '''
+    _memory.clear()
+    _entries.clear()
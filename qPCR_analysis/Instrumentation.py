@@ -0,0 +1,220 @@
+# +
+import cProfile
+import functools
+import importlib
+import inspect
+import io
+import json
+import pstats
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+import pandas as pd
+
+# Modules whose public functions are wrapped by enable() unless told otherwise
+DEFAULT_MODULES = ('Data_processing', 'Plotting')
+
+COLUMNS = ['Stage', 'Start', 'Seconds', 'Rows in', 'Rows out', 'Memory delta MB', 'Peak MB', 'Depth', 'Error']
+
+_records = []
+_profiles = {}
+_originals = {}
+_settings = {}
+_local = threading.local()
+_lock = threading.Lock()
+
+def _rows(value):
+    '''
+    Row count of a dataframe, series or array, None for anything else
+    '''
+    if hasattr(value, 'shape') and getattr(value, 'ndim', 0) > 0:
+        return len(value)
+    return None
+
+def _first_rows(args, kwargs):
+    for value in list(args) + list(kwargs.values()):
+        rows = _rows(value)
+        if rows is not None:
+            return rows
+    return None
+
+def _wrap(stage, function):
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        stack = _local.__dict__.setdefault('peaks', [])
+        depth = len(stack)
+        memory = _settings.get('memory') and tracemalloc.is_tracing()
+        profiler = cProfile.Profile() if _settings.get('profile') and depth == 0 else None
+        if memory:
+            current, peak = tracemalloc.get_traced_memory()
+            if stack:
+                # Keep the caller's peak so far before resetting it for this call
+                stack[-1] = max(stack[-1], peak)
+            tracemalloc.reset_peak()
+        stack.append(0)
+        error = None
+        start, wall = time.perf_counter(), time.time()
+        if profiler:
+            profiler.enable()
+        try:
+            result = function(*args, **kwargs)
+        except BaseException as exc:
+            error, result = type(exc).__name__, None
+            raise
+        finally:
+            if profiler:
+                profiler.disable()
+            seconds = time.perf_counter() - start
+            own_peak = stack.pop()
+            delta = peak_mb = None
+            if memory:
+                after, peak = tracemalloc.get_traced_memory()
+                peak = max(peak, own_peak)
+                if stack:
+                    stack[-1] = max(stack[-1], peak)
+                delta, peak_mb = (after - current) / 2 ** 20, (peak - current) / 2 ** 20
+            record = {'Stage': stage, 'Start': wall, 'Seconds': seconds, 'Rows in': _first_rows(args, kwargs),
+                      'Rows out': _rows(result), 'Memory delta MB': delta, 'Peak MB': peak_mb,
+                      'Depth': depth, 'Error': error}
+            with _lock:
+                _records.append(record)
+                if profiler:
+                    if stage in _profiles:
+                        _profiles[stage].add(profiler)
+                    else:
+                        _profiles[stage] = pstats.Stats(profiler)
+        return result
+    return wrapper
+
+def _public_functions(module):
+    return [name for name, value in vars(module).items()
+            if inspect.isfunction(value) and value.__module__ == module.__name__ and not name.startswith('_')]
+
+def enable(memory=True, profile=False, modules=DEFAULT_MODULES):
+    '''
+    Goal: start recording every call to the public functions of modules
+
+    Input:
+    memory - also record the traced memory delta and peak of each call
+        (starts tracemalloc, which slows allocation-heavy code)
+    profile - capture a cProfile of each outermost call, see profile_report
+    modules - qPCR_analysis module names to instrument
+
+    The functions are replaced by timing wrappers in their modules and put
+    back by disable(), so nothing is added to a call while disabled. Callers
+    that imported a function directly (from ... import name) before enable()
+    keep the unwrapped one.
+    '''
+    disable()
+    _settings.update(memory=memory, profile=profile, modules=tuple(modules),
+                     started_tracing=memory and not tracemalloc.is_tracing())
+    if _settings['started_tracing']:
+        tracemalloc.start()
+    for name in modules:
+        module = importlib.import_module(f'qPCR_analysis.{name}')
+        for function in _public_functions(module):
+            original = getattr(module, function)
+            _originals[(module, function)] = original
+            setattr(module, function, _wrap(f'{name}.{function}', original))
+
+def disable():
+    '''
+    Restore the original functions; recorded calls are kept until reset()
+    '''
+    for (module, function), original in _originals.items():
+        setattr(module, function, original)
+    _originals.clear()
+    if _settings.get('started_tracing'):
+        tracemalloc.stop()
+    _settings.clear()
+
+def is_enabled():
+    return bool(_originals)
+
+def settings():
+    '''
+    Keyword arguments that re-create the current enable() call, None when disabled
+    '''
+    if not is_enabled():
+        return None
+    return {key: _settings[key] for key in ('memory', 'profile', 'modules')}
+
+@contextmanager
+def instrumented(**options):
+    '''
+    Enable instrumentation for the duration of a with block (options as enable)
+    '''
+    enable(**options)
+    try:
+        yield
+    finally:
+        disable()
+
+def reset():
+    '''
+    Drop all recorded calls and profiles
+    '''
+    with _lock:
+        _records.clear()
+        _profiles.clear()
+
+def take_records():
+    '''
+    Remove and return the recorded calls as a list of dicts (used to ship
+    records from worker processes back to the parent)
+    '''
+    with _lock:
+        taken = list(_records)
+        _records.clear()
+    return taken
+
+def add_records(records):
+    with _lock:
+        _records.extend(records)
+
+def records():
+    '''
+    Dataframe with one row per instrumented call, in the order calls finished
+    '''
+    with _lock:
+        return pd.DataFrame(list(_records), columns=COLUMNS)
+
+def summary():
+    '''
+    Calls, total and mean seconds, rows and largest peak memory per stage,
+    slowest stage first. Nested calls are counted in their callers' time too.
+    '''
+    calls = records()
+    grouped = calls.groupby('Stage', sort=False)
+    table = grouped.agg(**{'Calls': ('Seconds', 'size'), 'Total seconds': ('Seconds', 'sum'),
+                           'Mean seconds': ('Seconds', 'mean'), 'Rows in': ('Rows in', 'sum'),
+                           'Peak MB': ('Peak MB', 'max'), 'Errors': ('Error', 'count')})
+    return table.sort_values('Total seconds', ascending=False).reset_index()
+
+def export(file_path):
+    '''
+    Write the recorded calls to a .json (list of records) or .csv file
+    '''
+    calls = records()
+    if str(file_path).endswith('.json'):
+        with open(file_path, 'w') as handle:
+            json.dump(json.loads(calls.to_json(orient='records')), handle, indent=1)
+    else:
+        calls.to_csv(file_path, index=False)
+
+def profile_report(stage=None, sort='cumulative', limit=20):
+    '''
+    Text report of the cProfile captures (enable(profile=True)) of one stage,
+    or of all stages combined
+    '''
+    with _lock:
+        captures = [_profiles[stage]] if stage is not None else list(_profiles.values())
+        if not captures:
+            return ''
+        stream = io.StringIO()
+        combined = pstats.Stats(stream=stream)
+        combined.add(*captures)
+    combined.sort_stats(sort).print_stats(limit)
+    return stream.getvalue()
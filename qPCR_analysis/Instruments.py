@@ -0,0 +1,347 @@
+# +
+import contextlib
+import io
+import os
+import zipfile
+from xml.etree import ElementTree
+
+import numpy as np
+import pandas as pd
+
+from qPCR_analysis import Data_processing
+
+# Default split of a sample name into condition and biological replicate,
+# e.g. 'Treated 2', 'Treated_2' or 'Treated-2'. Unmatched names become the
+# condition with replicate 1.
+SAMPLE_PATTERN = r'^(?P<Condition>.*?)[\s_-]*(?P<Replicate>\d+)$'
+
+# Vendor column names for each tidy column, first match wins
+# (QuantStudio / 7500 / CFX Maestro result tables)
+COLUMN_ALIASES = {
+    'Well': ['Well Position', 'Well'],
+    'Gene': ['Target Name', 'Target', 'Detector'],
+    'Sample': ['Sample Name', 'Sample'],
+    'Ct': ['CT', 'Ct', 'Cq', 'CRT', 'Cт'],
+    'Task': ['Task', 'Content'],
+    'Omit': ['Omit'],
+    'Quantity': ['Quantity', 'Starting Quantity (SQ)'],
+}
+
+RDML_EXTENSIONS = ('.rdml', '.rdm')
+EXCEL_EXTENSIONS = ('.xlsx', '.xls')
+EXPORT_EXTENSIONS = RDML_EXTENSIONS + EXCEL_EXTENSIONS + ('.txt', '.tsv')
+
+# Lines of a .csv searched for a vendor results header (CFX csv exports) before
+# it is taken for a plain Ct csv
+SNIFF_LINES = 100
+
+def _require_openpyxl():
+    try:
+        import openpyxl
+    except ImportError as err:
+        raise ImportError("Reading xlsx exports needs openpyxl: pip install 'qPCR_analysis[excel]'") from err
+    return openpyxl
+
+def _local(tag):
+    '''
+    Tag name without its XML namespace
+    '''
+    return tag.rpartition('}')[2]
+
+def _well_label(react_id, columns):
+    '''
+    RDML numbers reactions row by row from 1; convert to A1-style labels
+    '''
+    if not react_id.isdigit():
+        return react_id
+    row, column = divmod(int(react_id) - 1, columns)
+    return f'{chr(ord("A") + row)}{column + 1}'
+
+@contextlib.contextmanager
+def _rdml_stream(file_path):
+    '''
+    Open the XML inside an RDML file (a zip archive, or plain XML) without
+    extracting it; the archive is closed with the stream
+    '''
+    if not zipfile.is_zipfile(file_path):
+        with open(file_path, 'rb') as stream:
+            yield stream
+        return
+    with zipfile.ZipFile(file_path) as archive:
+        names = [n for n in archive.namelist() if n.endswith('.xml')]
+        member = 'rdml_data.xml' if 'rdml_data.xml' in names else names[0]
+        with archive.open(member) as stream:
+            yield stream
+
+def parse_rdml(file_path):
+    '''
+    Stream an RDML file into (wells, samples).
+
+    The XML is read with iterparse and every react and sample element is
+    cleared once read, so memory stays flat however large the run.
+    wells has Well, Sample, Gene, Ct and Excluded columns, one row per
+    react/target pair (multiplexed wells give several rows). samples has one
+    row per sample with its RDML type, quantity and annotations (e.g.
+    Condition, Replicate).
+    '''
+    wells = {'Well': [], 'Sample': [], 'Gene': [], 'Ct': [], 'Excluded': []}
+    samples = []
+    columns = 12
+    with _rdml_stream(file_path) as stream:
+        for _, element in ElementTree.iterparse(stream, events=('end',)):
+            tag = _local(element.tag)
+            if tag == 'columns' and element.text:
+                columns = int(element.text)
+            elif tag == 'react':
+                sample = next((c.get('id') for c in element if _local(c.tag) == 'sample'), None)
+                well = _well_label(element.get('id', ''), columns)
+                for data in (c for c in element if _local(c.tag) == 'data'):
+                    fields = {_local(c.tag): c for c in data}
+                    cq = fields.get('cq')
+                    wells['Well'].append(well)
+                    wells['Sample'].append(sample)
+                    wells['Gene'].append(fields['tar'].get('id') if 'tar' in fields else None)
+                    wells['Ct'].append(cq.text if cq is not None else None)
+                    wells['Excluded'].append('excl' in fields)
+                element.clear()
+            elif tag == 'sample' and len(element):
+                # A sample definition (references inside reacts have no children)
+                record = {'Sample': element.get('id')}
+                for child in element:
+                    name = _local(child.tag)
+                    if name == 'type':
+                        record['Type'] = child.text
+                    elif name == 'quantity':
+                        value = next((c.text for c in child if _local(c.tag) == 'value'), None)
+                        record['Quantity'] = float(value) if value is not None else np.nan
+                    elif name == 'annotation':
+                        values = {_local(c.tag): c.text for c in child}
+                        record[values.get('property')] = values.get('value')
+                samples.append(record)
+                element.clear()
+    wells = pd.DataFrame(wells)
+    wells['Ct'] = pd.to_numeric(wells['Ct'], errors='coerce')
+    # RDML uses -1 for 'no amplification'
+    wells['Ct'] = wells['Ct'].mask(wells['Ct'] < 0)
+    return wells, pd.DataFrame(samples) if samples else pd.DataFrame(columns=['Sample'])
+
+def _find_header(rows):
+    '''
+    Index of the first row that looks like a results table header, or None
+    '''
+    for i, row in enumerate(rows):
+        cells = {str(c).strip() for c in row}
+        if cells & set(COLUMN_ALIASES['Gene']) and cells & set(COLUMN_ALIASES['Ct']):
+            return i
+    return None
+
+def _read_text_results(file_path):
+    '''
+    Results table of a QuantStudio/7500 text export or a CFX csv export.
+
+    Header lines ('* Block Type = ...'), other sections ('[Amplification Data]')
+    and blank lines around the table are skipped while streaming the file, and
+    only the table's lines are handed to the csv parser.
+    '''
+    lines = []
+    with open(file_path, encoding='utf-8-sig', errors='replace') as handle:
+        for line in handle:
+            if not lines:
+                fields = line.rstrip('\r\n').split('\t' if '\t' in line else ',')
+                if _find_header([fields]) is None:
+                    continue
+                separator = '\t' if '\t' in line else ','
+            elif not line.strip() or line.startswith('['):
+                break
+            lines.append(line)
+    if not lines:
+        raise ValueError(f'No results table (target and Ct/Cq columns) found in {file_path}')
+    return pd.read_csv(io.StringIO(''.join(lines)), sep=separator, dtype=str, skipinitialspace=True)
+
+def _read_excel_results(file_path, sheet=None):
+    '''
+    Results table of an xlsx export (QuantStudio 'Results' sheet or a CFX workbook)
+    '''
+    _require_openpyxl()
+    with pd.ExcelFile(file_path) as workbook:
+        if sheet is None:
+            sheet = 'Results' if 'Results' in workbook.sheet_names else workbook.sheet_names[0]
+        raw = workbook.parse(sheet, header=None, dtype=str)
+    header = _find_header(raw.itertuples(index=False))
+    if header is None:
+        raise ValueError(f'No results table (target and Ct/Cq columns) found in sheet {sheet!r} of {file_path}')
+    table = raw.iloc[header + 1:]
+    table.columns = [str(c).strip() for c in raw.iloc[header]]
+    blank = table.isna().all(axis=1).to_numpy()
+    if blank.any():
+        table = table.iloc[:np.argmax(blank)]
+    return table.reset_index(drop=True)
+
+def _standard_columns(table):
+    '''
+    Rename vendor columns to Well, Gene, Sample, Ct, Task, Omit and Quantity
+    '''
+    table.columns = [str(c).strip() for c in table.columns]
+    renamed = {}
+    for name, aliases in COLUMN_ALIASES.items():
+        found = next((a for a in aliases if a in table.columns and a not in renamed), None)
+        if found is not None:
+            renamed[found] = name
+    wells = table[list(renamed)].rename(columns=renamed)
+    wells['Ct'] = pd.to_numeric(wells['Ct'], errors='coerce')
+    if 'Omit' in wells.columns:
+        wells['Excluded'] = wells.pop('Omit').astype(str).str.strip().str.lower() == 'true'
+    if 'Quantity' in wells.columns:
+        wells['Quantity'] = pd.to_numeric(wells['Quantity'], errors='coerce')
+    return wells
+
+def split_samples(samples, layout=None, pattern=SAMPLE_PATTERN):
+    '''
+    Goal: map sample names to Data_processing.ID_COLUMNS (e.g. Condition, Replicate)
+
+    Input:
+    samples - sample names, one per well
+    layout - plate layout: dataframe with a Sample column plus ID columns, used
+        instead of pattern for the samples it lists
+    pattern - regular expression with named groups for the ID columns
+
+    Output: dataframe with Sample and the ID columns, one row per well. Each
+    distinct sample name is parsed once.
+    '''
+    codes, names = pd.factorize(pd.Series(samples), use_na_sentinel=False)
+    names = pd.Series(names, dtype=object)
+    table = names.astype(str).str.extract(pattern)
+    if 'Condition' in table.columns:
+        unmatched = table.isna().all(axis=1)
+        table.loc[unmatched, 'Condition'] = names[unmatched]
+    if 'Replicate' in table.columns:
+        table['Replicate'] = pd.to_numeric(table['Replicate'], errors='coerce').fillna(1).astype(int)
+    table.insert(0, 'Sample', names)
+    if layout is not None and len(layout):
+        listed = table['Sample'].isin(layout['Sample'])
+        known = table[listed][['Sample']].merge(layout, on='Sample', how='left')
+        table = pd.concat([table[~listed], known]).set_index('Sample').reindex(pd.Index(names, name='Sample')).reset_index()
+    return table.iloc[codes].reset_index(drop=True)
+
+def _annotation_layout(samples):
+    '''
+    Plate layout from RDML sample annotations named like ID columns, if any
+    '''
+    ids = [c for c in Data_processing.ID_COLUMNS if c in samples.columns and c != 'Gene']
+    if not ids:
+        return None
+    layout = samples[['Sample'] + ids].dropna(subset=ids, how='all')
+    if 'Replicate' in layout.columns:
+        layout['Replicate'] = pd.to_numeric(layout['Replicate'], errors='coerce').astype('Int64')
+    for column in ('Dilution', 'Fraction'):
+        if column in layout.columns:
+            layout[column] = pd.to_numeric(layout[column], errors='coerce')
+    return layout
+
+def _tidy_wells(wells, layout, pattern, controls):
+    '''
+    Shared tail of every reader: drop controls, attach the plate layout and
+    number the technical replicates of each sample
+    '''
+    if not controls and 'Task' in wells.columns:
+        wells = wells[~wells['Task'].fillna('').astype(str).str.strip().str.upper().str.startswith('NTC')]
+    wells = wells.drop(columns=['Task'], errors='ignore').reset_index(drop=True)
+
+    if layout is not None and 'Well' in layout.columns:
+        # Well-keyed layout: everything but the Ct comes from the layout
+        provided = [c for c in layout.columns if c != 'Well']
+        wells = wells.drop(columns=provided, errors='ignore').merge(layout, on='Well', how='inner')
+    else:
+        ids = split_samples(wells['Sample'], layout, pattern)
+        wells = pd.concat([wells, ids.drop(columns='Sample')], axis=1)
+
+    ids = [c for c in Data_processing.ID_COLUMNS if c in wells.columns]
+    wells['Technical_replicate'] = wells.groupby(ids, sort=False, dropna=False).cumcount() + 1
+    extra = [c for c in ('Quantity',) if c in wells.columns]
+    columns = ['Well', 'Sample'] + ids + ['Technical_replicate', 'Ct'] + extra
+    tidy = wells[[c for c in columns if c in wells.columns]]
+    if 'Excluded' in wells.columns:
+        # Wells excluded on the instrument are kept but left out of averages
+        tidy = tidy.assign(Outlier=wells['Excluded'].to_numpy(dtype=bool))
+    return tidy
+
+def read_rdml(file_path, layout=None, pattern=SAMPLE_PATTERN, controls=False):
+    '''
+    Goal: import an RDML run as one row per well
+
+    Input:
+    file_path - .rdml file (zipped or plain XML)
+    layout - optional plate layout (dataframe keyed by Sample or Well); sample
+        annotations named Condition, Replicate, ... are used otherwise, then pattern
+    pattern - see split_samples
+    controls - keep no-template control wells (RDML sample type 'ntc')
+
+    Output: long dataframe (Well, Sample, Gene, Condition, Replicate,
+    Technical_replicate, Ct, Outlier) as Data_processing.to_long_format
+    '''
+    wells, samples = parse_rdml(file_path)
+    if 'Type' in samples.columns:
+        wells['Task'] = wells['Sample'].map(samples.set_index('Sample')['Type'])
+    if 'Quantity' in samples.columns:
+        wells['Quantity'] = wells['Sample'].map(samples.set_index('Sample')['Quantity'])
+    if layout is None:
+        layout = _annotation_layout(samples)
+    return _tidy_wells(wells, layout, pattern, controls)
+
+def read_vendor_export(file_path, layout=None, pattern=SAMPLE_PATTERN, controls=False, sheet=None):
+    '''
+    Goal: import a QuantStudio/7500 or CFX results export (text, csv or xlsx)
+    as one row per well
+
+    Input:
+    file_path - export file; the results table is found by its header
+    layout, pattern, controls - see read_rdml ('NTC' task/content wells are controls)
+    sheet - xlsx sheet holding the results (default 'Results' or the first sheet)
+
+    Output: long dataframe as read_rdml; wells marked Omit become Outlier
+    '''
+    if str(file_path).lower().endswith(EXCEL_EXTENSIONS):
+        table = _read_excel_results(file_path, sheet)
+    else:
+        table = _read_text_results(file_path)
+    return _tidy_wells(_standard_columns(table), layout, pattern, controls)
+
+def _is_vendor_csv(file_path):
+    '''
+    True when one of the first SNIFF_LINES lines of a csv is a vendor results
+    header (target and Ct/Cq columns) rather than a Gene, ..., Ct1, Ct2 header
+    '''
+    with open(file_path, encoding='utf-8-sig', errors='replace') as handle:
+        for _, line in zip(range(SNIFF_LINES), handle):
+            if _find_header([line.rstrip('\r\n').split('\t' if '\t' in line else ',')]) is not None:
+                return True
+    return False
+
+def is_export(file_path):
+    '''
+    True for files read_export handles that are not plain Ct csvs: RDML, text
+    and xlsx exports, and csvs holding a vendor results table (CFX)
+    '''
+    name = str(file_path).lower()
+    if name.endswith(EXPORT_EXTENSIONS):
+        return True
+    return name.endswith('.csv') and os.path.isfile(file_path) and _is_vendor_csv(file_path)
+
+def read_export(file_path, layout=None, pattern=SAMPLE_PATTERN, controls=False, tidy=False, qc=None):
+    '''
+    Read an RDML or vendor export by its extension (csvs are vendor exports,
+    see is_export). qc names an outlier rule applied to each sample's wells
+    (Data_processing.flag_long_outliers). With tidy=True the wells are
+    averaged with Data_processing.aggregate_technical_replicates.
+    '''
+    if isinstance(layout, (str, os.PathLike)):
+        layout = pd.read_csv(layout)
+    if str(file_path).lower().endswith(RDML_EXTENSIONS):
+        wells = read_rdml(file_path, layout, pattern, controls)
+    else:
+        wells = read_vendor_export(file_path, layout, pattern, controls)
+    if qc is not None:
+        wells = Data_processing.flag_long_outliers(wells, method=qc)
+    if tidy:
+        return Data_processing.aggregate_technical_replicates(wells)
+    return wells
@@ -0,0 +1,105 @@
+# +
+import numpy as np
+import pandas as pd
+from scipy import signal
+
+from qPCR_analysis import Data_processing
+
+def melt_from_frame(df):
+    '''
+    Convert melt-curve fluorescence to a dense (wells x temperatures) array.
+
+    Accepts either a wide frame with a Temperature column and one column per
+    well, or a long frame with Well, Temperature and Fluorescence columns.
+    Returns (wells, temperatures, fluorescence).
+    '''
+    if 'Well' in df.columns:
+        df = df.pivot_table(index='Temperature', columns='Well', values='Fluorescence', aggfunc='mean', sort=False)
+    else:
+        df = df.set_index('Temperature')
+    df = df.sort_index()
+    return np.asarray(df.columns), df.index.to_numpy(dtype=float), df.to_numpy(dtype=float).T.copy()
+
+def import_melt_curves(file_path):
+    '''
+    Import a melt-curve export (see melt_from_frame for the layouts)
+    '''
+    return melt_from_frame(pd.read_csv(file_path))
+
+def negative_derivative(temperatures, fluorescence, window=7, polyorder=2):
+    '''
+    Smoothed -dF/dT of every well at once using a Savitzky-Golay filter along
+    the temperature axis. Assumes evenly spaced temperatures.
+    '''
+    step = np.median(np.diff(temperatures))
+    window = min(window, fluorescence.shape[1] - (1 - fluorescence.shape[1] % 2))
+    return -signal.savgol_filter(fluorescence, window, polyorder, deriv=1, delta=step, axis=1)
+
+def find_peaks_batch(temperatures, derivative, min_height=0.1, min_separation=3.0):
+    '''
+    Local maxima of -dF/dT for all wells in one array pass.
+
+    A peak must be at least min_height x the well's largest peak. Of peaks
+    closer than min_separation degrees only the highest is kept.
+
+    Returns (peak mask of the same shape as derivative, Tm of the main peak
+    refined by parabolic interpolation).
+    '''
+    d = derivative
+    inner = (d[:, 1:-1] > d[:, :-2]) & (d[:, 1:-1] >= d[:, 2:])
+    peaks = np.zeros_like(d, dtype=bool)
+    peaks[:, 1:-1] = inner & (d[:, 1:-1] >= min_height * d.max(axis=1, keepdims=True)) & (d[:, 1:-1] > 0)
+
+    # Suppress a peak if a higher peak lies within min_separation degrees
+    step = np.median(np.diff(temperatures))
+    reach = max(int(round(min_separation / step)), 1)
+    heights = np.where(peaks, d, -np.inf)
+    padded = np.pad(heights, [(0, 0), (reach, reach)], constant_values=-np.inf)
+    windows = np.lib.stride_tricks.sliding_window_view(padded, 2 * reach + 1, axis=1)
+    peaks &= heights >= windows.max(axis=2)
+
+    rows = np.arange(len(d))
+    main = np.argmax(d, axis=1)
+    left, right = np.clip(main - 1, 0, d.shape[1] - 1), np.clip(main + 1, 0, d.shape[1] - 1)
+    y0, y1, y2 = d[rows, left], d[rows, main], d[rows, right]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        offset = np.where((left < main) & (main < right), 0.5 * (y0 - y2) / (y0 - 2 * y1 + y2), 0)
+    tm = temperatures[main] + np.nan_to_num(offset) * step
+    return peaks, tm
+
+def melt_peaks(wells, temperatures, fluorescence, window=7, min_height=0.1, min_separation=3.0):
+    '''
+    Goal: melting temperature and product count for every well of a plate
+
+    Input:
+    wells, temperatures, fluorescence - from import_melt_curves
+    window - Savitzky-Golay smoothing window (points)
+    min_height, min_separation - peak filters, see find_peaks_batch
+
+    Output: dataframe with Well, Tm, n_peaks and Multiple products (True when
+    more than one peak, e.g. a primer dimer)
+    '''
+    derivative = negative_derivative(temperatures, fluorescence, window)
+    peaks, tm = find_peaks_batch(temperatures, derivative, min_height, min_separation)
+    n_peaks = peaks.sum(axis=1)
+    return pd.DataFrame({'Well': wells, 'Tm': tm, 'n_peaks': n_peaks, 'Multiple products': n_peaks > 1})
+
+def add_melt_flags(tidy, melt_calls, layout):
+    '''
+    Goal: flag samples in a tidy frame whose wells show more than one melt product
+
+    Input:
+    tidy - tidy dataframe (e.g. import_and_tidy_data output)
+    melt_calls - output of melt_peaks
+    layout - plate layout mapping Well to the sample columns of tidy
+
+    Output: copy of tidy with a Multiple products column (True if any of the
+    sample's wells has more than one peak) and the sample's mean Tm
+    '''
+    wells = layout.merge(melt_calls, on='Well', how='inner')
+    ids = [c for c in Data_processing.ID_COLUMNS if c in wells.columns and c in tidy.columns]
+    flags = wells.groupby(ids, sort=False, dropna=False).agg(
+        **{'Multiple products': ('Multiple products', 'any'), 'Tm': ('Tm', 'mean')}).reset_index()
+    flagged = tidy.drop(columns=['Multiple products', 'Tm'], errors='ignore').merge(flags, on=ids, how='left')
+    flagged['Multiple products'] = flagged['Multiple products'].fillna(False).astype(bool)
+    return flagged
@@ -0,0 +1,196 @@
+# +
+import argparse
+import glob
+import os
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+
+from qPCR_analysis import Data_processing, Instrumentation
+
+# Name of the combined result table produced for each csv layout
+ANALYSES = {'dilution': 'efficiency', 'GER': 'pfaffl', 'polysome': 'polysome'}
+
+def find_plates(folder, pattern='*.csv'):
+    '''
+    Sorted list of plate files in a run folder (searched recursively)
+    '''
+    return sorted(glob.glob(os.path.join(folder, '**', pattern), recursive=True))
+
+def analyze_plate(file_path, efficiencies=None, reference_genes=None, control_condition=None):
+    '''
+    Goal: import one plate and run the analysis matching its layout
+
+    Input:
+    file_path - csv in one of the Data_processing.EXPECTED_HEADERS layouts
+    efficiencies, reference_genes, control_condition - passed to
+        Data_processing.pfaffl_batch for GER plates
+
+    Output: (layout, result dataframe) where the result is the output of
+    primer_efficiency_batch, pfaffl_batch or polysome_profiling_batch
+    '''
+    df = Data_processing.import_and_tidy_data(file_path)
+    layout = Data_processing.detect_layout(df.columns)
+    if layout == 'dilution':
+        result = Data_processing.primer_efficiency_batch(df)
+    elif layout == 'polysome':
+        result = Data_processing.polysome_profiling_batch(df)
+    else:
+        if reference_genes is None or control_condition is None:
+            raise ValueError('GER plates need reference_genes and control_condition')
+        result = Data_processing.pfaffl_batch(df, efficiencies, reference_genes, control_condition)
+    return layout, result
+
+def _run_plate(file_path, options):
+    '''
+    Worker entry point: never raises, so one bad plate cannot abort the batch
+    '''
+    start = time.perf_counter()
+    try:
+        layout, result = analyze_plate(file_path, **options)
+        error = None
+    except Exception:
+        layout, result = None, None
+        error = traceback.format_exc(limit=3)
+    return file_path, layout, result, time.perf_counter() - start, error
+
+def _run_plate_instrumented(file_path, options, settings):
+    '''
+    Worker entry point while Instrumentation is enabled in the parent: records
+    the plate's calls in the worker and hands them back with the result
+    '''
+    # A forked worker starts with a copy of the parent's records: drop them so
+    # only this plate's calls are shipped back
+    Instrumentation.reset()
+    Instrumentation.enable(**settings)
+    try:
+        run = _run_plate(file_path, options)
+    finally:
+        Instrumentation.disable()
+    return run, Instrumentation.take_records()
+
+def _map_plates(paths, options, workers):
+    if workers == 1 or len(paths) <= 1:
+        return [_run_plate(path, options) for path in paths]
+    settings = Instrumentation.settings()
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        if settings is None:
+            return list(pool.map(_run_plate, paths, [options] * len(paths)))
+        runs = []
+        for run, records in pool.map(_run_plate_instrumented, paths, [options] * len(paths),
+                                     [settings] * len(paths)):
+            Instrumentation.add_records(records)
+            runs.append(run)
+        return runs
+
+def _plate_layout(file_path):
+    try:
+        return Data_processing.detect_layout(pd.read_csv(file_path, nrows=0).columns)
+    except Exception:
+        return None
+
+def run_pipeline(plates, efficiencies=None, reference_genes=None, control_condition=None, workers=None):
+    '''
+    Goal: analyze a whole run folder (or list of csv files) across a process pool
+
+    Input:
+    plates - folder to search for csv files, or a list of file paths
+    efficiencies - gene -> primer efficiency (%); genes fitted from dilution
+        plates in the same run are added to (and override) this table
+    reference_genes, control_condition - used for GER plates
+    workers - number of worker processes, None for one per core, 1 to run in-process
+
+    Output: dict with one combined dataframe per analysis ('efficiency',
+    'pfaffl', 'polysome'), each with a Plate column, and 'report' holding
+    Plate, Layout, Seconds, Rows, Status and Error for every file
+    '''
+    paths = find_plates(plates) if isinstance(plates, (str, os.PathLike)) else list(plates)
+
+    # Dilution plates first so their efficiencies are available to the GER plates
+    dilution = [p for p in paths if _plate_layout(p) == 'dilution']
+    others = [p for p in paths if p not in dilution]
+    runs = _map_plates(dilution, {}, workers)
+
+    efficiency_tables = [result.assign(Plate=path) for path, _, result, _, _ in runs if result is not None]
+    merged = Data_processing._efficiency_lookup(efficiencies if efficiencies is not None else {})
+    if efficiency_tables:
+        fitted = pd.concat(efficiency_tables).drop_duplicates('Gene', keep='last')
+        merged = pd.concat([merged, Data_processing._efficiency_lookup(fitted)])
+        merged = merged[~merged.index.duplicated(keep='last')]
+    options = {'efficiencies': merged.to_dict(), 'reference_genes': reference_genes,
+               'control_condition': control_condition}
+    runs += _map_plates(others, options, workers)
+
+    results = {name: [] for name in ANALYSES.values()}
+    report = []
+    for path, layout, result, seconds, error in runs:
+        if result is not None:
+            results[ANALYSES[layout]].append(result.assign(Plate=path))
+        report.append({'Plate': path, 'Layout': layout, 'Seconds': seconds,
+                       'Rows': 0 if result is None else len(result),
+                       'Status': 'failed' if error else 'ok', 'Error': error})
+
+    combined = {name: pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+                for name, frames in results.items()}
+    combined['report'] = pd.DataFrame(report, columns=['Plate', 'Layout', 'Seconds', 'Rows', 'Status', 'Error'])
+    return combined
+
+def _parse_efficiencies(values):
+    efficiencies = {}
+    for value in values or []:
+        gene, _, efficiency = value.partition('=')
+        efficiencies[gene] = float(efficiency)
+    return efficiencies
+
+def build_parser(parser=None):
+    '''
+    Argument parser for the pipeline command line
+    '''
+    parser = parser or argparse.ArgumentParser(description='Analyze every plate in a qPCR run folder in parallel')
+    parser.add_argument('folder', help='folder of csv exports, searched recursively')
+    parser.add_argument('-o', '--output-dir', default='.', help='where the combined csv tables are written')
+    parser.add_argument('-w', '--workers', type=int, default=None, help='worker processes (default: one per core)')
+    parser.add_argument('-r', '--reference', action='append', dest='reference_genes',
+                        help='reference gene for GER plates, repeat for several')
+    parser.add_argument('-c', '--control', dest='control_condition', help='calibrator condition for GER plates')
+    parser.add_argument('-e', '--efficiency', action='append', metavar='GENE=PERCENT',
+                        help='primer efficiency for a gene, repeat for several')
+    parser.add_argument('--instrument', metavar='FILE',
+                        help='record every Data_processing/Plotting call to FILE (.json or .csv)')
+    return parser
+
+def run_from_args(args):
+    '''
+    Run the pipeline for parsed command line arguments and write its tables
+    '''
+    if args.instrument:
+        # The file covers this run only
+        Instrumentation.reset()
+        Instrumentation.enable()
+    try:
+        results = run_pipeline(args.folder, efficiencies=_parse_efficiencies(args.efficiency),
+                               reference_genes=args.reference_genes,
+                               control_condition=args.control_condition, workers=args.workers)
+    finally:
+        if args.instrument:
+            Instrumentation.disable()
+            Instrumentation.export(args.instrument)
+    os.makedirs(args.output_dir, exist_ok=True)
+    for name, table in results.items():
+        if len(table):
+            table.to_csv(os.path.join(args.output_dir, f'{name}.csv'), index=False)
+
+    report = results['report']
+    for row in report.itertuples():
+        print(f'{row.Status:6} {row.Seconds:8.3f}s {row.Rows:7d} rows  {row.Plate}')
+    failed = int((report['Status'] == 'failed').sum())
+    print(f'{len(report) - failed} plates analyzed, {failed} failed')
+    return 1 if failed else 0
+
+def main(argv=None):
+    return run_from_args(build_parser().parse_args(argv))
+
+if __name__ == '__main__':
+    raise SystemExit(main())
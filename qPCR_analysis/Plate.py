@@ -0,0 +1,292 @@
+# +
+import numpy as np
+import pandas as pd
+
+from qPCR_analysis import Data_processing
+
+# ID columns stored as integer codes into sorted label arrays
+CODED_COLUMNS = list(Data_processing.ID_COLUMNS)
+
+# Code of a missing (NaN) label, which is not one of the levels
+MISSING_CODE = -1
+
+def _readonly(array):
+    array.flags.writeable = False
+    return array
+
+def _code_dtype(n_levels):
+    '''
+    Smallest signed integer type that can index n_levels labels and hold MISSING_CODE
+    '''
+    return np.min_scalar_type(-max(n_levels, 1))
+
+def _gather(levels, codes):
+    '''
+    Label of every code, NaN for MISSING_CODE (which would otherwise index the last label)
+    '''
+    labels = levels[codes]
+    missing = codes == MISSING_CODE
+    if missing.any():
+        labels = labels.astype(float if levels.dtype.kind in 'biuf' else object)
+        labels[missing] = np.nan
+    return labels
+
+def shared_levels(frames):
+    '''
+    Sorted labels of every ID column across frames, so plates coded with them
+    share one code per gene, condition, ... Missing labels are not levels,
+    they are coded MISSING_CODE.
+    '''
+    levels = {}
+    for column in CODED_COLUMNS:
+        values = [pd.unique(df[column]) for df in frames if column in df.columns]
+        if values:
+            values = pd.unique(np.concatenate(values))
+            levels[column] = _readonly(np.sort(values[~pd.isna(values)]))
+    return levels
+
+class Plate:
+    '''
+    Immutable, array-backed plate of Ct values.
+
+    Samples are rows of a (samples x technical replicates) float32 Ct matrix.
+    Each ID column (Gene, Condition, Dilution, Fraction, Replicate) is an
+    array of small integer codes into a sorted array of labels, MISSING_CODE
+    where the label is NaN.
+    Samples are sorted by gene, so plate['GOI'] is a slice: a view sharing
+    the plate's buffers, not a boolean-mask copy. All arrays are read-only,
+    so views and the frames built by to_frame() can be handed to several
+    analyses without defensive copies.
+
+    Parameters:
+        ct (numpy.ndarray): Ct matrix, NaN where a well has no Ct.
+        codes (dict): ID column -> code array, one code per sample.
+        levels (dict): ID column -> label array the codes index.
+        mask (numpy.ndarray): Optional boolean matrix of outlier wells (Data_processing.flag_outliers).
+        name (str): Plate name, e.g. its file path.
+    '''
+
+    __slots__ = ('ct', 'codes', 'levels', 'mask', 'name', '_bounds', '_summary')
+
+    def __init__(self, ct, codes, levels, mask=None, name=None):
+        self.ct = ct
+        self.codes = codes
+        self.levels = levels
+        self.mask = mask
+        self.name = name
+        gene_codes = codes['Gene']
+        # Start and end row of every gene code (samples are sorted by gene)
+        self._bounds = np.searchsorted(gene_codes, np.arange(len(levels['Gene']) + 1))
+        self._summary = None
+
+    @classmethod
+    def from_frame(cls, df, name=None, levels=None):
+        '''
+        Build a plate from a wide frame (Ct1, Ct2, ... columns, as import_and_tidy_data)
+        or a long frame (Technical_replicate and Ct, as to_long_format).
+        levels (from shared_levels) fixes the codes, e.g. across an Experiment.
+        '''
+        ids = [c for c in CODED_COLUMNS if c in df.columns]
+        levels = levels if levels is not None else shared_levels([df])
+        codes = {c: pd.Index(levels[c]).get_indexer(df[c]).astype(_code_dtype(len(levels[c]))) for c in ids}
+
+        if 'Ct' in df.columns and 'Technical_replicate' in df.columns:
+            # Long frame: one row per well, gather the wells of each sample into a row
+            keys, inverse = np.unique(np.column_stack([codes[c] for c in ids]), axis=0, return_inverse=True)
+            technical = df['Technical_replicate'].to_numpy(dtype=np.intp) - 1
+            ct = np.full((len(keys), technical.max() + 1), np.nan, dtype=np.float32)
+            ct[inverse.ravel(), technical] = df['Ct'].to_numpy(dtype=np.float32)
+            mask = None
+            if 'Outlier' in df.columns:
+                mask = np.zeros(ct.shape, dtype=bool)
+                mask[inverse.ravel(), technical] = df['Outlier'].to_numpy(dtype=bool)
+            codes = {c: keys[:, i].astype(codes[c].dtype) for i, c in enumerate(ids)}
+        else:
+            reps = Data_processing.ct_columns(df.columns)
+            ct = df[reps].apply(pd.to_numeric, errors='coerce').to_numpy(dtype=np.float32)
+            mask = None
+            if 'Outlier mask' in df.columns:
+                bits = df['Outlier mask'].to_numpy(dtype=np.int64)[:, None] >> np.arange(len(reps))
+                mask = (bits & 1).astype(bool)
+
+        order = np.argsort(codes['Gene'], kind='stable')
+        ct = _readonly(np.ascontiguousarray(ct[order]))
+        codes = {c: _readonly(values[order]) for c, values in codes.items()}
+        if mask is not None:
+            mask = _readonly(np.ascontiguousarray(mask[order]))
+        return cls(ct, codes, {c: levels[c] for c in ids}, mask, name)
+
+    def _view(self, rows):
+        return Plate(self.ct[rows], {c: v[rows] for c, v in self.codes.items()}, self.levels,
+                     None if self.mask is None else self.mask[rows], self.name)
+
+    def __len__(self):
+        return len(self.ct)
+
+    def __repr__(self):
+        return f'Plate({self.name!r}, {len(self)} samples x {self.ct.shape[1]} wells, {len(self.genes)} genes)'
+
+    def __getitem__(self, gene):
+        return self.gene(gene)
+
+    @property
+    def columns(self):
+        return list(self.codes)
+
+    @property
+    def genes(self):
+        '''
+        Genes present on the plate (or view), in code order
+        '''
+        return self.levels['Gene'][np.flatnonzero(np.diff(self._bounds))]
+
+    @property
+    def nbytes(self):
+        '''
+        Bytes held by the Ct, mask and code arrays (labels are shared and not counted)
+        '''
+        arrays = [self.ct, *self.codes.values()] + ([self.mask] if self.mask is not None else [])
+        return sum(a.nbytes for a in arrays)
+
+    def labels(self, column):
+        '''
+        Label of every sample in an ID column (a gather from the level array)
+        '''
+        return _gather(self.levels[column], self.codes[column])
+
+    def gene(self, gene):
+        '''
+        View of one gene's samples: a slice of the plate's arrays, no copy
+        '''
+        code = np.searchsorted(self.levels['Gene'], gene)
+        if code >= len(self.levels['Gene']) or self.levels['Gene'][code] != gene:
+            raise KeyError(gene)
+        return self._view(slice(self._bounds[code], self._bounds[code + 1]))
+
+    def select(self, **labels):
+        '''
+        Samples matching every column=label given, e.g. select(Condition='Treated').
+        Compares integer codes; returns a new plate (fancy indexing copies).
+        '''
+        keep = np.ones(len(self), dtype=bool)
+        for column, label in labels.items():
+            if pd.isna(label):
+                keep &= self.codes[column] == MISSING_CODE
+                continue
+            code = np.searchsorted(self.levels[column], label)
+            found = code < len(self.levels[column]) and self.levels[column][code] == label
+            keep &= (self.codes[column] == code) if found else False
+        return self._view(np.flatnonzero(keep))
+
+    def _summarize(self):
+        if self._summary is None:
+            ct = self.ct if self.mask is None else np.where(self.mask, np.nan, self.ct)
+            n = (~np.isnan(ct)).sum(axis=1)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                total = np.nansum(ct, axis=1, dtype=np.float64)
+                mean = np.where(n > 0, total / n, np.nan)
+                sq = np.nansum((ct - mean[:, None]) ** 2, axis=1, dtype=np.float64)
+                sem = np.where(n > 1, np.sqrt(sq / np.maximum(n - 1, 1) / n), np.nan)
+            self._summary = (_readonly(mean), _readonly(sem), _readonly(n))
+        return self._summary
+
+    @property
+    def ct_value(self):
+        '''
+        Mean Ct of each sample without masked wells (computed once)
+        '''
+        return self._summarize()[0]
+
+    @property
+    def sem(self):
+        return self._summarize()[1]
+
+    @property
+    def n_wells(self):
+        return self._summarize()[2]
+
+    def to_frame(self):
+        '''
+        Wide dataframe in the import_and_tidy_data layout (ID columns, Ct1,
+        Ct2, ..., Ct_value, SEM) for the Data_processing functions. Text
+        columns are categoricals over the shared labels, and the Ct columns
+        are views of the plate's read-only Ct matrix.
+        '''
+        ids = {}
+        for column, codes in self.codes.items():
+            levels = self.levels[column]
+            if levels.dtype.kind in 'fiu':
+                ids[column] = _gather(levels, codes)
+            else:
+                ids[column] = pd.Categorical.from_codes(codes.astype(np.int32), categories=levels)
+        cts = pd.DataFrame(self.ct, columns=[f'Ct{i + 1}' for i in range(self.ct.shape[1])], copy=False)
+        frame = pd.concat([pd.DataFrame(ids, copy=False), cts], axis=1)
+        frame['Ct_value'] = self.ct_value
+        frame['SEM'] = self.sem
+        return frame
+
+class Experiment:
+    '''
+    Several plates coded against one shared set of labels, so a gene or
+    condition has the same code on every plate.
+
+    Parameters:
+        plates (list): Plate objects built with the same levels (see from_frames).
+    '''
+
+    def __init__(self, plates):
+        self.plates = list(plates)
+
+    @classmethod
+    def from_frames(cls, frames, names=None):
+        '''
+        Build an experiment from tidy frames (one per plate)
+        '''
+        frames = list(frames)
+        names = names if names is not None else list(range(len(frames)))
+        levels = shared_levels(frames)
+        return cls(Plate.from_frame(df, name, levels) for df, name in zip(frames, names))
+
+    @classmethod
+    def from_files(cls, paths, reader=None):
+        '''
+        Import every file (with Data_processing.import_and_tidy_data by default)
+        '''
+        reader = reader or Data_processing.import_and_tidy_data
+        paths = list(paths)
+        return cls.from_frames((reader(path) for path in paths), names=paths)
+
+    def __len__(self):
+        return len(self.plates)
+
+    def __iter__(self):
+        return iter(self.plates)
+
+    def __getitem__(self, key):
+        if isinstance(key, int):
+            return self.plates[key]
+        return next(plate for plate in self.plates if plate.name == key)
+
+    def __repr__(self):
+        return f'Experiment({len(self)} plates, {sum(len(p) for p in self.plates)} samples)'
+
+    @property
+    def nbytes(self):
+        '''
+        Bytes of all plates' arrays plus the shared labels, counted once
+        '''
+        shared = {id(a): a for p in self.plates for a in p.levels.values()}
+        return sum(p.nbytes for p in self.plates) + sum(a.nbytes for a in shared.values())
+
+    def gene(self, gene):
+        '''
+        Experiment of per-plate views of one gene (plates without it are left out)
+        '''
+        return Experiment(plate.gene(gene) for plate in self.plates if gene in set(plate.genes))
+
+    def to_frame(self):
+        '''
+        Wide frames of every plate stacked, with a Plate column
+        '''
+        frames = [plate.to_frame().assign(Plate=plate.name) for plate in self.plates]
+        return pd.concat(frames, ignore_index=True)
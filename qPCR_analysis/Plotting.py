@@ -1,21 +1,28 @@
 # +
+import os
+from concurrent.futures import ProcessPoolExecutor
+
 import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
 
+from qPCR_analysis import Data_processing
+
 def plot_efficiency_graph(df, df_primer_efficiency, gene):
     # Filter the data for the specific gene
-    gene_data = df[df['Gene'] == gene]
+    gene_data = Data_processing.select_rows(df, Gene=gene)
     
     # Filter the primer efficiency data for the specific gene
-    gene_efficiency_data = df_primer_efficiency[df_primer_efficiency['Gene'] == gene]
+    gene_efficiency_data = Data_processing.select_rows(df_primer_efficiency, Gene=gene)
     
     # Extracting relevant information
-    log_dilution = gene_data['log_dilution']
+    if 'log_dilution' in gene_data.columns:
+        log_dilution = gene_data['log_dilution']
+    else:
+        log_dilution = np.log10(gene_data['Dilution'])
     ct_value = gene_data['Ct_value']
-    ct1 = gene_data['Ct1']
-    ct2 = gene_data['Ct2']
-    ct3 = gene_data['Ct3']
+    replicates = Data_processing.ct_columns(gene_data.columns)
+    replicate_cts = gene_data[replicates].to_numpy(dtype=float)
     slope = gene_efficiency_data['Slope'].values[0]  # Assuming there's only one row for each gene
     r_value = gene_efficiency_data['R'].values[0]  # Assuming there's only one row for each gene
     primer_efficiency = gene_efficiency_data['Primer Efficiency'].values[0]  # Assuming there's only one row for each gene
@@ -25,9 +32,9 @@ def plot_efficiency_graph(df, df_primer_efficiency, gene):
     fig, ax = plt.subplots()
     # Adjust to use ax instead of plt so we can return the fig for users to save
     ax.plot(log_dilution, ct_value, marker='o', color='blue', label=f'{gene} Ct_value')
-    ax.scatter(log_dilution, ct1, color='red', label='Ct1', alpha=0.3, s=20, zorder=5)
-    ax.scatter(log_dilution, ct2, color='green', label='Ct2', alpha=0.3, s=20, zorder=5)
-    ax.scatter(log_dilution, ct3, color='orange', label='Ct3', alpha=0.3, s=20, zorder=5)
+    # All technical replicates in one scatter call, whatever their number
+    ax.scatter(np.repeat(log_dilution.to_numpy(), len(replicates)), replicate_cts.ravel(),
+               color='red', label='Technical replicates', alpha=0.3, s=20, zorder=5)
     
     # Plot the main dot (average Ct_value) with error bars (standard error)
     ax.errorbar(log_dilution, ct_value, yerr=sem, fmt='o', color='blue', ecolor='black', capsize=5)
@@ -38,12 +45,12 @@ def plot_efficiency_graph(df, df_primer_efficiency, gene):
 
     # Add custom legend for slope, R_value, and primer efficiency
     legend_text = f'Slope: {slope:.2f}\nR_value: {r_value:.2f}\nPrimer Efficiency: {primer_efficiency:.2f}'
-    ax.text(0.65, 0.95, legend_text, transform=plt.gca().transAxes, fontsize=10, verticalalignment='top', bbox=dict(facecolor='none', edgecolor='black', boxstyle='round,pad=0.5'))
+    ax.text(0.65, 0.95, legend_text, transform=ax.transAxes, fontsize=10, verticalalignment='top', bbox=dict(facecolor='none', edgecolor='black', boxstyle='round,pad=0.5'))
     ax.set_title(f"Plot for {gene}'s dilutions series  made with a slope of {slope} and effiency of {primer_efficiency}")
 
     return fig
 
-def plot_gene_expression_ratio(df, gene):
+def plot_gene_expression_ratio(df, gene, seed=0):
     # Plotting the average GER with SEM as error bars, and creating empty bars
     fig, ax = plt.subplots()
     
@@ -51,17 +58,12 @@ def plot_gene_expression_ratio(df, gene):
     df.plot(ax=ax, kind='bar', x='Condition', y='Average GER', yerr='SEM GER', 
              error_kw=dict(capsize=2), legend=False, linewidth=1.5,
              edgecolor='black', facecolor='none')
-    fold_change = 0
-    # Adding individual points
-    for i in range(len(df)):
-        # Extract the individual gene expression ratios for the respective conditions
-        ratios = df.loc[i, ["Gene Expression Ratio 1", "Gene Expression Ratio 2", "Gene Expression Ratio 3"]]
-        
-        x_values = np.random.normal(i, 0.05, size=len(ratios)) 
-        
-        # Plot each point
-        for x, ratio in zip(x_values, ratios):
-            ax.plot(x, ratio, 'o', color=np.random.rand(3,), alpha=0.6) # random color for each point
+    ratio_columns = [c for c in df.columns if c.startswith('Gene Expression Ratio ')]
+    # Adding individual points, all conditions in one scatter with seeded jitter
+    ratios = df[ratio_columns].to_numpy(dtype=float)
+    positions = np.repeat(np.arange(len(df)), ratios.shape[1])
+    x_values = positions + np.random.default_rng(seed).normal(0, 0.05, size=positions.size)
+    ax.scatter(x_values, ratios.ravel(), c=positions, cmap='tab10', vmin=0, vmax=9, alpha=0.6, zorder=3)
 
     # Improving the plot aesthetics
     ax.set_ylabel('Gene Expression Ratio')
@@ -70,7 +72,7 @@ def plot_gene_expression_ratio(df, gene):
     # Customize x-tick labels for better appearance
     ax.set_xticklabels(df["Condition"], rotation=0)
 
-    ax.set_title(f"Plot for {gene}'s gene expression ratio made from {df} and {df}")
+    ax.set_title(f"Plot for {gene}'s gene expression ratio")
     return fig
 
 
@@ -88,9 +90,9 @@ def plot_gene_fractions(df, gene_name):
     fig, ax = plt.subplots(figsize=(10, 6))  # Create a figure and an Axes object
     
     # Translucent lines for individual replicates    
-    ax.plot(df.index, df['Percent in fraction R1'], label='R1', color='blue', alpha=0.35)
-    ax.plot(df.index, df['Percent in fraction R2'], label='R2', color='red', alpha=0.35)
-    ax.plot(df.index, df['Percent in fraction R3'], label='R3', color='green', alpha=0.35)
+    replicates = [c for c in df.columns if c.startswith('Percent in fraction R')]
+    ax.plot(df.index, df[replicates].to_numpy(), alpha=0.35,
+            label=[c[len('Percent in fraction '):] for c in replicates])
 
     # Solid line for the average percent
     ax.plot(df.index, df['Average Percent in Fraction'], label='Average', color='black', linewidth=2)
@@ -103,22 +105,123 @@ def plot_gene_fractions(df, gene_name):
     ax.set_xlabel('Fraction Number')
     ax.set_ylabel('Percent')
     ax.set_title(f'Average Percent in Each Fraction for {gene_name} with Individual Replicates')
-    plt.legend()
-    plt.grid(False)
+    ax.legend()
+    ax.grid(False)
 
     return fig
 
 
-def save_plot(fig, file_path):
+def _grid(n_panels, ncols, panel_size, fig=None):
+    """
+    Lay out n_panels axes on fig (cleared and reused when given) and hide unused cells
+    """
+    ncols = max(1, min(ncols, n_panels))
+    nrows = max(1, -(-n_panels // ncols))
+    figsize = (panel_size[0] * ncols, panel_size[1] * nrows)
+    if fig is None:
+        fig = plt.figure(figsize=figsize)
+    else:
+        fig.clear()
+        fig.set_size_inches(figsize)
+    axes = np.atleast_1d(fig.subplots(nrows, ncols, squeeze=False).ravel())
+    for ax in axes[n_panels:]:
+        ax.set_visible(False)
+    return fig, axes[:n_panels]
+
+def plot_expression_grid(pfaffl_df, genes=None, ncols=4, seed=0, fig=None):
+    """
+    Plot the gene expression ratio of every gene as panels of a single figure.
+    
+    Parameters:
+        pfaffl_df (pandas.DataFrame): Long-form output of Data_processing.pfaffl_batch.
+        genes (list): Genes to plot, defaults to all genes in pfaffl_df.
+        ncols (int): Number of panels per row.
+        seed (int): Seed for the horizontal jitter of replicate points.
+        fig (matplotlib.figure.Figure): Figure to clear and reuse instead of creating one.
+        
+    Returns:
+        matplotlib.figure.Figure: The figure holding one panel per gene.
+    """
+    genes = list(pd.unique(pfaffl_df['Gene'])) if genes is None else list(genes)
+    fig, axes = _grid(len(genes), ncols, (3.5, 3), fig)
+    rng = np.random.default_rng(seed)
+    conditions = list(pd.unique(pfaffl_df['Condition']))
+    index = Data_processing.group_index(pfaffl_df, ('Gene',))
+
+    for ax, gene in zip(axes, genes):
+        gene_df = Data_processing.select_rows(pfaffl_df, index, Gene=gene)
+        summary = gene_df.groupby('Condition', observed=True)['Gene Expression Ratio'].agg(['mean', 'sem'])
+        summary = summary.reindex(conditions)
+        positions = np.arange(len(conditions))
+        ax.bar(positions, summary['mean'], yerr=summary['sem'], capsize=2, linewidth=1.5,
+               edgecolor='black', facecolor='none')
+        # One scatter per panel for every replicate point
+        x_codes = pd.Categorical(gene_df['Condition'], categories=conditions).codes
+        ax.scatter(x_codes + rng.normal(0, 0.05, size=len(x_codes)), gene_df['Gene Expression Ratio'],
+                   c=x_codes, cmap='tab10', vmin=0, vmax=9, alpha=0.6, s=15, zorder=3)
+        ax.set_xticks(positions)
+        ax.set_xticklabels(conditions)
+        ax.set_title(str(gene))
+    for ax in axes[::max(1, min(ncols, len(genes)))]:
+        ax.set_ylabel('Gene Expression Ratio')
+    fig.tight_layout()
+    return fig
+
+def plot_fraction_grid(polysome_df, genes=None, ncols=4, fig=None):
+    """
+    Plot the percent of mRNA per fraction of every gene as panels of a single figure,
+    with one average line per condition and the replicate points behind it.
+    
+    Parameters:
+        polysome_df (pandas.DataFrame): Output of Data_processing.polysome_profiling_batch.
+        genes (list): Genes to plot, defaults to all genes in polysome_df.
+        ncols (int): Number of panels per row.
+        fig (matplotlib.figure.Figure): Figure to clear and reuse instead of creating one.
+        
+    Returns:
+        matplotlib.figure.Figure: The figure holding one panel per gene.
+    """
+    genes = list(pd.unique(polysome_df['Gene'])) if genes is None else list(genes)
+    fig, axes = _grid(len(genes), ncols, (4, 3), fig)
+    conditions = list(pd.unique(polysome_df['Condition']))
+    colors = {condition: f'C{i % 10}' for i, condition in enumerate(conditions)}
+    index = Data_processing.group_index(polysome_df, ('Gene',))
+
+    for ax, gene in zip(axes, genes):
+        gene_df = Data_processing.select_rows(polysome_df, index, Gene=gene)
+        summary = gene_df.groupby(['Condition', 'Fraction'], observed=True)['Percent in fraction'].agg(['mean', 'sem'])
+        ax.scatter(gene_df['Fraction'], gene_df['Percent in fraction'], s=8, alpha=0.35,
+                   c=gene_df['Condition'].map(colors).tolist())
+        for condition in conditions:
+            if condition in summary.index.get_level_values(0):
+                line = summary.loc[condition]
+                ax.errorbar(line.index, line['mean'], yerr=line['sem'], color=colors[condition],
+                            capsize=3, label=str(condition))
+        ax.set_title(str(gene))
+        ax.set_xlabel('Fraction Number')
+    for ax in axes[::max(1, min(ncols, len(genes)))]:
+        ax.set_ylabel('Percent')
+    if len(axes):
+        axes[0].legend(fontsize=8)
+    fig.tight_layout()
+    return fig
+
+
+def save_plot(fig, file_path, close=False, verbose=True):
     """
     Saves the plot to a specified file path.
     
     Parameters:
         fig (matplotlib.figure.Figure): The figure object to save.
         file_path (str): The file path where the figure should be saved.
+        close (bool): Close the figure after saving to release its memory.
+        verbose (bool): Print the path the plot was saved to.
     """
     fig.savefig(file_path)
-    print(f"Plot saved to {file_path}")
+    if close:
+        plt.close(fig)
+    if verbose:
+        print(f"Plot saved to {file_path}")
 
 
 def get_save_path(default_path='/default/path/plot.png'):
@@ -138,6 +241,120 @@ def get_save_path(default_path='/default/path/plot.png'):
     else:
         # User provided a path
         return user_input
+
+
+def ger_table(pfaffl_df, gene, index=None):
+    """
+    Reshape pfaffl_batch output for one gene into the layout plot_gene_expression_ratio
+    expects: one row per condition with Average GER, SEM GER and one
+    'Gene Expression Ratio N' column per biological replicate.
+    index is an optional Data_processing.group_index(pfaffl_df, ('Gene',)).
+    """
+    gene_df = Data_processing.select_rows(pfaffl_df, index, Gene=gene)
+    wide = gene_df.pivot_table(index='Condition', columns='Replicate', values='Gene Expression Ratio', observed=True)
+    wide.columns = [f'Gene Expression Ratio {r}' for r in wide.columns]
+    wide.insert(0, 'Average GER', wide.mean(axis=1))
+    wide.insert(1, 'SEM GER', wide.iloc[:, 1:].sem(axis=1))
+    return wide.reset_index()
+
+def fraction_table(polysome_df, gene, condition, index=None):
+    """
+    Reshape polysome_profiling_batch output for one gene and condition into the
+    layout plot_gene_fractions expects, indexed by fraction. index is an
+    optional Data_processing.group_index(polysome_df, ('Gene', 'Condition')).
+    """
+    subset = Data_processing.select_rows(polysome_df, index, Gene=gene, Condition=condition)
+    wide = subset.pivot_table(index='Fraction', columns='Replicate', values='Percent in fraction', observed=True)
+    wide.columns = [f'Percent in fraction R{r}' for r in wide.columns]
+    wide['Average Percent in Fraction'] = wide.mean(axis=1)
+    wide['SEM Percent in Fraction'] = wide.iloc[:, :-1].sem(axis=1)
+    return wide
+
+def _safe_name(*parts):
+    return '_'.join(str(p) for p in parts).replace(os.sep, '-').replace(' ', '_')
+
+def figure_jobs(dilution_df=None, efficiency_df=None, pfaffl_df=None, polysome_df=None):
+    """
+    List the per-gene figures for export_figures as (file stem, plot kind, args) tuples.
+
+    Parameters:
+        dilution_df, efficiency_df: tidy dilution data and primer_efficiency_batch output,
+            one efficiency plot per gene in efficiency_df.
+        pfaffl_df: pfaffl_batch output, one expression ratio plot per gene.
+        polysome_df: polysome_profiling_batch output, one fraction plot per gene and condition.
+    """
+    jobs = []
+    if dilution_df is not None and efficiency_df is not None:
+        dilution_index = Data_processing.group_index(dilution_df, ('Gene',))
+        efficiency_index = Data_processing.group_index(efficiency_df, ('Gene',))
+        for gene in efficiency_df['Gene']:
+            gene_data = Data_processing.select_rows(dilution_df, dilution_index, Gene=gene)
+            gene_data = gene_data.assign(log_dilution=np.log10(gene_data['Dilution']))
+            gene_efficiency = Data_processing.select_rows(efficiency_df, efficiency_index, Gene=gene)
+            jobs.append((_safe_name(gene, 'efficiency'), 'efficiency', (gene_data, gene_efficiency, gene)))
+    if pfaffl_df is not None:
+        index = Data_processing.group_index(pfaffl_df, ('Gene',))
+        for gene in pd.unique(pfaffl_df['Gene']):
+            jobs.append((_safe_name(gene, 'expression_ratio'), 'ratio', (ger_table(pfaffl_df, gene, index), gene)))
+    if polysome_df is not None:
+        index = Data_processing.group_index(polysome_df, ('Gene', 'Condition'))
+        pairs = polysome_df[['Gene', 'Condition']].drop_duplicates()
+        for gene, condition in pairs.itertuples(index=False):
+            jobs.append((_safe_name(gene, condition, 'fractions'), 'fractions',
+                         (fraction_table(polysome_df, gene, condition, index), f'{gene} ({condition})')))
+    return jobs
+
+PLOT_FUNCTIONS = {
+    'efficiency': 'plot_efficiency_graph',
+    'ratio': 'plot_gene_expression_ratio',
+    'fractions': 'plot_gene_fractions',
+}
+
+def _use_agg():
+    plt.switch_backend('Agg')
+
+def _render_jobs(jobs, output_dir, formats, dpi):
+    """
+    Render a chunk of jobs, closing every figure as soon as it is written
+    """
+    written = []
+    for stem, kind, args in jobs:
+        fig = globals()[PLOT_FUNCTIONS[kind]](*args)
+        try:
+            for fmt in formats:
+                path = os.path.join(output_dir, f'{stem}.{fmt}')
+                fig.savefig(path, dpi=dpi)
+                written.append(path)
+        finally:
+            plt.close(fig)
+    return written
+
+def export_figures(output_dir, jobs=None, formats=('png',), workers=None, dpi=100, **data):
+    """
+    Render every per-gene figure headlessly and write it to output_dir, without prompts.
+
+    Parameters:
+        output_dir (str): Directory the figures are written to (created if needed).
+        jobs (list): Jobs from figure_jobs; built from the dataframes in data if omitted.
+        formats (tuple): File formats to write for each figure, e.g. ('png', 'svg', 'pdf').
+        workers (int): Worker processes, each using the Agg backend (default: one per core).
+        dpi (int): Resolution of raster formats.
+        **data: dilution_df, efficiency_df, pfaffl_df and/or polysome_df for figure_jobs.
+
+    Returns:
+        list: Paths of the written files.
+    """
+    if jobs is None:
+        jobs = figure_jobs(**data)
+    os.makedirs(output_dir, exist_ok=True)
+    workers = workers or os.cpu_count() or 1
+    # A few chunks per worker keeps the pool busy without pickling one job at a time
+    n_chunks = min(len(jobs), workers * 4)
+    chunks = [jobs[i::n_chunks] for i in range(n_chunks)]
+    with ProcessPoolExecutor(max_workers=workers, initializer=_use_agg) as pool:
+        results = pool.map(_render_jobs, chunks, [output_dir] * n_chunks,
+                           [tuple(formats)] * n_chunks, [dpi] * n_chunks)
+        return sorted(path for chunk in results for path in chunk)
     
 # Example Usage
 # save_path = get_save_path()
@@ -1 +1,443 @@
+# +
+from concurrent.futures import ProcessPoolExecutor
 
+import numpy as np
+import pandas as pd
+from scipy import stats
+
+from qPCR_analysis import Data_processing
+
+def _pad_groups(values, codes, n_groups):
+    '''
+    Lay out values by group code as a (n_groups, max group size) matrix padded
+    with NaN, returning it with the size of each group
+    '''
+    order = np.argsort(codes, kind='stable')
+    sorted_codes = codes[order]
+    sizes = np.bincount(codes, minlength=n_groups)
+    starts = np.concatenate(([0], np.cumsum(sizes)[:-1]))
+    position = np.arange(len(codes)) - starts[sorted_codes]
+    padded = np.full((n_groups, max(sizes.max(initial=0), 1)), np.nan)
+    padded[sorted_codes, position] = values[order]
+    return padded, sizes
+
+def _chunk_seeds(n_resamples, chunk_size, seed):
+    '''
+    Split n_resamples into chunks, each with its own child seed, so results do
+    not depend on how many workers run the chunks
+    '''
+    counts = [chunk_size] * (n_resamples // chunk_size)
+    if n_resamples % chunk_size:
+        counts.append(n_resamples % chunk_size)
+    return list(zip(counts, np.random.SeedSequence(seed).spawn(len(counts))))
+
+def _map_chunks(function, chunks, args, workers):
+    if workers == 1 or len(chunks) == 1:
+        return [function(*args, n, seed) for n, seed in chunks]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(function, *args, n, seed) for n, seed in chunks]
+        return [future.result() for future in futures]
+
+def _bootstrap_means_chunk(padded, sizes, n_resamples, seed):
+    '''
+    Means of n_resamples bootstrap resamples of every group: (n_resamples, n_groups)
+    '''
+    rng = np.random.default_rng(seed)
+    width = padded.shape[1]
+    # Random indices into each group's own values, drawn for all groups at once
+    idx = (rng.random((n_resamples, len(sizes), width)) * sizes[:, None]).astype(np.intp)
+    resampled = np.take_along_axis(padded[None, :, :], idx, axis=2)
+    valid = np.arange(width) < sizes[:, None]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(valid, resampled, 0).sum(axis=2) / sizes
+
+def _bootstrap_means(values, codes, n_groups, n_resamples, seed, workers, chunk_size):
+    padded, sizes = _pad_groups(values, codes, n_groups)
+    chunks = _chunk_seeds(n_resamples, chunk_size, seed)
+    return np.vstack(_map_chunks(_bootstrap_means_chunk, chunks, (padded, sizes), workers))
+
+def _transform(values, log):
+    values = np.asarray(values, dtype=float)
+    return np.log2(values) if log else values
+
+def bootstrap_ci(df, value_column='Gene Expression Ratio', group_columns=('Gene', 'Condition'),
+                 n_resamples=10000, confidence=0.95, log=False, seed=None, workers=1, chunk_size=1000):
+    '''
+    Goal: percentile bootstrap confidence interval of the mean of every group
+
+    Input:
+    df - long-form dataframe, e.g. from Data_processing.pfaffl_batch
+    value_column - column to summarise
+    group_columns - columns defining the groups
+    n_resamples, confidence - number of bootstrap resamples and interval width
+    log - bootstrap log2 values and report the geometric mean (suits ratios)
+    seed - seed for reproducible resamples
+    workers - processes the resamples are split across
+    chunk_size - resamples drawn per array operation, bounds memory use
+
+    Output: dataframe with the group columns, n, Estimate, CI low and CI high
+    '''
+    group_columns = list(group_columns)
+    data = df.dropna(subset=[value_column])
+    codes, groups = pd.MultiIndex.from_frame(data[group_columns]).factorize()
+    values = _transform(data[value_column], log)
+
+    means = _bootstrap_means(values, codes, len(groups), n_resamples, seed, workers, chunk_size)
+    alpha = (1 - confidence) / 2
+    low, high = np.nanquantile(means, [alpha, 1 - alpha], axis=0)
+    estimate = np.bincount(codes, weights=values, minlength=len(groups)) / np.bincount(codes, minlength=len(groups))
+    if log:
+        estimate, low, high = 2 ** estimate, 2 ** low, 2 ** high
+
+    result = groups.to_frame(index=False, name=group_columns)
+    result['n'] = np.bincount(codes, minlength=len(groups))
+    result['Estimate'] = estimate
+    result['CI low'] = low
+    result['CI high'] = high
+    return result
+
+def _two_group_layout(df, value_column, control_condition, log):
+    '''
+    Pair every non-control condition of each gene with that gene's control values.
+    Returns the (Gene, Condition) pairs and padded (pairs, max n) matrices and
+    sizes for the test and control values.
+    '''
+    data = df.dropna(subset=[value_column])
+    values = _transform(data[value_column], log)
+    genes = data['Gene'].to_numpy()
+    is_control = (data['Condition'] == control_condition).to_numpy()
+
+    test = pd.MultiIndex.from_frame(data.loc[~is_control, ['Gene', 'Condition']])
+    test_codes, pairs = test.factorize()
+    padded_test, test_sizes = _pad_groups(values[~is_control], test_codes, len(pairs))
+
+    control_genes = pd.Index(pd.unique(genes[is_control]))
+    padded_control, control_sizes = _pad_groups(values[is_control], control_genes.get_indexer(genes[is_control]),
+                                                len(control_genes))
+    pair_gene = control_genes.get_indexer(pairs.get_level_values(0))
+    if (pair_gene < 0).any():
+        missing = sorted(set(pairs.get_level_values(0)[pair_gene < 0]))
+        raise ValueError(f"No {control_condition!r} values for: {', '.join(map(str, missing))}")
+    return pairs, padded_test, test_sizes, padded_control[pair_gene], control_sizes[pair_gene]
+
+def _padded_mean(padded, sizes):
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.nansum(padded, axis=-1) / sizes
+
+def _bootstrap_difference_chunk(padded_test, test_sizes, padded_control, control_sizes, n_resamples, seed):
+    test_seed, control_seed = seed.spawn(2)
+    return (_bootstrap_means_chunk(padded_test, test_sizes, n_resamples, test_seed)
+            - _bootstrap_means_chunk(padded_control, control_sizes, n_resamples, control_seed))
+
+def bootstrap_difference(df, control_condition, value_column='Gene Expression Ratio', log=True,
+                         n_resamples=10000, confidence=0.95, seed=None, workers=1, chunk_size=1000):
+    '''
+    Goal: bootstrap confidence interval of the difference in means between every
+    condition and the control condition, for every gene
+
+    Input:
+    df - long-form dataframe with Gene, Condition and value_column (e.g. pfaffl_batch output)
+    control_condition - condition every other condition is compared to
+    log - compare log2 values. On Gene Expression Ratios this gives the log2 fold
+        change, i.e. the efficiency-corrected -ddCt
+    n_resamples, confidence, seed, workers, chunk_size - as in bootstrap_ci
+
+    Output: dataframe with Gene, Condition, Difference, CI low and CI high
+    '''
+    pairs, padded_test, test_sizes, padded_control, control_sizes = _two_group_layout(
+        df, value_column, control_condition, log)
+    chunks = _chunk_seeds(n_resamples, chunk_size, seed)
+    args = (padded_test, test_sizes, padded_control, control_sizes)
+    differences = np.vstack(_map_chunks(_bootstrap_difference_chunk, chunks, args, workers))
+
+    alpha = (1 - confidence) / 2
+    low, high = np.nanquantile(differences, [alpha, 1 - alpha], axis=0)
+    result = pairs.to_frame(index=False, name=['Gene', 'Condition'])
+    result['Difference'] = _padded_mean(padded_test, test_sizes) - _padded_mean(padded_control, control_sizes)
+    result['CI low'] = low
+    result['CI high'] = high
+    return result
+
+def _permutation_chunk(pooled, test_sizes, pooled_sizes, n_resamples, seed):
+    '''
+    Difference in means after randomly relabelling the pooled values of every pair
+    '''
+    rng = np.random.default_rng(seed)
+    width = pooled.shape[1]
+    valid = np.arange(width) < pooled_sizes[:, None]
+    # Sorting random keys (padding last) gives an independent shuffle per pair and resample
+    keys = np.where(valid, rng.random((n_resamples, len(pooled_sizes), width)), np.inf)
+    shuffled = np.take_along_axis(np.broadcast_to(pooled, keys.shape), np.argsort(keys, axis=2), axis=2)
+    shuffled = np.where(valid, shuffled, 0)
+    in_test = np.arange(width) < test_sizes[:, None]
+    control_sizes = pooled_sizes - test_sizes
+    with np.errstate(invalid='ignore', divide='ignore'):
+        test_mean = np.where(in_test, shuffled, 0).sum(axis=2) / test_sizes
+        control_mean = np.where(in_test, 0, shuffled).sum(axis=2) / control_sizes
+    return test_mean - control_mean
+
+def permutation_test(df, control_condition, value_column='Gene Expression Ratio', log=True,
+                     n_resamples=10000, alternative='two-sided', seed=None, workers=1, chunk_size=1000):
+    '''
+    Goal: permutation test of the difference in means between every condition and
+    the control condition, for every gene
+
+    Input:
+    df, control_condition, value_column, log - as in bootstrap_difference
+    n_resamples - number of random relabellings
+    alternative - 'two-sided', 'greater' or 'less' (condition vs control)
+    seed, workers, chunk_size - as in bootstrap_ci
+
+    Output: dataframe with Gene, Condition, Difference and p_value
+    '''
+    pairs, padded_test, test_sizes, padded_control, control_sizes = _two_group_layout(
+        df, value_column, control_condition, log)
+
+    # Pool each pair's values: test values first, then control values
+    width = padded_test.shape[1] + padded_control.shape[1]
+    pooled = np.full((len(pairs), width), np.nan)
+    pooled[:, :padded_test.shape[1]] = padded_test
+    columns = test_sizes[:, None] + np.arange(padded_control.shape[1])
+    rows = np.broadcast_to(np.arange(len(pairs))[:, None], columns.shape)
+    keep = np.arange(padded_control.shape[1]) < control_sizes[:, None]
+    pooled[rows[keep], columns[keep]] = padded_control[keep]
+    pooled_sizes = test_sizes + control_sizes
+
+    observed = _padded_mean(padded_test, test_sizes) - _padded_mean(padded_control, control_sizes)
+    chunks = _chunk_seeds(n_resamples, chunk_size, seed)
+    null = np.vstack(_map_chunks(_permutation_chunk, chunks, (pooled, test_sizes, pooled_sizes), workers))
+
+    tolerance = 1e-12 * np.maximum(1, np.abs(observed))
+    if alternative == 'two-sided':
+        extreme = np.abs(null) >= np.abs(observed) - tolerance
+    elif alternative == 'greater':
+        extreme = null >= observed - tolerance
+    elif alternative == 'less':
+        extreme = null <= observed + tolerance
+    else:
+        raise ValueError("alternative must be 'two-sided', 'greater' or 'less'")
+
+    result = pairs.to_frame(index=False, name=['Gene', 'Condition'])
+    result['Difference'] = observed
+    result['p_value'] = (extreme.sum(axis=0) + 1) / (n_resamples + 1)
+    return result
+
+def adjust_p_values(p_values, method='fdr_bh'):
+    '''
+    Goal: correct a vector of p values for multiple testing
+
+    Input:
+    p_values - array-like of p values, NaNs are left as NaN and not counted
+    method - 'fdr_bh' (Benjamini-Hochberg), 'holm' or 'bonferroni'
+
+    Output: numpy array of adjusted p values in the input order
+    '''
+    p_values = np.asarray(p_values, dtype=float)
+    adjusted = np.full(p_values.shape, np.nan)
+    tested = ~np.isnan(p_values)
+    p = p_values[tested]
+    m = len(p)
+    if m == 0:
+        return adjusted
+    order = np.argsort(p, kind='stable')
+    ranked = p[order]
+    rank = np.arange(1, m + 1)
+    if method == 'fdr_bh':
+        # Step-up: running minimum from the largest p value down
+        corrected = np.minimum.accumulate((ranked * m / rank)[::-1])[::-1]
+    elif method == 'holm':
+        # Step-down: running maximum from the smallest p value up
+        corrected = np.maximum.accumulate(ranked * (m - rank + 1))
+    elif method == 'bonferroni':
+        corrected = ranked * m
+    else:
+        raise ValueError("method must be 'fdr_bh', 'holm' or 'bonferroni'")
+    result = np.empty(m)
+    result[order] = np.minimum(corrected, 1)
+    adjusted[tested] = result
+    return adjusted
+
+def group_moments(df, value_column='Gene Expression Ratio', group_columns=('Gene', 'Condition'), log=False):
+    '''
+    n, mean and sample variance of value_column for every group from one groupby
+    '''
+    data = df[list(group_columns)].copy()
+    data['value'] = _transform(df[value_column], log)
+    moments = data.groupby(list(group_columns), observed=True, sort=False)['value'].agg(['count', 'mean', 'var'])
+    return moments.rename(columns={'count': 'n'}).reset_index()
+
+def welch_t_test(df, control_condition, value_column='Gene Expression Ratio', log=True, correction='fdr_bh'):
+    '''
+    Goal: Welch's unequal-variance t test of every condition against the control
+    condition, for every gene at once
+
+    Input:
+    df - long-form dataframe with Gene, Condition and value_column (e.g. pfaffl_batch output)
+    control_condition - condition every other condition is compared to
+    log - test log2 values, as ratios are log-normally distributed
+    correction - multiple-testing method for adjust_p_values, or None
+
+    Output: dataframe with Gene, Condition, Difference, t, df, p_value
+    (and p_adjusted when correction is given)
+    '''
+    moments = group_moments(df, value_column, log=log)
+    control = moments[moments['Condition'] == control_condition].drop(columns='Condition')
+    test = moments[moments['Condition'] != control_condition]
+    paired = test.merge(control, on='Gene', suffixes=('', '_control'))
+
+    se_test = paired['var'].to_numpy() / paired['n'].to_numpy()
+    se_control = paired['var_control'].to_numpy() / paired['n_control'].to_numpy()
+    difference = paired['mean'].to_numpy() - paired['mean_control'].to_numpy()
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t_stat = difference / np.sqrt(se_test + se_control)
+        dof = (se_test + se_control) ** 2 / (se_test ** 2 / (paired['n'].to_numpy() - 1)
+                                             + se_control ** 2 / (paired['n_control'].to_numpy() - 1))
+    result = paired[['Gene', 'Condition']].reset_index(drop=True)
+    result['Difference'] = difference
+    result['t'] = t_stat
+    result['df'] = dof
+    result['p_value'] = 2 * stats.t.sf(np.abs(t_stat), dof)
+    if correction:
+        result['p_adjusted'] = adjust_p_values(result['p_value'], correction)
+    return result
+
+def one_way_anova(df, value_column='Gene Expression Ratio', log=True, correction='fdr_bh'):
+    '''
+    Goal: one-way ANOVA across all conditions, for every gene at once
+
+    Input:
+    df - long-form dataframe with Gene, Condition and value_column
+    log - test log2 values
+    correction - multiple-testing method for adjust_p_values, or None
+
+    Output: dataframe with Gene, F, df_between, df_within, p_value
+    (and p_adjusted when correction is given)
+    '''
+    moments = group_moments(df, value_column, log=log)
+    gene_codes, genes = pd.factorize(moments['Gene'])
+    n = moments['n'].to_numpy(dtype=float)
+    mean = moments['mean'].to_numpy()
+    var = np.nan_to_num(moments['var'].to_numpy())
+
+    # Between- and within-group sums of squares from the group moments alone
+    total_n = np.bincount(gene_codes, weights=n)
+    grand_mean = np.bincount(gene_codes, weights=n * mean) / total_n
+    ss_between = np.bincount(gene_codes, weights=n * (mean - grand_mean[gene_codes]) ** 2)
+    ss_within = np.bincount(gene_codes, weights=(n - 1) * var)
+    df_between = np.bincount(gene_codes) - 1
+    df_within = total_n - np.bincount(gene_codes)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        f_stat = (ss_between / df_between) / (ss_within / df_within)
+
+    result = pd.DataFrame({'Gene': genes, 'F': f_stat, 'df_between': df_between, 'df_within': df_within})
+    result['p_value'] = stats.f.sf(f_stat, df_between, df_within)
+    if correction:
+        result['p_adjusted'] = adjust_p_values(result['p_value'], correction)
+    return result
+
+def _log2_quantities(df, candidates, efficiencies):
+    '''
+    Sample x candidate matrix of log2 relative quantities, E**-Ct on the log2 scale.
+    Samples missing a Ct for any candidate are dropped.
+    '''
+    ct = df.pivot_table(index=['Condition', 'Replicate'], columns='Gene',
+                        values='Ct_value', aggfunc='mean', observed=True)
+    candidates = list(ct.columns) if candidates is None else list(candidates)
+    ct = ct[candidates].dropna()
+    if efficiencies is None:
+        log2_amplification = np.ones(len(candidates))
+    else:
+        efficiency = Data_processing._efficiency_lookup(efficiencies)
+        log2_amplification = np.log2(efficiency.reindex(candidates).to_numpy() / 100 + 1)
+    return ct, -ct.to_numpy() * log2_amplification
+
+def genorm(df, candidates=None, efficiencies=None):
+    '''
+    Goal: geNorm stability ranking of candidate reference genes
+
+    Input:
+    df - tidy dataframe with Gene, Condition, Replicate and Ct_value
+    candidates - genes to rank, defaults to every gene in df
+    efficiencies - optional gene -> primer efficiency (%), 100% when omitted
+
+    Output: dataframe with Gene, M and Rank (1 = most stable), ordered by rank.
+    M is each gene's stability value at the step it was eliminated; the final
+    two genes share the last M.
+    '''
+    ct, log2_q = _log2_quantities(df, candidates, efficiencies)
+    genes = np.asarray(ct.columns, dtype=object)
+    if len(genes) < 2:
+        raise ValueError('geNorm needs at least two candidate genes with complete data')
+
+    # var(log2 Qj - log2 Qk) = var_j + var_k - 2 cov_jk gives every pairwise variation at once
+    cov = np.atleast_2d(np.cov(log2_q, rowvar=False))
+    variance = np.diag(cov)
+    pairwise = np.sqrt(np.clip(variance[:, None] + variance[None, :] - 2 * cov, 0, None))
+
+    remaining = list(range(len(genes)))
+    eliminated = []
+    while len(remaining) > 2:
+        sub = pairwise[np.ix_(remaining, remaining)]
+        m_values = sub.sum(axis=1) / (len(remaining) - 1)
+        worst = int(np.argmax(m_values))
+        eliminated.append((remaining.pop(worst), m_values[worst]))
+    final_m = pairwise[remaining[0], remaining[1]]
+    order = [(g, final_m) for g in remaining] + eliminated[::-1]
+
+    return pd.DataFrame({
+        'Gene': genes[[g for g, _ in order]],
+        'M': [m for _, m in order],
+        'Rank': np.arange(1, len(order) + 1),
+    })
+
+def normfinder(df, candidates=None, efficiencies=None, group_column='Condition'):
+    '''
+    Goal: NormFinder stability ranking of candidate reference genes, combining
+    intra- and inter-group variation
+
+    Input:
+    df - tidy dataframe with Gene, Condition, Replicate and Ct_value
+    candidates, efficiencies - as in genorm
+    group_column - index level defining the sample groups (default Condition)
+
+    Output: dataframe with Gene, Stability (lower is more stable) and Rank,
+    ordered by rank
+    '''
+    ct, y = _log2_quantities(df, candidates, efficiencies)
+    genes = np.asarray(ct.columns, dtype=object)
+    n_genes = len(genes)
+    if n_genes < 3:
+        raise ValueError('NormFinder needs at least three candidate genes with complete data')
+    group_codes, groups = pd.factorize(ct.index.get_level_values(group_column))
+    n_groups = len(groups)
+    n_per_group = np.bincount(group_codes)
+
+    # Group means per gene (groups x genes) and per-sample means over genes
+    one_hot = np.eye(n_groups)[group_codes]
+    gene_group_mean = one_hot.T @ y / n_per_group[:, None]
+    sample_mean = y.mean(axis=1)
+    group_mean = gene_group_mean.mean(axis=1)
+
+    # Intra-group variance of each gene, corrected for the sample means
+    residual = y - gene_group_mean[group_codes] - sample_mean[:, None] + group_mean[group_codes][:, None]
+    residual_ss = one_hot.T @ residual ** 2 / (n_per_group[:, None] - 1)
+    intra = (residual_ss - residual_ss.sum(axis=1, keepdims=True) / (n_genes * (n_genes - 1))) \
+        / (1 - 2 / n_genes)
+    intra = np.clip(intra, 0, None)
+
+    if n_groups == 1:
+        # One group: the intragroup standard deviation itself
+        stability = np.sqrt(intra[0])
+    else:
+        # Variance of each group mean
+        intra = intra / n_per_group[:, None]
+        # Inter-group differences, shrunk towards zero by their estimated spread
+        inter = gene_group_mean - gene_group_mean.mean(axis=0) - group_mean[:, None] + group_mean.mean()
+        gamma = max((inter ** 2).sum() / ((n_genes - 1) * (n_groups - 1)) - intra.sum() / (n_genes * n_groups), 0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            shrunk = np.where(gamma + intra > 0, inter * gamma / (gamma + intra), 0)
+            spread = np.where(gamma + intra > 0, intra * gamma / (gamma + intra), 0)
+        stability = (np.abs(shrunk) + np.sqrt(spread)).mean(axis=0)
+
+    order = np.argsort(stability, kind='stable')
+    return pd.DataFrame({'Gene': genes[order], 'Stability': stability[order], 'Rank': np.arange(1, n_genes + 1)})
@@ -0,0 +1,335 @@
+# +
+import asyncio
+import fnmatch
+import os
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from qPCR_analysis import Data_processing, Instruments
+from qPCR_analysis.Pipeline import ANALYSES
+
+# Files picked up by the watcher, and names of partial files written before a rename
+PATTERNS = ['*.csv'] + [f'*{extension}' for extension in Instruments.EXPORT_EXTENSIONS]
+PARTIAL_PATTERNS = ['*.tmp', '*.part', '*.partial', '*.crdownload', '~$*', '.*']
+
+REPORT_COLUMNS = ['Plate', 'Layout', 'Rows', 'Status', 'Error', 'Outputs', 'Detected', 'Started', 'Finished',
+                  'Latency']
+
+def _init_worker():
+    from qPCR_analysis import Plotting
+    Plotting._use_agg()
+
+def load_plate(file_path, qc=None):
+    '''
+    Tidy frame of a Ct csv, or one row per well of an instrument export (wells
+    the software excluded are masked). Outlier wells are masked with the qc rule.
+    '''
+    if Instruments.is_export(file_path):
+        return Instruments.read_export(file_path, qc=qc)
+    return Data_processing.import_and_tidy_data(file_path, qc=qc)
+
+def plate_layout(file_path):
+    '''
+    Layout of a Ct csv read from its header. None for instrument exports, whose
+    layout is only known once they are read, and for unreadable files.
+    '''
+    try:
+        if Instruments.is_export(file_path):
+            return None
+        return Data_processing.detect_layout(pd.read_csv(file_path, nrows=0).columns)
+    except Exception:
+        return None
+
+def process_plate(file_path, output_dir, efficiencies=None, reference_genes=None, control_condition=None,
+                  qc=None, lot=None, register=False, formats=('png',), dpi=100):
+    '''
+    Goal: import, QC and analyze one plate and write its results
+
+    Input:
+    file_path - Ct csv or instrument export
+    output_dir - the result table is written to <stem>_<analysis>.csv and the
+        figures to a <stem> folder in it
+    efficiencies, reference_genes, control_condition, lot - for GER plates, see
+        Data_processing.pfaffl_batch
+    qc - outlier rule, see Data_processing.flag_outliers
+    register - fit dilution plates through the primer efficiency registry
+    formats, dpi - figure formats (empty for no figures) and resolution
+
+    Output: (layout, result dataframe, list of written paths). Raises
+    ValueError when the analysis gives no rows.
+    '''
+    df = load_plate(file_path, qc)
+    layout = Data_processing.frame_layout(df.columns)
+    if layout != 'polysome' and 'Ct' in df.columns:
+        # Exports are read one row per well, which only the polysome analysis uses
+        df = Data_processing.aggregate_technical_replicates(df)
+    if layout == 'dilution':
+        if register:
+            from qPCR_analysis import Efficiencies
+            result = Efficiencies.fit(df, lot=lot)
+        else:
+            result = Data_processing.primer_efficiency_batch(df)
+        data = {'dilution_df': df, 'efficiency_df': result}
+    elif layout == 'polysome':
+        result = Data_processing.polysome_profiling_batch(df)
+        data = {'polysome_df': result}
+    else:
+        if reference_genes is None or control_condition is None:
+            raise ValueError('GER plates need reference_genes and control_condition')
+        result = Data_processing.pfaffl_batch(df, efficiencies, reference_genes, control_condition, lot=lot)
+        data = {'pfaffl_df': result}
+    if result.empty:
+        raise ValueError(f'No {layout} results: no wells with a Ct')
+
+    # Written under a temporary name and renamed, so readers never see half a table
+    stem = os.path.splitext(os.path.basename(file_path))[0]
+    table_path = os.path.join(output_dir, f'{stem}_{ANALYSES[layout]}.csv')
+    result.to_csv(f'{table_path}.tmp', index=False)
+    os.replace(f'{table_path}.tmp', table_path)
+    written = [table_path]
+    if formats:
+        from qPCR_analysis import Plotting
+        figure_dir = os.path.join(output_dir, stem)
+        os.makedirs(figure_dir, exist_ok=True)
+        written += Plotting._render_jobs(Plotting.figure_jobs(**data), figure_dir, tuple(formats), dpi)
+    return layout, result, written
+
+def _run_plate(file_path, output_dir, options):
+    '''
+    Executor entry point: never raises, so one bad file cannot stop the service
+    '''
+    started = time.time()
+    try:
+        layout, result, written = process_plate(file_path, output_dir, **options)
+        record = {'Layout': layout, 'Rows': len(result), 'Status': 'ok', 'Error': None, 'Outputs': len(written)}
+        if layout == 'dilution':
+            record['efficiencies'] = Data_processing._efficiency_lookup(result).to_dict()
+    except Exception:
+        record = {'Layout': None, 'Rows': 0, 'Status': 'failed', 'Error': traceback.format_exc(limit=3),
+                  'Outputs': 0}
+    record.update(Plate=file_path, Started=started, Finished=time.time())
+    return record
+
+class FolderWatcher:
+    '''
+    Asyncio service that analyzes plates as an instrument writes them to a folder.
+
+    The folder is polled (which also works on network shares, where change
+    notifications are unreliable). A file is processed once its size and
+    modification time have not changed for settle seconds, so partially
+    written files are skipped. A file rewritten later is processed again.
+    Plates run through process_plate in a bounded executor: at most workers
+    plates are in flight and the event loop only waits. Each plate's table,
+    figures and report row are written as soon as that plate finishes.
+
+    Efficiencies fitted from dilution plates are used by the GER plates that
+    start after them. A GER csv (or an export) detected while dilution csvs
+    are still running waits for them first. Dilution plates exported from an
+    instrument are only recognised once read, so GER plates are not held for
+    them: a GER plate that starts while one is running uses the efficiencies
+    known at its start.
+
+    Parameters:
+        folder (str): Folder to watch.
+        output_dir (str): Where results, figures and watch_report.csv are written.
+        workers (int): Worker processes, None for one per core, 1 to run in a
+            thread of this process.
+        poll_interval (float): Seconds between scans of the folder.
+        settle (float): Seconds a file must stay unchanged before it is processed.
+        patterns (list): File name patterns to pick up, default PATTERNS.
+        recursive (bool): Also watch subfolders.
+        existing (bool): Also process files already in the folder at start.
+        **options: Passed to process_plate. Efficiencies fitted from dilution
+            plates are added to options['efficiencies'] (see above).
+    '''
+
+    def __init__(self, folder, output_dir, workers=None, poll_interval=1.0, settle=2.0, patterns=None,
+                 recursive=False, existing=True, **options):
+        if os.path.abspath(folder) == os.path.abspath(output_dir):
+            raise ValueError('output_dir must differ from the watched folder, results would be picked up as plates')
+        self.folder = folder
+        self.output_dir = output_dir
+        self.workers = workers or os.cpu_count() or 1
+        self.poll_interval = poll_interval
+        self.settle = settle
+        self.patterns = list(patterns or PATTERNS)
+        self.recursive = recursive
+        self.existing = existing
+        efficiencies = options.pop('efficiencies', None)
+        self.efficiencies = Data_processing._efficiency_lookup(efficiencies).to_dict()
+        self.options = options
+        self.records = []
+        self._seen = {}
+        self._done = {}
+        self._tasks = set()
+        self._fitting = set()
+        self._stop = None
+        self._started = None
+
+    def _matches(self, name):
+        if any(fnmatch.fnmatch(name, pattern) for pattern in PARTIAL_PATTERNS):
+            return False
+        return any(fnmatch.fnmatch(name.lower(), pattern) for pattern in self.patterns)
+
+    def scan(self):
+        '''
+        (size, modification time) of every matching file in the folder
+        '''
+        found = {}
+        folders = [self.folder]
+        while folders:
+            try:
+                entries = list(os.scandir(folders.pop()))
+            except FileNotFoundError:
+                continue
+            for entry in entries:
+                try:
+                    if entry.is_dir():
+                        if self.recursive and os.path.abspath(entry.path) != os.path.abspath(self.output_dir):
+                            folders.append(entry.path)
+                    elif self._matches(entry.name):
+                        info = entry.stat()
+                        found[entry.path] = (info.st_size, info.st_mtime_ns)
+                except FileNotFoundError:
+                    # Removed or renamed between listing and stat
+                    continue
+        return found
+
+    def ready(self, now=None):
+        '''
+        Files unchanged for settle seconds and not processed in this state yet,
+        as (path, first seen time) pairs, oldest first
+        '''
+        now = time.time() if now is None else now
+        found = self.scan()
+        # Forget files that were removed, so a long-running service does not grow
+        for state in (self._seen, self._done):
+            for path in [path for path in state if path not in found]:
+                del state[path]
+        ready = []
+        for path, signature in found.items():
+            if self._done.get(path) == signature:
+                continue
+            seen = self._seen.get(path)
+            if seen is None or seen[0] != signature:
+                # New or still being written: restart its settle time
+                self._seen[path] = (signature, now, seen[2] if seen else now)
+            elif signature[0] > 0 and now - seen[1] >= self.settle:
+                ready.append((path, seen[2]))
+                self._done[path] = signature
+                del self._seen[path]
+        return sorted(ready, key=lambda item: item[1])
+
+    def _skip_existing(self):
+        for path, signature in self.scan().items():
+            self._done[path] = signature
+
+    async def _process(self, loop, executor, slots, path, detected, upstream=()):
+        if upstream:
+            # Dilution plates submitted earlier: their efficiencies are needed first
+            await asyncio.wait(upstream)
+        async with slots:
+            options = dict(self.options, efficiencies=dict(self.efficiencies))
+            record = await loop.run_in_executor(executor, _run_plate, path, self.output_dir, options)
+        self.efficiencies.update(record.pop('efficiencies', {}))
+        record.update(Detected=detected, Latency=record['Finished'] - detected)
+        self.records.append(record)
+        self._write_report(record)
+        return record
+
+    def _write_report(self, record):
+        path = os.path.join(self.output_dir, 'watch_report.csv')
+        row = pd.DataFrame([record], columns=REPORT_COLUMNS)
+        row.to_csv(path, mode='a', header=not os.path.exists(path), index=False)
+
+    def stop(self):
+        '''
+        Ask a running service to finish the plates in flight and return
+        '''
+        if self._stop is not None:
+            self._stop.set()
+
+    async def run(self, max_plates=None, timeout=None):
+        '''
+        Watch until stop() is called, max_plates plates have been processed
+        or timeout seconds have passed. Returns the metrics() dataframe.
+        '''
+        loop = asyncio.get_running_loop()
+        self._stop = asyncio.Event()
+        self._started = time.time()
+        os.makedirs(self.output_dir, exist_ok=True)
+        if not self.existing:
+            self._skip_existing()
+        if self.workers == 1:
+            executor = ThreadPoolExecutor(max_workers=1)
+        else:
+            executor = ProcessPoolExecutor(max_workers=self.workers, initializer=_init_worker)
+        slots = asyncio.Semaphore(self.workers)
+        submitted = 0
+        try:
+            while not self._stop.is_set():
+                for path, detected in self.ready():
+                    if max_plates is not None and submitted >= max_plates:
+                        break
+                    layout = plate_layout(path)
+                    upstream = list(self._fitting) if layout in ('GER', None) else []
+                    task = asyncio.create_task(self._process(loop, executor, slots, path, detected, upstream))
+                    self._tasks.add(task)
+                    task.add_done_callback(self._tasks.discard)
+                    if layout == 'dilution':
+                        self._fitting.add(task)
+                        task.add_done_callback(self._fitting.discard)
+                    submitted += 1
+                if max_plates is not None and len(self.records) >= max_plates:
+                    break
+                if timeout is not None and time.time() - self._started >= timeout:
+                    break
+                try:
+                    await asyncio.wait_for(self._stop.wait(), self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+            if self._tasks:
+                await asyncio.gather(*self._tasks)
+        finally:
+            executor.shutdown(wait=True)
+        return self.metrics()
+
+    def metrics(self):
+        '''
+        One row per processed plate: REPORT_COLUMNS, times in epoch seconds and
+        Latency from first sight of the file to its results being written
+        '''
+        return pd.DataFrame(self.records, columns=REPORT_COLUMNS)
+
+    def summary(self):
+        '''
+        Plates, failures, throughput (plates per minute since run() started)
+        and mean, median and 95th percentile end-to-end latency in seconds
+        '''
+        records = self.metrics()
+        elapsed = (records['Finished'].max() if len(records) else time.time()) - (self._started or time.time())
+        latency = records['Latency'].to_numpy(dtype=float)
+        return {
+            'Plates': len(records),
+            'Failed': int((records['Status'] == 'failed').sum()),
+            'Plates per minute': float(len(records) / elapsed * 60) if elapsed > 0 else np.nan,
+            'Mean latency': float(latency.mean()) if len(latency) else np.nan,
+            'Median latency': float(np.median(latency)) if len(latency) else np.nan,
+            'P95 latency': float(np.percentile(latency, 95)) if len(latency) else np.nan,
+        }
+
+def watch(folder, output_dir, max_plates=None, timeout=None, **kwargs):
+    '''
+    Run a FolderWatcher (kwargs as FolderWatcher) until interrupted, max_plates
+    plates or timeout seconds; returns the watcher for its metrics and summary
+    '''
+    watcher = FolderWatcher(folder, output_dir, **kwargs)
+    try:
+        asyncio.run(watcher.run(max_plates=max_plates, timeout=timeout))
+    except KeyboardInterrupt:
+        pass
+    return watcher
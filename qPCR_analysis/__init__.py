@@ -1 +1 @@
-__all__ = ['Data_processing', 'Plotting', 'Statistics']
+__all__ = ['Data_processing', 'Plotting', 'Statistics', 'Cache', 'Pipeline', 'Amplification', 'Melt_curve', 'Analysis', 'Benchmark', 'Instrumentation', 'Command_line', 'Instruments', 'Plate', 'Efficiencies', 'Watch']
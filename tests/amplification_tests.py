@@ -0,0 +1,50 @@
+# +
+from qPCR_analysis import Amplification
+import numpy as np
+import pandas as pd
+import pytest
+
+CYCLES = np.arange(1, 46, dtype=float)
+
+def simulated_curves(midpoints, efficiency=90, noise=1.0, seed=0):
+    rng = np.random.default_rng(seed)
+    scale = 1 / np.log(1 + efficiency / 100)
+    curves = 100 + 0.5 * CYCLES + 5000 / (1 + np.exp(-(CYCLES - np.asarray(midpoints)[:, None]) / scale))
+    return curves + rng.normal(0, noise, curves.shape)
+
+def test_call_wells_orders_cts_and_estimates_efficiency():
+    midpoints = [29, 32, 35, 38]
+    fluorescence = simulated_curves(midpoints)
+    fluorescence = np.vstack([fluorescence, 100 + np.random.default_rng(1).normal(0, 1, len(CYCLES))])
+    calls = Amplification.call_wells(np.array(['A1', 'A2', 'A3', 'A4', 'NTC']), CYCLES, fluorescence)
+    cts = calls['Ct'].to_numpy()
+    # Equal amplitudes: a 3 cycle shift in midpoint is a 3 cycle shift in Ct
+    assert np.diff(cts[:4]) == pytest.approx([3, 3, 3], abs=0.1)
+    assert np.isnan(cts[4])
+    assert calls['Efficiency'][:4].to_numpy() == pytest.approx([90] * 4, abs=8)
+
+def test_curves_from_long_frame():
+    long_df = pd.DataFrame({
+        'Well': np.repeat(['A1', 'A2'], 3),
+        'Cycle': np.tile([3, 1, 2], 2),
+        'Fluorescence': [3.0, 1.0, 2.0, 30.0, 10.0, 20.0],
+    })
+    wells, cycles, fluorescence = Amplification.curves_from_frame(long_df)
+    assert list(wells) == ['A1', 'A2']
+    assert list(cycles) == [1, 2, 3]
+    assert fluorescence.tolist() == [[1, 2, 3], [10, 20, 30]]
+
+def test_sigmoid_fit_recovers_midpoint():
+    corrected = simulated_curves([25, 30])
+    fits = Amplification.sigmoid_fit(corrected, CYCLES)
+    assert fits['Midpoint'].to_numpy() == pytest.approx([25, 30], abs=0.2)
+
+def test_calls_to_tidy_aggregates_technical_replicates():
+    calls = pd.DataFrame({'Well': ['A1', 'A2', 'B1', 'B2'], 'Ct': [20.0, 21.0, 25.0, np.nan],
+                          'Efficiency': [90.0, 92.0, 95.0, np.nan]})
+    layout = pd.DataFrame({'Well': ['A1', 'A2', 'B1', 'B2'], 'Gene': ['GOI', 'GOI', 'Ref', 'Ref'],
+                           'Condition': ['Treated'] * 4, 'Replicate': [1] * 4})
+    tidy = Amplification.calls_to_tidy(calls, layout)
+    assert list(tidy['Ct_value']) == pytest.approx([20.5, 25.0])
+    assert list(tidy['n_wells']) == [2, 1]
+    assert list(tidy['Efficiency']) == pytest.approx([91, 95])
@@ -0,0 +1,72 @@
+# +
+from qPCR_analysis import Data_processing
+from qPCR_analysis.Analysis import Analysis
+import os
+import numpy as np
+import pandas as pd
+import pytest
+
+DATA_DIR = os.path.join(os.path.dirname(Data_processing.__file__), 'data')
+
+@pytest.fixture
+def plate():
+    rng = np.random.default_rng(0)
+    genes = ['Ref', 'A', 'B']
+    df = pd.DataFrame({
+        'Gene': np.repeat(genes, 6),
+        'Condition': np.tile(np.repeat(['Untreated', 'Treated'], 3), 3),
+        'Replicate': np.tile([1, 2, 3], 6),
+    })
+    for well in (1, 2, 3):
+        df[f'Ct{well}'] = rng.normal(22, 0.3, len(df))
+    df['Ct_value'] = df[['Ct1', 'Ct2', 'Ct3']].mean(axis=1)
+    return df
+
+EFFICIENCIES = {'Ref': 100, 'A': 95, 'B': 98}
+
+def test_pfaffl_matches_batch(plate):
+    analysis = Analysis(plate, EFFICIENCIES, 'Ref', 'Untreated')
+    expected = Data_processing.pfaffl_batch(plate, EFFICIENCIES, 'Ref', 'Untreated')
+    result = analysis.pfaffl()
+    assert result['Gene Expression Ratio'].to_numpy() == pytest.approx(expected['Gene Expression Ratio'].to_numpy())
+
+def test_exclude_recomputes_only_affected_gene(plate):
+    analysis = Analysis(plate, EFFICIENCIES, 'Ref', 'Untreated')
+    before = analysis.pfaffl()
+    gene_a = np.flatnonzero(analysis.wells['Gene'] == 'A')
+    analysis.exclude(gene_a[0])
+    after = analysis.pfaffl()
+    assert analysis.last_recomputed == ['A']
+    assert analysis.samples()['n_wells'].sum() == len(analysis.wells) - 1
+    unchanged = before['Gene'] == 'B'
+    pd.testing.assert_frame_equal(before[unchanged].reset_index(drop=True), after[unchanged].reset_index(drop=True))
+
+    analysis.include(gene_a[0])
+    pd.testing.assert_frame_equal(analysis.pfaffl(), before)
+
+def test_repeated_wells_are_counted_once(plate):
+    analysis = Analysis(plate, EFFICIENCIES, 'Ref', 'Untreated')
+    analysis.exclude([0, 0])
+    expected = Analysis(plate, EFFICIENCIES, 'Ref', 'Untreated').exclude(0)
+    pd.testing.assert_frame_equal(analysis.samples(), expected.samples())
+    assert analysis.samples()['n_wells'].iloc[0] == 2
+    analysis.update_ct([1, 1], [30.0, 25.0])
+    assert analysis.wells['Ct'].iloc[1] == 25.0
+    assert analysis.samples()['Ct_value'].iloc[0] == pytest.approx(25.0 / 2 + plate['Ct3'].iloc[0] / 2)
+
+def test_reference_change_recomputes_every_gene(plate):
+    analysis = Analysis(plate, EFFICIENCIES, 'Ref', 'Untreated')
+    analysis.pfaffl()
+    analysis.update_ct(0, 30.0)
+    analysis.pfaffl()
+    assert analysis.last_recomputed == ['A', 'B']
+
+def test_efficiency_tracks_excluded_wells():
+    dilution = Data_processing.import_and_tidy_data(os.path.join(DATA_DIR, 'dilution_testdata.csv'))
+    analysis = Analysis(dilution)
+    pd.testing.assert_frame_equal(analysis.efficiency(), Data_processing.primer_efficiency_batch(dilution))
+    analysis.exclude([0, 1])
+    wells = analysis.wells
+    expected = Data_processing.primer_efficiency_batch(
+        Data_processing.aggregate_technical_replicates(wells[~wells['Excluded']]))
+    pd.testing.assert_frame_equal(analysis.efficiency(), expected)
@@ -0,0 +1,38 @@
+# +
+from qPCR_analysis import Benchmark, Data_processing
+import numpy as np
+import pandas as pd
+import pytest
+
+@pytest.mark.parametrize('layout', ['GER', 'polysome', 'dilution'])
+def test_synthetic_plate_matches_layout(layout):
+    plate = Benchmark.synthetic_plate(layout, genes=5, conditions=3, technical=4)
+    assert Data_processing.detect_layout(plate.columns) == layout
+    assert Data_processing.ct_columns(plate.columns) == ['Ct1', 'Ct2', 'Ct3', 'Ct4']
+    assert plate['Gene'].nunique() == 5
+    assert len(plate) * 4 == 5 * Benchmark._wells_per_gene(layout, 3, 3, 4, 10, 5)
+
+def test_synthetic_plate_is_seeded():
+    pd.testing.assert_frame_equal(Benchmark.synthetic_plate(seed=3), Benchmark.synthetic_plate(seed=3))
+    assert not Benchmark.synthetic_plate(seed=3).equals(Benchmark.synthetic_plate(seed=4))
+
+def test_synthetic_dilution_efficiency_is_realistic():
+    plate = Benchmark.synthetic_plate('dilution', genes=20)
+    tidy = Data_processing._tidy_chunk(plate, Data_processing.ct_columns(plate.columns))
+    efficiency = Data_processing.primer_efficiency_batch(tidy)['Primer Efficiency']
+    assert efficiency.between(85, 110).all()
+
+def test_run_benchmarks_and_compare(tmp_path):
+    results = Benchmark.run_benchmarks([2000], ['pfaffl_batch', 'flag_outliers'], repeats=1, plates=2)
+    assert list(results['Stage']) == ['pfaffl_batch', 'flag_outliers']
+    assert (results['Wells'] >= 2000).all() and (results['Seconds'] > 0).all() and (results['Peak MB'] > 0).all()
+
+    path = tmp_path / 'baseline.json'
+    Benchmark.save_baseline(results, path)
+    slower = results.assign(Seconds=results['Seconds'] * [1.0, 2.0])
+    compared = Benchmark.compare(slower, Benchmark.load_baseline(path))
+    assert compared['Regression'].tolist() == [False, True]
+
+def test_run_benchmarks_rejects_unknown_stage():
+    with pytest.raises(ValueError):
+        Benchmark.run_benchmarks([100], ['not_a_stage'])
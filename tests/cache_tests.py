@@ -0,0 +1,80 @@
+# +
+from qPCR_analysis import Cache, Data_processing
+import os
+import time
+import pandas as pd
+import pytest
+
+pytest.importorskip('pyarrow')
+
+DATA_DIR = os.path.join(os.path.dirname(Data_processing.__file__), 'data')
+
+def test_import_and_tidy_data_uses_cache(tmp_path):
+    path = os.path.join(DATA_DIR, 'test_data.csv')
+    first = Data_processing.import_and_tidy_data(path, cache_dir=tmp_path)
+    assert len(list(tmp_path.glob('*.arrow'))) == 1
+    second = Data_processing.import_and_tidy_data(path, cache_dir=tmp_path)
+    pd.testing.assert_frame_equal(first, second)
+    # A miss returns the mapped frame too, so both behave alike
+    for frame in (first, second):
+        with pytest.raises(ValueError):
+            frame.loc[0, 'Ct_value'] = 1.0
+    edited = second.copy()
+    edited.loc[0, 'Ct_value'] = 1.0
+
+def test_cache_key_changes_with_file_contents(tmp_path):
+    path = tmp_path / 'plate.csv'
+    path.write_text('Gene,Condition,Replicate,Ct1\nGOI,Treated,1,20\n')
+    before = Cache.cache_key(path)
+    path.write_text('Gene,Condition,Replicate,Ct1\nGOI,Treated,1,21\n')
+    assert Cache.cache_key(path) != before
+
+def test_evict_removes_oldest_entries_first(tmp_path):
+    frame = pd.DataFrame({'Ct_value': [1.0] * 100})
+    for i, name in enumerate(['old', 'new']):
+        Cache.write_frame(frame, tmp_path / f'{name}.arrow')
+        os.utime(tmp_path / f'{name}.arrow', (time.time() + i, time.time() + i))
+    size = os.path.getsize(tmp_path / 'new.arrow')
+    removed = Cache.evict(tmp_path, max_bytes=size)
+    assert [os.path.basename(p) for p in removed] == ['old.arrow']
+
+def test_read_frame_maps_numeric_columns_without_copying(tmp_path):
+    frame = pd.DataFrame({'Gene': ['GOI', 'Control'] * 500, 'Ct_value': range(1000)}).astype({'Ct_value': float})
+    Cache.write_frame(frame, tmp_path / 'frame.arrow')
+    read = Cache.read_frame(tmp_path / 'frame.arrow')
+    pd.testing.assert_frame_equal(read, frame)
+    # A view of the mapped file, not a private copy
+    assert not read['Ct_value'].to_numpy().flags.writeable
+
+def test_cached_applies_default_limits(tmp_path, monkeypatch):
+    builder = lambda path: pd.read_csv(path)
+    for i, name in enumerate(['a', 'b']):
+        (tmp_path / f'{name}.csv').write_text(f'Ct_value\n{20 + i}\n')
+    Cache.cached(tmp_path / 'a.csv', builder, tmp_path / 'cache')
+    (old,) = (tmp_path / 'cache').glob('*.arrow')
+    os.utime(old, (time.time() - 7200, time.time() - 7200))
+    monkeypatch.setattr(Cache, 'MAX_CACHE_AGE', 3600)
+    Cache.cached(tmp_path / 'b.csv', builder, tmp_path / 'cache')
+    assert not old.exists() and len(list((tmp_path / 'cache').glob('*.arrow'))) == 1
+    monkeypatch.setattr(Cache, 'MAX_CACHE_BYTES', 0)
+    Cache.cached(tmp_path / 'a.csv', builder, tmp_path / 'cache')
+    assert list((tmp_path / 'cache').glob('*.arrow')) == []
+
+def test_evict_tolerates_concurrent_removal_and_clears_stale_temp_files(tmp_path, monkeypatch):
+    frame = pd.DataFrame({'Ct_value': [1.0] * 100})
+    for name in ['a.arrow', 'b.arrow', 'c.arrow.123.tmp', 'd.arrow.456.tmp']:
+        Cache.write_frame(frame, tmp_path / 'frame.arrow')
+        os.replace(tmp_path / 'frame.arrow', tmp_path / name)
+    old = time.time() - 2 * Cache.TMP_MAX_AGE
+    os.utime(tmp_path / 'a.arrow', (old, old))
+    os.utime(tmp_path / 'c.arrow.123.tmp', (old, old))
+    # Another process evicts a.arrow between this one listing and removing it
+    remove = os.remove
+    def racing_remove(path):
+        if str(path).endswith('a.arrow'):
+            remove(path)
+        remove(path)
+    monkeypatch.setattr(os, 'remove', racing_remove)
+    removed = Cache.evict(tmp_path, max_age=Cache.TMP_MAX_AGE)
+    assert [os.path.basename(p) for p in removed] == ['c.arrow.123.tmp']
+    assert sorted(os.listdir(tmp_path)) == ['b.arrow', 'd.arrow.456.tmp']
@@ -0,0 +1,68 @@
+# +
+from qPCR_analysis import Command_line, Data_processing
+import io
+import os
+import subprocess
+import sys
+import pandas as pd
+import pytest
+
+DATA_DIR = os.path.join(os.path.dirname(Data_processing.__file__), 'data')
+
+def test_import_writes_tidy_csv(tmp_path):
+    out = tmp_path / 'tidy.csv'
+    assert Command_line.main(['import', os.path.join(DATA_DIR, 'test_data.csv'), '--qc', 'median', '-o', str(out)]) == 0
+    tidy = pd.read_csv(out)
+    assert {'Ct_value', 'SEM', 'Outlier mask'} <= set(tidy.columns)
+
+def test_efficiency_table_feeds_pfaffl(tmp_path, capsys):
+    efficiency = tmp_path / 'efficiency.csv'
+    Command_line.main(['efficiency', os.path.join(DATA_DIR, 'dilution_testdata.csv'), '-o', str(efficiency)])
+    capsys.readouterr()
+    Command_line.main(['pfaffl', os.path.join(DATA_DIR, 'test_data.csv'), '-r', 'Control', '-c', 'Untreated',
+                       '-e', 'Control=100', '--efficiency-table', str(efficiency), '--summary'])
+    summary = pd.read_csv(io.StringIO(capsys.readouterr().out))
+    assert list(summary['Condition']) == ['Treated', 'Untreated']
+
+def test_pfaffl_requires_reference():
+    with pytest.raises(SystemExit):
+        Command_line.main(['pfaffl', os.path.join(DATA_DIR, 'test_data.csv')])
+
+def test_plot_writes_figures(tmp_path):
+    Command_line.main(['plot', os.path.join(DATA_DIR, 'polysome_profile_testdata.csv'), '-o', str(tmp_path), '-w', '1'])
+    assert sorted(os.listdir(tmp_path)) == ['GOI_Treated_fractions.png', 'GOI_Untreated_fractions.png']
+
+def text_export(df, path, sample):
+    '''
+    Write a wide Ct frame as a QuantStudio-style results table, one well per
+    Ct, with sample(row) as the sample name
+    '''
+    lines = ['[Results]', 'Well Position\tSample Name\tTarget Name\tCT']
+    for _, row in df.iterrows():
+        for ct in row[Data_processing.ct_columns(df.columns)]:
+            lines.append(f'A{len(lines) - 1}\t{sample(row)}\t{row["Gene"]}\t{ct}')
+    path.write_text('\n'.join(lines) + '\n')
+    return str(path)
+
+def test_plot_reads_exports(tmp_path):
+    polysome = pd.read_csv(os.path.join(DATA_DIR, 'polysome_profile_testdata.csv'), encoding='utf-8-sig')
+    sample = lambda row: f'{row["Condition"]} fraction {row["Fraction"]}'
+    export = text_export(polysome, tmp_path / 'polysome.txt', sample)
+    layout = polysome[['Condition', 'Fraction']].drop_duplicates()
+    layout.insert(0, 'Sample', layout.apply(sample, axis=1))
+    layout.to_csv(tmp_path / 'layout.csv', index=False)
+    Command_line.main(['plot', export, '--layout', str(tmp_path / 'layout.csv'), '-o', str(tmp_path / 'polysome'),
+                       '-w', '1'])
+    assert sorted(os.listdir(tmp_path / 'polysome')) == ['GOI_Treated_fractions.png', 'GOI_Untreated_fractions.png']
+
+    ger = pd.read_csv(os.path.join(DATA_DIR, 'test_data.csv'), encoding='utf-8-sig')
+    export = text_export(ger, tmp_path / 'ger.txt', lambda row: f'{row["Condition"]} {row["Replicate"]}')
+    Command_line.main(['plot', export, '-r', 'Control', '-c', 'Untreated', '-e', 'Control=100', '-e', 'GOI=100',
+                       '-o', str(tmp_path / 'ger'), '-w', '1'])
+    assert os.listdir(tmp_path / 'ger') == ['GOI_expression_ratio.png']
+
+def test_non_plotting_commands_skip_heavy_imports():
+    code = ('import sys; from qPCR_analysis import Command_line; '
+            f"Command_line.main(['polysome', {os.path.join(DATA_DIR, 'polysome_profile_testdata.csv')!r}, '-o', {os.devnull!r}]); "
+            "print(sorted(m for m in ('matplotlib', 'scipy.stats') if m in sys.modules))")
+    assert subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True).stdout.strip() == '[]'
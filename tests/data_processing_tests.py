@@ -1,7 +1,12 @@
 # +
 from qPCR_analysis import Data_processing
+import os
+import numpy as np
+import pandas as pd
 import pytest 
 
+DATA_DIR = os.path.join(os.path.dirname(Data_processing.__file__), 'data')
+
 def test_primer_efficiency_calc():
     assert Data_processing.primer_effiency_calc(-3.754) == pytest.approx(84.66, 0.01), "Primer efficiency calculation with a slope of -3.754 should equal 84.66 " 
 
@@ -9,16 +14,233 @@ def test_delta_Ct():
     assert Data_processing.delta_Ct(19,18) == pytest.approx(1), "delta_Ct calculation with a Ct of 19 and 18 should be 1" 
     
 def test_pfaffl_calc():
-    assert Data_processing.pfaffl_calc(100, 2, 5, 2) == pytest.approx(400), "pfaffl_calc with efficiency of 100 and 5 and delta ct of 2 and 2 should be 400"
+    assert Data_processing.pfaffl_calc(2, 2, 100, 5) == pytest.approx(4 / 1.05 ** 2), "pfaffl_calc with delta cts of 2 and 2 and efficiencies of 100 and 5 should be 2**2 / 1.05**2"
 
-def test_calculate_polysome_diff(reference_cts, cts):
-    assert Data_processing.delta_Ct(19,18) == pytest.approx(1), "test_calculate_polysome_diff calculation with a Ct of 19 and 18 should be 1" 
+def test_calculate_polysome_diff():
+    assert Data_processing.calculate_polysome_diff(19, 18) == pytest.approx(1), "calculate_polysome_diff with a reference Ct of 19 and a Ct of 18 should be 1"
     
-def test_calculate_2_delta_ct_polysome(delta_ct):
+def test_calculate_2_delta_ct_polysome():
     assert Data_processing.calculate_2_delta_ct_polysome(2) == pytest.approx(4)
 
-def test_calculate_percentages(total, column):
-    df = pd.Data
-    assert Data_processing.calculate_percentages(
-    
-    return (column * 100) / total if total != 0 else 0
+def test_calculate_percentages():
+    df = pd.DataFrame({'2DeltaCt': [1.0, 3.0]})
+    assert Data_processing.calculate_percentages(df['2DeltaCt'].sum(), df['2DeltaCt']).tolist() == pytest.approx([25, 75])
+    assert Data_processing.calculate_percentages(0, 5) == 0
+
+
+def test_pfaffl_batch_control_condition_is_calibrator():
+    df = Data_processing.import_and_tidy_data(os.path.join(DATA_DIR, 'test_data.csv'))
+    result = Data_processing.pfaffl_batch(df, {'GOI': 100, 'Control': 100}, 'Control', 'Untreated')
+    assert list(result['Gene'].unique()) == ['GOI']
+    assert len(result) == 6
+    untreated = result[result['Condition'] == 'Untreated']
+    # Log ratios of the calibrator condition average to zero
+    assert np.log2(untreated['Gene Expression Ratio']).mean() == pytest.approx(0)
+
+def test_pfaffl_batch_multiple_reference_genes():
+    df = pd.DataFrame({
+        'Gene': ['GOI', 'GOI', 'RefA', 'RefA', 'RefB', 'RefB'],
+        'Condition': ['Untreated', 'Treated'] * 3,
+        'Replicate': [1] * 6,
+        'Ct_value': [20.0, 18.0, 15.0, 16.0, 15.0, 14.0],
+    })
+    result = Data_processing.pfaffl_batch(df, {'GOI': 100, 'RefA': 100, 'RefB': 100}, ['RefA', 'RefB'], 'Untreated')
+    treated = result[result['Condition'] == 'Treated']['Gene Expression Ratio'].iloc[0]
+    # Reference shifts of -1 and +1 cancel in the geometric mean, leaving 2**2
+    assert treated == pytest.approx(4)
+
+
+def test_primer_efficiency_batch_matches_single_gene_fit():
+    df = Data_processing.import_and_tidy_data(os.path.join(DATA_DIR, 'dilution_testdata.csv'))
+    shifted = df.assign(Gene='GOI2', Ct_value=df['Ct_value'] + 2)
+    both = pd.concat([df, shifted], ignore_index=True)
+    batch = Data_processing.primer_efficiency_batch(both)
+    single = Data_processing.primer_efficiency(df.copy(), 'GOI')
+    assert list(batch['Gene']) == ['GOI', 'GOI2']
+    assert 'log_dilution' not in both.columns
+    for column in ['Slope', 'Intercept', 'Error', 'R', 'p_value', 'Primer Efficiency']:
+        assert batch[column].iloc[0] == pytest.approx(single[column].iloc[0])
+    assert batch['Intercept'].iloc[1] == pytest.approx(single['Intercept'].iloc[0] + 2)
+
+def test_import_and_tidy_data_chunked_matches_full_import():
+    path = os.path.join(DATA_DIR, 'polysome_profile_testdata.csv')
+    full = Data_processing.import_and_tidy_data(path)
+    chunked = Data_processing.import_and_tidy_data_chunked(path, chunksize=5)
+    assert list(chunked.columns) == list(full.columns)
+    assert isinstance(chunked['Condition'].dtype, pd.CategoricalDtype)
+    assert chunked['Ct1'].dtype == np.float32
+    assert np.allclose(chunked['Ct_value'], full['Ct_value'], atol=1e-4)
+
+def test_iter_tidy_chunks_reads_undetermined_as_nan(tmp_path):
+    path = tmp_path / 'plate.csv'
+    path.write_text('Gene,Condition,Replicate,Ct1,Ct2,Ct3\nGOI,Treated,1,20,Undetermined,22\n')
+    chunk = next(Data_processing.iter_tidy_chunks(path))
+    assert chunk['Ct_value'].iloc[0] == pytest.approx(21)
+
+def test_detect_layout_rejects_unknown_header(tmp_path):
+    assert Data_processing.detect_layout(['Gene', 'Dilution', 'Ct1', 'Ct2']) == 'dilution'
+    with pytest.raises(ValueError):
+        Data_processing.detect_layout(['Gene', 'Sample', 'Ct1'])
+    bad = tmp_path / 'bad.csv'
+    bad.write_text('Gene,Sample,Value\nGOI,A,20\n')
+    with pytest.raises(ValueError, match='No Ct replicate columns'):
+        Data_processing.import_and_tidy_data(bad)
+    # Long and tidied frames have no Ct1, Ct2, ... columns
+    assert Data_processing.frame_layout(['Gene', 'Fraction', 'Condition', 'Ct']) == 'polysome'
+    assert Data_processing.frame_layout(['Gene', 'Condition', 'Replicate', 'Ct_value', 'SEM']) == 'GER'
+    with pytest.raises(ValueError):
+        Data_processing.frame_layout(['Gene', 'Condition', 'Replicate'])
+
+def test_long_format_round_trip_with_missing_wells():
+    df = pd.DataFrame({
+        'Gene': ['GOI', 'GOI'], 'Condition': ['Treated', 'Untreated'], 'Replicate': [1, 1],
+        'Ct1': [20.0, 25.0], 'Ct2': ['Undetermined', 25.5], 'Ct3': [21.0, 26.0], 'Ct4': [22.0, None],
+    })
+    long_df = Data_processing.to_long_format(df)
+    assert len(long_df) == 8
+    assert list(long_df['Technical_replicate'][:4]) == [1, 2, 3, 4]
+    tidy = Data_processing.aggregate_technical_replicates(long_df)
+    assert list(tidy['n_wells']) == [3, 3]
+    assert list(tidy['Ct_value']) == pytest.approx([21.0, 25.5])
+
+def test_polysome_profiling_analysis_any_replicate_count():
+    df = pd.DataFrame({
+        'Gene': ['GOI'] * 3, 'Fraction': [1, 2, 3], 'Condition': ['Treated'] * 3,
+        'Ct1': [20.0, 19.0, 20.0], 'Ct2': [20.0, 19.0, 20.0],
+        'Ct3': [20.0, 19.0, 20.0], 'Ct4': [20.0, 19.0, 20.0],
+    })
+    result = Data_processing.polysome_profiling_analysis(df, 'GOI', 'Treated')
+    assert 'Percent in fraction R4' in result.columns
+    assert list(result['Average Percent in Fraction']) == pytest.approx([25, 50, 25])
+    assert result[[f'Percent in fraction R{r}' for r in range(1, 5)]].sum().tolist() == pytest.approx([100] * 4)
+
+def test_polysome_profiling_skips_outlier_wells():
+    df = pd.DataFrame({
+        'Gene': ['GOI'] * 3, 'Fraction': [1, 2, 3], 'Condition': ['Treated'] * 3,
+        'Ct1': [20.0, 19.0, 20.0], 'Ct2': [20.0, 19.0, 20.0], 'Ct3': [20.0, 25.0, 20.0],
+        'Ct4': [20.0, 19.0, 20.0],
+    })
+    flagged = Data_processing.flag_outliers(df)
+    assert Data_processing.to_long_format(flagged)['Outlier'].sum() == 1
+
+    batch = Data_processing.polysome_profiling_batch(flagged)
+    replicate_3 = batch[batch['Replicate'] == 3]
+    assert replicate_3['Fraction'].tolist() == [1, 3]
+    assert replicate_3['Percent in fraction'].tolist() == pytest.approx([50, 50])
+
+    single = Data_processing.polysome_profiling_analysis(flagged, 'GOI', 'Treated')
+    assert np.isnan(single['Percent in fraction R3'].iloc[1])
+    assert single['Percent in fraction R3'].sum() == pytest.approx(100)
+    assert single['Average Percent in Fraction'].tolist() == pytest.approx([31.25, 50, 31.25])
+
+def test_polysome_profiling_without_baseline_ct():
+    df = pd.DataFrame({
+        'Gene': ['GOI'] * 3, 'Fraction': [1, 2, 3], 'Condition': ['Treated'] * 3,
+        'Ct1': [np.nan, 19.0, 20.0], 'Ct2': [20.0, 19.0, 20.0],
+    })
+    batch = Data_processing.polysome_profiling_batch(df)
+    assert batch[batch['Replicate'] == 1]['Percent in fraction'].isna().all()
+    summary = Data_processing.summarize_polysome(batch)
+    assert summary['Average Percent in Fraction'].tolist() == pytest.approx([25, 50, 25])
+
+    single = Data_processing.polysome_profiling_analysis(df, 'GOI', 'Treated')
+    assert single['Percent in fraction R1'].isna().all()
+    assert single['Average Percent in Fraction'].tolist() == pytest.approx([25, 50, 25])
+
+def test_polysome_profiling_batch_matches_single_analysis():
+    df = Data_processing.import_and_tidy_data(os.path.join(DATA_DIR, 'polysome_profile_testdata.csv'))
+    batch = Data_processing.polysome_profiling_batch(df)
+    assert len(batch) == 24 * 3
+    summary = Data_processing.summarize_polysome(batch)
+    for condition in ['Treated', 'Untreated']:
+        single = Data_processing.polysome_profiling_analysis(df, 'GOI', condition, 3)
+        batched = summary[summary['Condition'] == condition].reset_index(drop=True)
+        assert np.allclose(batched['Average Percent in Fraction'], single['Average Percent in Fraction'])
+        assert np.allclose(batched['SEM Percent in Fraction'], single['SEM Percent in Fraction'])
+
+def test_normalization_factors_geometric_mean():
+    df = pd.DataFrame({
+        'Gene': ['RefA', 'RefA', 'RefB', 'RefB'],
+        'Condition': ['Untreated', 'Treated'] * 2,
+        'Replicate': [1] * 4,
+        'Ct_value': [15.0, 14.0, 15.0, 13.0],
+    })
+    factors = Data_processing.normalization_factors(df, {'RefA': 100, 'RefB': 100}, ['RefA', 'RefB'], 'Untreated')
+    treated = factors.loc[factors['Condition'] == 'Treated', 'Normalization Factor'].iloc[0]
+    assert treated == pytest.approx(np.sqrt(2 * 4))
+
+def test_absolute_quantification_inverts_standard_curve():
+    standards = pd.DataFrame({
+        'Gene': ['GOI'] * 5 + ['Ref'] * 5,
+        'Dilution': [1e2, 1e3, 1e4, 1e5, 1e6] * 2,
+        'Ct_value': [31.0, 27.7, 24.3, 21.0, 17.6, 30.0, 26.6, 23.3, 20.0, 16.6],
+    })
+    unknowns = pd.DataFrame({'Gene': ['GOI', 'Ref'], 'Ct_value': [24.3, 26.6]})
+    result = Data_processing.absolute_quantification(standards, unknowns)
+    assert result['Quantity'].to_numpy() == pytest.approx([1e4, 1e3], rel=0.05)
+    assert (result['PI low'] < result['Quantity']).all() and (result['Quantity'] < result['PI high']).all()
+    assert 'Quantity' not in unknowns.columns
+
+def test_absolute_quantification_requires_standards_for_every_gene():
+    standards = pd.DataFrame({'Gene': ['GOI'] * 3, 'Dilution': [1, 10, 100], 'Ct_value': [30.0, 26.7, 23.4]})
+    with pytest.raises(ValueError):
+        Data_processing.absolute_quantification(standards, pd.DataFrame({'Gene': ['Other'], 'Ct_value': [25.0]}))
+
+OUTLIER_CTS = np.array([
+    [20.0, 20.1, 23.0],     # third well 3 cycles off
+    [20.0, 20.2, 20.1],     # clean
+    [20.0, np.nan, 25.0],   # only two wells, cannot tell which is off
+    [np.nan, np.nan, np.nan],
+])
+
+@pytest.mark.parametrize('method', ['median', 'spread'])
+def test_outlier_mask_flags_single_well(method):
+    mask = Data_processing.outlier_mask(OUTLIER_CTS, method)
+    assert mask.tolist() == [[False, False, True]] + [[False] * 3] * 3
+
+def test_outlier_mask_grubbs():
+    cts = np.array([[20.0, 20.1, 19.9, 20.05, 23.0], [20.0, 20.1, 19.9, 20.05, 20.2]])
+    assert Data_processing.outlier_mask(cts, 'grubbs').tolist() == [[False] * 4 + [True], [False] * 5]
+
+def test_flag_outliers_masks_wells_downstream():
+    df = pd.DataFrame({'Gene': ['A'] * 4, 'Condition': ['Untreated'] * 4, 'Replicate': [1, 2, 3, 4]})
+    df[['Ct1', 'Ct2', 'Ct3']] = OUTLIER_CTS
+    flagged = Data_processing.flag_outliers(df)
+    assert flagged['Outlier mask'].tolist() == [4, 0, 0, 0]
+    assert flagged['Ct_value'].iloc[0] == pytest.approx(20.05)
+    assert 'Outlier mask' not in df.columns
+
+    tidy = Data_processing.aggregate_technical_replicates(Data_processing.to_long_format(flagged))
+    assert tidy['Ct_value'].to_numpy() == pytest.approx(flagged['Ct_value'].to_numpy(), nan_ok=True)
+    assert tidy['n_wells'].tolist() == [2, 3, 2, 0]
+
+def test_select_rows_matches_boolean_masks():
+    df = pd.DataFrame({'Gene': ['A', 'B', 'A', 'B', 'A', 'C'],
+                       'Condition': ['T', 'T', 'U', 'U', 'T', pd.NA],
+                       'Ct_value': np.arange(6.0)})
+    expected = df[(df['Gene'] == 'A') & (df['Condition'] == 'T')]
+    index = Data_processing.group_index(df, ('Gene', 'Condition'))
+    pd.testing.assert_frame_equal(Data_processing.select_rows(df, Condition='T', Gene='A'), expected)
+    pd.testing.assert_frame_equal(Data_processing.select_rows(df, index, Condition='T', Gene='A'), expected)
+    gene_index = Data_processing.group_index(df, ('Gene',))
+    assert Data_processing.select_rows(df, gene_index, Gene='B').index.tolist() == [1, 3]
+    assert Data_processing.select_rows(df, gene_index, Gene='D').empty
+    assert Data_processing.select_rows(df, Condition=pd.NA).index.tolist() == [5]
+    with pytest.raises(ValueError):
+        Data_processing.select_rows(df, gene_index, Condition='T')
+
+def test_lookups_follow_frames_changed_in_place():
+    df = pd.read_csv(os.path.join(DATA_DIR, 'polysome_profile_testdata.csv'), encoding='utf-8-sig')
+    before = Data_processing.polysome_profiling_analysis(df, 'GOI', 'Treated')
+    df.sort_values(['Condition', 'Fraction'], ascending=[False, True], inplace=True, ignore_index=True)
+    pd.testing.assert_frame_equal(Data_processing.polysome_profiling_analysis(df, 'GOI', 'Treated'), before)
+    df.loc[df['Condition'] == 'Treated', 'Gene'] = 'Other'
+    assert Data_processing.polysome_profiling_analysis(df, 'GOI', 'Treated').empty
+
+def test_pfaffl_does_not_modify_input():
+    df = pd.DataFrame({'Gene': np.repeat(['GOI', 'Ref'], 6), 'Condition': np.tile(np.repeat(['U', 'T'], 3), 2),
+                       'Replicate': np.tile([1, 2, 3], 4), 'Ct_value': [20, 20.2, 19.8, 21, 21.2, 20.8] + [18] * 6})
+    before = df.copy()
+    result = Data_processing.pfaffl('GOI', 'Ref', 'T', 'U', 100, 100, df)
+    pd.testing.assert_frame_equal(df, before)
+    assert result['Condition'].tolist() == ['U', 'T']
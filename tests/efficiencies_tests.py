@@ -0,0 +1,68 @@
+# +
+from qPCR_analysis import Benchmark, Command_line, Data_processing, Efficiencies
+import pandas as pd
+import pytest
+
+@pytest.fixture
+def registry(tmp_path, monkeypatch):
+    monkeypatch.setenv('QPCR_EFFICIENCY_DIR', str(tmp_path / 'registry'))
+    Efficiencies.clear_memory()
+    yield tmp_path / 'registry'
+    Efficiencies.clear_memory()
+
+@pytest.fixture
+def fits(monkeypatch):
+    calls = []
+    batch = Data_processing.primer_efficiency_batch
+    def counted(df, *args, **kwargs):
+        calls.append(len(df))
+        return batch(df, *args, **kwargs)
+    monkeypatch.setattr(Data_processing, 'primer_efficiency_batch', counted)
+    return calls
+
+def dilution_csv(path, seed=0):
+    Benchmark.synthetic_plate('dilution', genes=3, seed=seed).to_csv(path, index=False)
+    return path
+
+def test_fit_is_memoized_in_memory_and_on_disk(registry, tmp_path, fits):
+    path = dilution_csv(tmp_path / 'dilution.csv')
+    first = Efficiencies.fit(path)
+    Efficiencies.fit(path)
+    assert len(fits) == 1
+    Efficiencies.clear_memory()
+    pd.testing.assert_frame_equal(Efficiencies.fit(path), first)
+    assert len(fits) == 1
+    # Changed data or another primer lot is a new fit
+    dilution_csv(path, seed=1)
+    Efficiencies.fit(path)
+    Efficiencies.fit(path, lot='B')
+    assert len(fits) == 3
+    assert len(list(registry.glob('*.json'))) == 3
+
+def test_lookup_prefers_latest_fit_of_lot(registry, tmp_path):
+    first = Efficiencies.fit(dilution_csv(tmp_path / 'a.csv'), lot='A')
+    second = Efficiencies.fit(dilution_csv(tmp_path / 'b.csv', seed=1), lot='B')
+    gene = first['Gene'].iloc[0]
+    assert Efficiencies.lookup([gene])[gene] == pytest.approx(second['Primer Efficiency'].iloc[0])
+    assert Efficiencies.lookup([gene], lot='A')[gene] == pytest.approx(first['Primer Efficiency'].iloc[0])
+    assert Efficiencies.lookup(['Missing']) == {}
+    assert set(Efficiencies.registered()['Lot']) == {'A', 'B'}
+
+def test_pfaffl_resolves_registered_efficiencies(registry, tmp_path):
+    fitted = Efficiencies.fit(dilution_csv(tmp_path / 'dilution.csv'))
+    ger = Benchmark.synthetic_plate('GER', genes=3)
+    ger = Data_processing._tidy_chunk(ger, Data_processing.ct_columns(ger.columns))
+    expected = Data_processing.pfaffl_batch(ger, fitted, 'Ref1', 'Untreated')
+    pd.testing.assert_frame_equal(Data_processing.pfaffl_batch(ger, None, 'Ref1', 'Untreated'), expected)
+    # Given efficiencies take precedence over registered ones
+    partial = Data_processing.pfaffl_batch(ger, {'Ref1': 90.0}, 'Ref1', 'Untreated')
+    assert not partial['Gene Expression Ratio'].equals(expected['Gene Expression Ratio'])
+    with pytest.raises(ValueError, match='No primer efficiency'):
+        Data_processing.pfaffl_batch(ger, None, 'Ref1', 'Untreated', lot='other')
+
+def test_command_line_registers_fit(registry, tmp_path, fits):
+    path = str(dilution_csv(tmp_path / 'dilution.csv'))
+    for _ in range(2):
+        assert Command_line.main(['efficiency', path, '--register', '--lot', 'L1', '-o', str(tmp_path / 'e.csv')]) == 0
+    assert len(fits) == 1
+    assert set(Efficiencies.registered()['Lot']) == {'L1'}
@@ -0,0 +1,51 @@
+# +
+from qPCR_analysis import Data_processing, Instrumentation
+import json
+import os
+import pytest
+
+DATA_DIR = os.path.join(os.path.dirname(Data_processing.__file__), 'data')
+
+@pytest.fixture(autouse=True)
+def clean_registry():
+    Instrumentation.reset()
+    yield
+    Instrumentation.disable()
+    Instrumentation.reset()
+
+def test_disabled_functions_are_untouched():
+    original = Data_processing.pfaffl_batch
+    with Instrumentation.instrumented():
+        assert Data_processing.pfaffl_batch is not original
+        assert Data_processing.pfaffl_batch.__wrapped__ is original
+    assert Data_processing.pfaffl_batch is original
+    Data_processing.import_and_tidy_data(os.path.join(DATA_DIR, 'test_data.csv'))
+    assert Instrumentation.records().empty
+
+def test_records_time_rows_and_memory():
+    with Instrumentation.instrumented():
+        df = Data_processing.import_and_tidy_data(os.path.join(DATA_DIR, 'test_data.csv'))
+        Data_processing.pfaffl_batch(df, {'GOI': 95, 'Control': 98}, 'Control', 'Untreated')
+    calls = Instrumentation.records().set_index('Stage')
+    pfaffl = calls.loc['Data_processing.pfaffl_batch']
+    assert pfaffl['Rows in'] == len(df) and pfaffl['Rows out'] == 6
+    assert pfaffl['Seconds'] > 0 and pfaffl['Peak MB'] > 0 and pfaffl['Depth'] == 0
+    assert (calls.loc['Data_processing.ct_columns', 'Depth'] >= 1).all()
+    assert Instrumentation.summary()['Stage'].is_unique
+
+def test_failed_calls_are_recorded():
+    with Instrumentation.instrumented(memory=False):
+        with pytest.raises(ValueError):
+            Data_processing.detect_layout(['Sample', 'Value'])
+    calls = Instrumentation.records().set_index('Stage')
+    assert calls.loc['Data_processing.detect_layout', 'Error'] == 'ValueError'
+    assert calls['Peak MB'].isna().all()
+
+def test_export_and_profile(tmp_path):
+    with Instrumentation.instrumented(profile=True):
+        Data_processing.import_and_tidy_data(os.path.join(DATA_DIR, 'test_data.csv'))
+    Instrumentation.export(tmp_path / 'calls.json')
+    with open(tmp_path / 'calls.json') as handle:
+        stages = [record['Stage'] for record in json.load(handle)]
+    assert 'Data_processing.import_and_tidy_data' in stages
+    assert '_tidy_chunk' in Instrumentation.profile_report('Data_processing.import_and_tidy_data')
@@ -0,0 +1,150 @@
+# +
+from qPCR_analysis import Data_processing, Instruments
+import time
+import zipfile
+import numpy as np
+import pandas as pd
+import pytest
+
+GENES = ['Control', 'GOI']
+CONDITIONS = ['Untreated', 'Treated']
+
+def plate_wells(n_wells=384):
+    '''
+    Gene, sample and Ct of every well: 2 genes x 2 conditions x biological
+    replicates, in technical triplicate, with the last well a no-template control
+    '''
+    rng = np.random.default_rng(0)
+    wells = []
+    for i in range(n_wells - 1):
+        gene = GENES[i % 2]
+        sample = i // 6
+        condition, replicate = CONDITIONS[sample % 2], sample // 2 + 1
+        wells.append((gene, f'{condition} {replicate}', 'UNKNOWN', 20 + 3 * (gene == 'GOI') + rng.normal(0, 0.1)))
+    wells.append(('GOI', 'NTC', 'NTC', np.nan))
+    return wells
+
+def write_rdml(path, wells, columns=24, annotate=False):
+    samples = sorted({sample for _, sample, _, _ in wells})
+    parts = ['<?xml version="1.0" encoding="UTF-8"?>', '<rdml version="1.2" xmlns="http://www.rdml.org">']
+    for sample in samples:
+        kind = 'ntc' if sample == 'NTC' else 'unkn'
+        annotation = ''
+        if annotate and sample != 'NTC':
+            condition, replicate = sample.split()
+            annotation = (f'<annotation><property>Condition</property><value>{condition[:3]}</value></annotation>'
+                          f'<annotation><property>Replicate</property><value>{replicate}</value></annotation>')
+        parts.append(f'<sample id="{sample}"><type>{kind}</type>{annotation}</sample>')
+    parts += [f'<target id="{gene}"><type>toi</type></target>' for gene in GENES]
+    parts.append(f'<experiment id="exp"><run id="run"><pcrFormat><rows>16</rows><columns>{columns}</columns></pcrFormat>')
+    for i, (gene, sample, _, ct) in enumerate(wells, start=1):
+        cq = '' if np.isnan(ct) else f'<cq>{ct:.3f}</cq>'
+        excl = '<excl>pipetting</excl>' if i == 1 else ''
+        parts.append(f'<react id="{i}"><sample id="{sample}"/><data><tar id="{gene}"/>{cq}{excl}</data></react>')
+    parts.append('</run></experiment></rdml>')
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as archive:
+        archive.writestr('rdml_data.xml', '\n'.join(parts))
+
+def test_read_rdml_maps_samples_and_excludes_controls(tmp_path):
+    path = tmp_path / 'run.rdml'
+    write_rdml(path, plate_wells())
+    start = time.perf_counter()
+    wells = Instruments.read_rdml(path)
+    assert time.perf_counter() - start < 0.5
+    assert len(wells) == 383
+    assert list(wells.columns) == ['Well', 'Sample', 'Gene', 'Condition', 'Replicate', 'Technical_replicate', 'Ct', 'Outlier']
+    assert list(wells['Well'][[0, 23, 24]]) == ['A1', 'A24', 'B1']
+    assert wells['Outlier'].sum() == 1
+    assert set(wells['Condition']) == set(CONDITIONS) and wells['Replicate'].max() == 32
+    assert wells['Technical_replicate'].max() == 3
+
+    tidy = Instruments.read_export(path, tidy=True)
+    ratios = Data_processing.pfaffl_batch(tidy, {'Control': 100, 'GOI': 100}, 'Control', 'Untreated')
+    assert ratios['Gene Expression Ratio'].to_numpy() == pytest.approx(1, rel=0.2)
+
+def test_read_rdml_closes_the_archive(tmp_path, monkeypatch):
+    path = tmp_path / 'run.rdml'
+    write_rdml(path, plate_wells(24), columns=12)
+    opened = []
+    class TrackedZipFile(zipfile.ZipFile):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            opened.append(self)
+    monkeypatch.setattr(zipfile, 'ZipFile', TrackedZipFile)
+    Instruments.read_rdml(path)
+    assert len(opened) == 1 and opened[0].fp is None
+
+def test_read_rdml_uses_sample_annotations(tmp_path):
+    path = tmp_path / 'run.rdml'
+    write_rdml(path, plate_wells(24), columns=12, annotate=True)
+    wells = Instruments.read_rdml(path, controls=True)
+    # The control has no annotations and falls back to the sample-name pattern
+    assert set(wells['Condition']) == {'Unt', 'Tre', 'NTC'}
+    assert wells['Sample'].iloc[-1] == 'NTC'
+
+def quantstudio_text(wells):
+    lines = ['* Block Type = 384-Well Block', '* Experiment Name = test', '', '[Results]',
+             'Well\tWell Position\tOmit\tSample Name\tTarget Name\tTask\tReporter\tCT']
+    for i, (gene, sample, task, ct) in enumerate(wells):
+        label = f'{chr(ord("A") + i // 24)}{i % 24 + 1}'
+        lines.append(f'{i + 1}\t{label}\t{"true" if i == 1 else "false"}\t{sample}\t{gene}\t{task}\tSYBR\t'
+                     + ('Undetermined' if np.isnan(ct) else f'{ct:.3f}'))
+    return '\n'.join(lines + ['', '[Amplification Data]', 'Well\tCycle\tTarget Name\tRn', '1\t1\tGOI\t0.1']) + '\n'
+
+def test_read_quantstudio_text(tmp_path):
+    path = tmp_path / 'results.txt'
+    path.write_text(quantstudio_text(plate_wells()))
+    wells = Instruments.read_export(path)
+    assert len(wells) == 383 and wells['Well'].iloc[1] == 'A2'
+    assert wells['Outlier'].tolist()[:3] == [False, True, False]
+    tidy = Instruments.read_export(path, tidy=True)
+    assert tidy['n_wells'].sum() == 382
+
+def cfx_csv(wells):
+    rows = [',Well,Fluor,Target,Content,Sample,Cq']
+    rows += [f'{i},{chr(ord("A") + i // 12)}{i % 12 + 1:02d},SYBR,{gene},{"NTC" if task == "NTC" else "Unkn"},'
+             f'{sample},{"" if np.isnan(ct) else round(ct, 3)}' for i, (gene, sample, task, ct) in enumerate(wells)]
+    return '\n'.join(rows) + '\n'
+
+def test_read_cfx_csv_with_well_layout(tmp_path):
+    path = tmp_path / 'cfx.csv'
+    path.write_text(cfx_csv(plate_wells(96)))
+    layout = pd.DataFrame({'Well': ['A01', 'A02'], 'Gene': ['X', 'Y'], 'Condition': ['c', 'c'], 'Replicate': [1, 1]})
+    tidy = Instruments.read_vendor_export(path, layout=layout)
+    assert list(tidy['Gene']) == ['X', 'Y'] and tidy['Technical_replicate'].tolist() == [1, 1]
+
+def test_read_quantstudio_xlsx(tmp_path):
+    pytest.importorskip('openpyxl')
+    text = quantstudio_text(plate_wells(24)).split('\n[Amplification Data]')[0]
+    rows = [line.split('\t') for line in text.splitlines()]
+    path = tmp_path / 'results.xlsx'
+    pd.DataFrame(rows).to_excel(path, sheet_name='Results', header=False, index=False)
+    wells = Instruments.read_export(path)
+    assert len(wells) == 23 and wells['Ct'].notna().all()
+
+def test_command_line_reads_exports(tmp_path, capsys):
+    from qPCR_analysis import Command_line
+    path = tmp_path / 'run.rdml'
+    write_rdml(path, plate_wells())
+    Command_line.main(['pfaffl', str(path), '-r', 'Control', '-c', 'Untreated', '-e', 'Control=100', '-e', 'GOI=100'])
+    assert capsys.readouterr().out.count('\n') == 1 + 2 * 32
+
+def test_command_line_detects_csv_exports_and_applies_qc(tmp_path, capsys):
+    from qPCR_analysis import Command_line
+    wells = plate_wells(96)
+    # One far-off well in the first GOI triplicate
+    wells[1] = wells[1][:3] + (30.0,)
+    path = tmp_path / 'cfx.csv'
+    path.write_text(cfx_csv(wells))
+    plain = tmp_path / 'plain.csv'
+    plain.write_text('Gene,Condition,Replicate,Ct1\nGOI,Untreated,1,20\n')
+    assert Instruments.is_export(path) and not Instruments.is_export(plain)
+    flagged = Instruments.read_export(path, qc='median')
+    assert flagged['Outlier'].sum() == 1 and flagged['Outlier'].iloc[1]
+
+    options = ['pfaffl', str(path), '-r', 'Control', '-c', 'Untreated', '-e', 'Control=100', '-e', 'GOI=100']
+    Command_line.main(options + ['-o', str(tmp_path / 'raw.csv')])
+    Command_line.main(options + ['--qc', 'median', '-o', str(tmp_path / 'qc.csv')])
+    raw, qc = pd.read_csv(tmp_path / 'raw.csv'), pd.read_csv(tmp_path / 'qc.csv')
+    assert len(raw) == 2 * 8 and raw['Gene Expression Ratio'].notna().all()
+    assert not np.allclose(raw['Gene Expression Ratio'], qc['Gene Expression Ratio'])
@@ -0,0 +1,39 @@
+# +
+from qPCR_analysis import Melt_curve
+import numpy as np
+import pandas as pd
+import pytest
+
+TEMPERATURES = np.arange(60, 95.01, 0.2)
+
+def melt(tm, width=0.8, amplitude=1.0):
+    return amplitude / (1 + np.exp((TEMPERATURES - tm) / width))
+
+@pytest.fixture
+def plate():
+    rng = np.random.default_rng(0)
+    fluorescence = np.vstack([melt(82), melt(84) + melt(74, amplitude=0.3), melt(85.5)])
+    return np.array(['A1', 'A2', 'A3']), TEMPERATURES, fluorescence + rng.normal(0, 0.002, fluorescence.shape)
+
+def test_melt_peaks_flags_primer_dimer(plate):
+    calls = Melt_curve.melt_peaks(*plate)
+    assert list(calls['n_peaks']) == [1, 2, 1]
+    assert list(calls['Multiple products']) == [False, True, False]
+    assert calls['Tm'].to_numpy() == pytest.approx([82, 84, 85.5], abs=0.2)
+
+def test_melt_from_long_frame():
+    long_df = pd.DataFrame({'Well': ['A1', 'A1', 'B1', 'B1'], 'Temperature': [61.0, 60.0, 61.0, 60.0],
+                            'Fluorescence': [0.5, 1.0, 0.4, 0.9]})
+    wells, temperatures, fluorescence = Melt_curve.melt_from_frame(long_df)
+    assert list(temperatures) == [60, 61]
+    assert fluorescence.tolist() == [[1.0, 0.5], [0.9, 0.4]]
+
+def test_add_melt_flags_marks_samples(plate):
+    calls = Melt_curve.melt_peaks(*plate)
+    layout = pd.DataFrame({'Well': ['A1', 'A2', 'A3'], 'Gene': ['GOI', 'GOI', 'Ref'],
+                           'Condition': ['Treated'] * 3, 'Replicate': [1] * 3})
+    tidy = pd.DataFrame({'Gene': ['GOI', 'Ref'], 'Condition': ['Treated'] * 2, 'Replicate': [1, 1],
+                         'Ct_value': [20.0, 15.0]})
+    flagged = Melt_curve.add_melt_flags(tidy, calls, layout)
+    assert list(flagged['Multiple products']) == [True, False]
+    assert 'Multiple products' not in tidy.columns
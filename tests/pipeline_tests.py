@@ -0,0 +1,49 @@
+# +
+from qPCR_analysis import Data_processing, Instrumentation, Pipeline
+import os
+import shutil
+import pytest
+import pandas as pd
+
+DATA_DIR = os.path.join(os.path.dirname(Data_processing.__file__), 'data')
+
+@pytest.fixture
+def run_folder(tmp_path):
+    for name in ['test_data.csv', 'dilution_testdata.csv', 'polysome_profile_testdata.csv']:
+        shutil.copy(os.path.join(DATA_DIR, name), tmp_path / name)
+    (tmp_path / 'broken.csv').write_text('Sample,Value\nA,1\n')
+    return tmp_path
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_run_pipeline_combines_plates_and_reports_failures(run_folder, workers):
+    results = Pipeline.run_pipeline(str(run_folder), efficiencies={'Control': 100},
+                                    reference_genes=['Control'], control_condition='Untreated', workers=workers)
+    report = results['report'].set_index('Plate')
+    assert report.loc[str(run_folder / 'broken.csv'), 'Status'] == 'failed'
+    assert (report['Status'] == 'ok').sum() == 3
+    assert list(results['efficiency']['Gene']) == ['GOI']
+    # The GOI efficiency fitted from the dilution plate feeds the Pfaffl plate
+    assert len(results['pfaffl']) == 6
+    assert set(results['polysome']['Condition']) == {'Treated', 'Untreated'}
+
+def test_pipeline_command_line_writes_tables(run_folder, tmp_path):
+    out = tmp_path / 'out'
+    status = Pipeline.main([str(run_folder), '-o', str(out), '-w', '1', '-r', 'Control', '-c', 'Untreated', '-e', 'Control=100'])
+    assert status == 1
+    assert sorted(os.listdir(out)) == ['efficiency.csv', 'pfaffl.csv', 'polysome.csv', 'report.csv']
+
+def test_pipeline_instrumentation_collects_worker_calls(run_folder, tmp_path_factory):
+    counts = {}
+    for workers in ['2', '1']:
+        # Results go outside the run folder, which is searched for plates
+        out = tmp_path_factory.mktemp(f'workers{workers}')
+        Pipeline.main([str(run_folder), '-o', str(out), '-w', workers, '-r', 'Control', '-c', 'Untreated',
+                       '-e', 'Control=100', '--instrument', str(out / 'calls.csv')])
+        counts[workers] = pd.read_csv(out / 'calls.csv')['Stage'].value_counts().sort_index()
+    # One import per plate (the broken one included) and one analysis per layout,
+    # none of them counted twice by the forked workers
+    assert counts['2']['Data_processing.import_and_tidy_data'] == 4
+    for stage in ['primer_efficiency_batch', 'pfaffl_batch', 'polysome_profiling_batch']:
+        assert counts['2'][f'Data_processing.{stage}'] == 1
+    pd.testing.assert_series_equal(counts['2'], counts['1'])
+    assert not Instrumentation.is_enabled()
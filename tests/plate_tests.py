@@ -0,0 +1,74 @@
+# +
+from qPCR_analysis import Benchmark, Data_processing
+from qPCR_analysis.Plate import Plate, Experiment
+import numpy as np
+import pandas as pd
+import pytest
+
+def tidy(layout='GER', seed=0, **sizes):
+    raw = Benchmark.synthetic_plate(layout, seed=seed, **sizes)
+    return Data_processing._tidy_chunk(raw, Data_processing.ct_columns(raw.columns))
+
+def test_gene_is_read_only_view():
+    plate = Plate.from_frame(tidy(genes=20))
+    gene = plate['Gene00005']
+    assert len(gene) == 6
+    assert np.shares_memory(gene.ct, plate.ct)
+    assert list(gene.labels('Gene')) == ['Gene00005'] * 6
+    with pytest.raises(ValueError):
+        gene.ct[0, 0] = 0
+    with pytest.raises(KeyError):
+        plate['Missing']
+
+def test_frame_round_trip_matches_batch():
+    df = tidy(genes=20)
+    df.loc[3, 'Ct2'] = 35.0
+    df = Data_processing.flag_outliers(df)
+    plate = Plate.from_frame(df)
+    efficiencies = {gene: 100.0 for gene in plate.genes}
+    expected = Data_processing.pfaffl_batch(df, efficiencies, 'Ref1', 'Untreated')
+    result = Data_processing.pfaffl_batch(plate.to_frame(), efficiencies, 'Ref1', 'Untreated')
+    assert result['Gene Expression Ratio'].to_numpy() == pytest.approx(
+        expected['Gene Expression Ratio'].to_numpy(), rel=1e-5)
+    # Long frames give the same samples
+    keys = ['Gene', 'Condition', 'Replicate']
+    long = Plate.from_frame(Data_processing.to_long_format(df))
+    assert long.mask.sum() == plate.mask.sum() == 1
+    pd.testing.assert_frame_equal(long.to_frame().sort_values(keys).reset_index(drop=True),
+                                  plate.to_frame().sort_values(keys).reset_index(drop=True))
+
+def test_missing_labels_are_not_coded_as_labels():
+    df = tidy(genes=3)
+    df['Condition'] = df['Condition'].astype(object)
+    df.loc[[0, 1], 'Condition'] = np.nan
+    df['Replicate'] = df['Replicate'].astype(float)
+    df.loc[2, 'Replicate'] = np.nan
+    plate = Plate.from_frame(df)
+    assert list(plate.levels['Condition']) == sorted(set(df['Condition'].dropna()))
+    assert plate.codes['Condition'].dtype.kind == 'i'
+    assert pd.isna(plate.labels('Condition')).sum() == 2 and pd.isna(plate.labels('Replicate')).sum() == 1
+    assert len(plate.select(Condition=np.nan)) == 2
+    frame = plate.to_frame()
+    assert frame['Condition'].isna().sum() == 2 and frame['Replicate'].isna().sum() == 1
+    # Every Gene is still a level and a slice
+    assert sum(len(plate[gene]) for gene in plate.genes) == len(df)
+
+def test_polysome_round_trip():
+    df = tidy('polysome', genes=3, fractions=4)
+    plate = Plate.from_frame(df)
+    expected = Data_processing.polysome_profiling_batch(df)
+    result = Data_processing.polysome_profiling_batch(plate.to_frame())
+    keys = ['Gene', 'Condition', 'Fraction']
+    expected = expected.sort_values(keys).reset_index(drop=True)
+    result = result.sort_values(keys).reset_index(drop=True)
+    assert result['Percent in fraction'].to_numpy() == pytest.approx(expected['Percent in fraction'].to_numpy(), rel=1e-5)
+
+def test_experiment_shares_levels_and_saves_memory():
+    frames = [tidy(genes=30, seed=seed) for seed in range(10)]
+    experiment = Experiment.from_frames(frames)
+    assert all(plate.levels['Gene'] is experiment[0].levels['Gene'] for plate in experiment)
+    assert experiment.nbytes * 3 < sum(df.memory_usage(deep=True).sum() for df in frames)
+    assert len(experiment.gene('Ref1')) == 10
+    stacked = experiment.to_frame()
+    assert len(stacked) == sum(len(df) for df in frames)
+    assert sorted(stacked['Plate'].unique()) == list(range(10))
@@ -1,5 +1,63 @@
 # +
 from qPCR_analysis import Data_processing
-import pytest 
+from qPCR_analysis import Plotting
+import os
+import matplotlib
+import matplotlib.pyplot as plt
+import pandas as pd
+from matplotlib.collections import PathCollection
+import pytest
 
+matplotlib.use('Agg')
 
+DATA_DIR = os.path.join(os.path.dirname(Data_processing.__file__), 'data')
+
+@pytest.fixture
+def analysis_results():
+    dilution = Data_processing.import_and_tidy_data(os.path.join(DATA_DIR, 'dilution_testdata.csv'))
+    ger = Data_processing.import_and_tidy_data(os.path.join(DATA_DIR, 'test_data.csv'))
+    polysome = Data_processing.import_and_tidy_data(os.path.join(DATA_DIR, 'polysome_profile_testdata.csv'))
+    return {
+        'dilution_df': dilution,
+        'efficiency_df': Data_processing.primer_efficiency_batch(dilution),
+        'pfaffl_df': Data_processing.pfaffl_batch(ger, {'GOI': 100, 'Control': 100}, 'Control', 'Untreated'),
+        'polysome_df': Data_processing.polysome_profiling_batch(polysome),
+    }
+
+def test_export_figures_writes_every_format(analysis_results, tmp_path):
+    written = Plotting.export_figures(tmp_path, formats=('png', 'svg'), workers=1, **analysis_results)
+    # One efficiency, one expression ratio and two fraction plots
+    assert len(written) == 4 * 2
+    assert all(os.path.getsize(path) > 0 for path in written)
+
+def test_save_plot_can_close_figure(analysis_results, tmp_path):
+    table = Plotting.ger_table(analysis_results['pfaffl_df'], 'GOI')
+    fig = Plotting.plot_gene_expression_ratio(table, 'GOI')
+    Plotting.save_plot(fig, tmp_path / 'ratio.png', close=True, verbose=False)
+    assert not plt.fignum_exists(fig.number)
+
+def test_plot_expression_grid_one_scatter_per_panel(analysis_results):
+    pfaffl_df = analysis_results['pfaffl_df']
+    two_genes = pd.concat([pfaffl_df, pfaffl_df.assign(Gene='GOI2')], ignore_index=True)
+    fig = Plotting.plot_expression_grid(two_genes, ncols=1)
+    visible = [ax for ax in fig.axes if ax.get_visible()]
+    assert [ax.get_title() for ax in visible] == ['GOI', 'GOI2']
+    scatters = [[c for c in ax.collections if isinstance(c, PathCollection)] for ax in visible]
+    assert all(len(panel) == 1 for panel in scatters)
+    assert len(scatters[0][0].get_offsets()) == 6
+    plt.close(fig)
+
+def test_plot_expression_grid_jitter_is_seeded(analysis_results):
+    first = Plotting.plot_expression_grid(analysis_results['pfaffl_df'], seed=3)
+    second = Plotting.plot_expression_grid(analysis_results['pfaffl_df'], seed=3)
+    offsets = [[c.get_offsets() for c in fig.axes[0].collections if isinstance(c, PathCollection)][0]
+               for fig in (first, second)]
+    assert (offsets[0] == offsets[1]).all()
+    plt.close('all')
+
+def test_plot_fraction_grid_reuses_figure(analysis_results):
+    fig = Plotting.plot_fraction_grid(analysis_results['polysome_df'])
+    again = Plotting.plot_fraction_grid(analysis_results['polysome_df'], fig=fig)
+    assert again is fig
+    assert len(fig.axes) == 1
+    plt.close(fig)
@@ -0,0 +1,109 @@
+# +
+from qPCR_analysis import Statistics
+import numpy as np
+import pandas as pd
+import pytest
+from scipy import stats
+
+@pytest.fixture
+def ratios():
+    rng = np.random.default_rng(0)
+    unchanged = rng.normal(0, 0.2, 6)
+    return pd.DataFrame({
+        'Gene': np.repeat(['A', 'B'], 12),
+        'Condition': np.tile(np.repeat(['Untreated', 'Treated'], 6), 2),
+        'Replicate': np.tile(np.arange(1, 7), 4),
+        # Gene A is induced 8-fold in Treated, gene B is unchanged
+        'Gene Expression Ratio': 2 ** np.concatenate([
+            rng.normal(0, 0.2, 6), rng.normal(3, 0.2, 6), unchanged, unchanged[::-1]]),
+    })
+
+def test_bootstrap_ci_brackets_estimate(ratios):
+    result = Statistics.bootstrap_ci(ratios, n_resamples=2000, log=True, seed=1)
+    assert list(result.columns) == ['Gene', 'Condition', 'n', 'Estimate', 'CI low', 'CI high']
+    assert (result['CI low'] <= result['Estimate']).all() and (result['Estimate'] <= result['CI high']).all()
+
+def test_bootstrap_is_reproducible_across_workers(ratios):
+    single = Statistics.bootstrap_ci(ratios, n_resamples=2000, seed=1, chunk_size=500)
+    pooled = Statistics.bootstrap_ci(ratios, n_resamples=2000, seed=1, chunk_size=500, workers=2)
+    pd.testing.assert_frame_equal(single, pooled)
+
+def test_bootstrap_difference_log_fold_change(ratios):
+    result = Statistics.bootstrap_difference(ratios, 'Untreated', n_resamples=2000, seed=1).set_index('Gene')
+    assert result.loc['A', 'CI low'] > 2
+    assert result.loc['B', 'CI low'] < 0 < result.loc['B', 'CI high']
+
+def test_permutation_test_separates_induced_gene(ratios):
+    result = Statistics.permutation_test(ratios, 'Untreated', n_resamples=2000, seed=1).set_index('Gene')
+    assert result.loc['A', 'p_value'] < 0.01
+    assert result.loc['B', 'p_value'] > 0.05
+
+def test_welch_t_test_matches_scipy(ratios):
+    result = Statistics.welch_t_test(ratios, 'Untreated').set_index('Gene')
+    gene = ratios[ratios['Gene'] == 'A']
+    expected = stats.ttest_ind(np.log2(gene.loc[gene['Condition'] == 'Treated', 'Gene Expression Ratio']),
+                               np.log2(gene.loc[gene['Condition'] == 'Untreated', 'Gene Expression Ratio']),
+                               equal_var=False)
+    assert result.loc['A', 't'] == pytest.approx(expected.statistic)
+    assert result.loc['A', 'p_value'] == pytest.approx(expected.pvalue)
+
+def test_one_way_anova_matches_scipy(ratios):
+    result = Statistics.one_way_anova(ratios).set_index('Gene')
+    gene = ratios[ratios['Gene'] == 'A']
+    expected = stats.f_oneway(*[np.log2(values) for _, values in gene.groupby('Condition')['Gene Expression Ratio']])
+    assert result.loc['A', 'F'] == pytest.approx(expected.statistic)
+    assert result.loc['A', 'p_value'] == pytest.approx(expected.pvalue)
+    assert result.loc['B', 'p_value'] == pytest.approx(1)
+
+def test_adjust_p_values():
+    p = np.array([0.01, 0.04, np.nan, 0.03, 0.2])
+    assert Statistics.adjust_p_values(p, 'fdr_bh')[[0, 1, 3, 4]] == pytest.approx([0.04, 0.0533333, 0.0533333, 0.2])
+    assert Statistics.adjust_p_values(p, 'holm')[[0, 1, 3, 4]] == pytest.approx([0.04, 0.09, 0.09, 0.2])
+    assert np.isnan(Statistics.adjust_p_values(p)[2])
+
+@pytest.fixture
+def candidate_cts():
+    rng = np.random.default_rng(0)
+    n_samples = 40
+    sample_effect = rng.normal(0, 1, n_samples)
+    noise = np.array([0.05, 0.1, 0.4, 0.8])
+    ct = 20 + sample_effect[:, None] + rng.normal(0, 1, (n_samples, 4)) * noise
+    ct[20:, 3] += 2  # Unstable gene also shifts with condition
+    return pd.DataFrame({
+        'Gene': np.tile(['Stable1', 'Stable2', 'Noisy', 'Shifted'], n_samples),
+        'Condition': np.repeat(['Untreated', 'Treated'], 20 * 4),
+        'Replicate': np.repeat(np.tile(np.arange(20), 2), 4),
+        'Ct_value': ct.ravel(),
+    })
+
+def test_genorm_ranks_stable_genes_first(candidate_cts):
+    result = Statistics.genorm(candidate_cts)
+    assert set(result['Gene'][:2]) == {'Stable1', 'Stable2'}
+    assert result['Gene'].iloc[-1] == 'Shifted'
+    assert result['M'].iloc[0] == result['M'].iloc[1]
+
+def test_normfinder_single_group_matches_reference():
+    cts = np.array([[20.1, 22.4, 25.0, 18.2],
+                    [20.3, 22.1, 25.9, 18.0],
+                    [19.8, 22.6, 24.1, 18.5],
+                    [20.0, 22.3, 25.6, 18.1],
+                    [20.2, 22.2, 24.7, 18.4]])
+    genes = ['A', 'B', 'C', 'D']
+    df = pd.DataFrame({'Gene': np.tile(genes, 5), 'Condition': 'Untreated',
+                       'Replicate': np.repeat(np.arange(1, 6), 4), 'Ct_value': cts.ravel()})
+    # Andersen et al. (2004), one group: sigma_i = sqrt((s_i^2 - sum(s^2) / (k (k - 1))) / (1 - 2 / k))
+    y = -cts
+    r = y - y.mean(axis=0) - y.mean(axis=1, keepdims=True) + y.mean()
+    n, k = y.shape
+    s2 = (r ** 2).sum(axis=0) / (n - 1)
+    reference = np.sqrt(np.clip((s2 - s2.sum() / (k * (k - 1))) / (1 - 2 / k), 0, None))
+    result = Statistics.normfinder(df).set_index('Gene')
+    assert result.loc[genes, 'Stability'].to_numpy() == pytest.approx(reference)
+    assert result.loc['B', 'Stability'] == pytest.approx(np.sqrt(0.0873333), rel=1e-5)
+    assert result['Rank'].loc['C'] == 4
+
+def test_normfinder_ranks_stable_genes_first(candidate_cts):
+    result = Statistics.normfinder(candidate_cts)
+    assert set(result['Gene'][:2]) == {'Stable1', 'Stable2'}
+    assert result['Gene'].iloc[-1] == 'Shifted'
+    assert result['Stability'].is_monotonic_increasing
@@ -0,0 +1,112 @@
+# +
+from qPCR_analysis import Benchmark, Data_processing, Watch
+import asyncio
+import os
+import zipfile
+import numpy as np
+import pandas as pd
+import pytest
+
+def test_ready_waits_for_files_to_settle(tmp_path):
+    watcher = Watch.FolderWatcher(tmp_path / 'in', tmp_path / 'out', settle=5)
+    os.makedirs(tmp_path / 'in')
+    plate = tmp_path / 'in' / 'plate.csv'
+    plate.write_text('Gene,Condition,Replicate,Ct1\n')
+    (tmp_path / 'in' / 'other.csv.part').write_text('partial')
+    assert watcher.ready(now=0) == []
+    # Still being written: the settle time restarts
+    with open(plate, 'a') as handle:
+        handle.write('A,U,1,20\n')
+    assert watcher.ready(now=4) == []
+    assert watcher.ready(now=8) == []
+    assert watcher.ready(now=9) == [(str(plate), 0)]
+    assert watcher.ready(now=20) == []
+    # Rewritten later: processed again
+    os.utime(plate, ns=(0, 10 ** 9))
+    watcher.ready(now=30)
+    assert [path for path, _ in watcher.ready(now=35)] == [str(plate)]
+    # Removed files are forgotten
+    os.remove(plate)
+    watcher.ready(now=40)
+    assert str(plate) not in watcher._seen and str(plate) not in watcher._done
+    assert list(watcher._seen) == []
+    with pytest.raises(ValueError):
+        Watch.FolderWatcher(tmp_path, tmp_path)
+
+def test_service_analyzes_plates_as_they_arrive(tmp_path):
+    folder, output = tmp_path / 'in', tmp_path / 'out'
+    os.makedirs(folder)
+    watcher = Watch.FolderWatcher(folder, output, workers=1, poll_interval=0.02, settle=0.05,
+                                  reference_genes='Ref1', control_condition='Untreated', formats=())
+
+    async def drop_plates():
+        service = asyncio.create_task(watcher.run(max_plates=3, timeout=30))
+        for name, layout in [('dilution', 'dilution'), ('ger', 'GER')]:
+            Benchmark.synthetic_plate(layout, genes=3).to_csv(folder / f'{name}.csv.tmp', index=False)
+            os.replace(folder / f'{name}.csv.tmp', folder / f'{name}.csv')
+            await asyncio.sleep(0.2)
+        (folder / 'broken.csv').write_text('not,a,plate\n1,2,3\n')
+        return await service
+
+    metrics = asyncio.run(drop_plates())
+    assert metrics['Status'].tolist() == ['ok', 'ok', 'failed']
+    assert metrics['Layout'].tolist()[:2] == ['dilution', 'GER']
+    assert (metrics['Latency'] > 0).all()
+    # GER plate used the efficiencies fitted from the dilution plate before it
+    assert set(watcher.efficiencies) >= {'Ref1', 'Gene00001'}
+    assert sorted(os.listdir(output)) == ['dilution_efficiency.csv', 'ger_pfaffl.csv', 'watch_report.csv']
+    assert len(pd.read_csv(output / 'watch_report.csv')) == 3
+    summary = watcher.summary()
+    assert summary['Plates'] == 3 and summary['Failed'] == 1
+    assert summary['Plates per minute'] > 0
+
+def test_ger_plates_wait_for_running_dilution_plates(tmp_path, monkeypatch):
+    monkeypatch.setenv('QPCR_EFFICIENCY_DIR', str(tmp_path / 'registry'))
+    folder, output = tmp_path / 'in', tmp_path / 'out'
+    os.makedirs(folder)
+    Benchmark.synthetic_plate('dilution', genes=40).to_csv(folder / 'dilution.csv', index=False)
+    Benchmark.synthetic_plate('GER', genes=3).to_csv(folder / 'ger.csv', index=False)
+    assert Watch.plate_layout(folder / 'ger.csv') == 'GER'
+    watcher = Watch.FolderWatcher(folder, output, workers=2, poll_interval=0.02, settle=0.05,
+                                  reference_genes='Ref1', control_condition='Untreated', formats=())
+    metrics = asyncio.run(watcher.run(max_plates=2, timeout=60)).set_index('Plate')
+    dilution, ger = metrics.loc[str(folder / 'dilution.csv')], metrics.loc[str(folder / 'ger.csv')]
+    # Both arrived together; the GER plate started with the fitted efficiencies
+    assert dilution['Status'] == ger['Status'] == 'ok'
+    assert ger['Started'] >= dilution['Finished']
+
+def polysome_rdml(path, plate):
+    '''
+    RDML run of a wide polysome plate, fraction and condition given as sample annotations
+    '''
+    samples = plate[['Condition', 'Fraction']].drop_duplicates()
+    parts = ['<?xml version="1.0" encoding="UTF-8"?>', '<rdml version="1.2" xmlns="http://www.rdml.org">']
+    for condition, fraction in samples.itertuples(index=False):
+        parts.append(f'<sample id="{condition}-F{fraction}"><type>unkn</type>'
+                     f'<annotation><property>Condition</property><value>{condition}</value></annotation>'
+                     f'<annotation><property>Fraction</property><value>{fraction}</value></annotation></sample>')
+    parts += [f'<target id="{gene}"><type>toi</type></target>' for gene in plate['Gene'].unique()]
+    parts.append('<experiment id="exp"><run id="run"><pcrFormat><rows>16</rows><columns>24</columns></pcrFormat>')
+    wells = [(row.Gene, f'{row.Condition}-F{row.Fraction}', ct) for row in plate.itertuples()
+             for ct in (row.Ct1, row.Ct2, row.Ct3)]
+    for i, (gene, sample, ct) in enumerate(wells, start=1):
+        parts.append(f'<react id="{i}"><sample id="{sample}"/><data><tar id="{gene}"/><cq>{ct:.3f}</cq></data></react>')
+    parts.append('</run></experiment></rdml>')
+    with zipfile.ZipFile(path, 'w') as archive:
+        archive.writestr('rdml_data.xml', '\n'.join(parts))
+
+def test_process_plate_analyzes_polysome_exports(tmp_path):
+    plate = Benchmark.synthetic_plate('polysome', genes=2)
+    polysome_rdml(tmp_path / 'polysome.rdml', plate)
+    layout, result, _ = Watch.process_plate(str(tmp_path / 'polysome.rdml'), str(tmp_path), formats=())
+    assert layout == 'polysome' and len(result) == len(plate) * 3
+    expected = Data_processing.polysome_profiling_batch(plate)
+    key = ['Gene', 'Condition', 'Replicate', 'Fraction']
+    pd.testing.assert_series_equal(result.sort_values(key)['Percent in fraction'].reset_index(drop=True),
+                                   expected.sort_values(key)['Percent in fraction'].reset_index(drop=True),
+                                   check_exact=False, rtol=1e-3)
+
+    # A plate without a single Ct is a failure, not an empty table
+    polysome_rdml(tmp_path / 'empty.rdml', plate.assign(Ct1=np.nan, Ct2=np.nan, Ct3=np.nan))
+    record = Watch._run_plate(str(tmp_path / 'empty.rdml'), str(tmp_path), {'formats': ()})
+    assert record['Status'] == 'failed' and 'No polysome results' in record['Error']